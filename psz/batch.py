@@ -0,0 +1,127 @@
+"""
+Runs a per zone tool over many zones on a pool of workers.
+
+The tools in the tools module each handle a single zone. run() takes one of
+those per zone functions and a list of zones and calls the function once per
+zone, in a process or thread pool, collecting a success or failure result for
+each zone instead of giving up on the first error.
+"""
+import errors
+import log
+
+import sys
+
+POOL_KINDS = ('process', 'thread')
+
+def _init_worker():
+    """
+    Worker setup. Errors must raise in a batch so they can be recorded
+    against the zone that caused them.
+    """
+    log.EXIT_ON_ERROR = False
+
+def _run_zone(item):
+    """
+    Runs func for one zone. Returns a (zone, rc, message) tuple.
+    """
+    func, zone = item
+    try:
+        rc = func(zone)
+    except errors.PszError, err:
+        return zone, 1, str(err)
+    except SystemExit, err:
+        if err.code is None:
+            return zone, 1, 'exited'
+        if isinstance(err.code, int):
+            return zone, err.code, err.code and 'exited' or ''
+        return zone, 1, str(err.code)
+    except Exception, err:
+        mesg = '%s: %s' % (err.__class__.__name__, err)
+        log.log("%s failed: %s" % (zone, mesg), zone=zone)
+        return zone, 1, mesg
+    return zone, rc or 0, ''
+
+def _make_pool(workers, kind):
+    """
+    Returns a pool of workers of the given kind.
+    """
+    if kind == 'thread':
+        from multiprocessing.pool import ThreadPool
+        _init_worker()
+        return ThreadPool(workers)
+    # Children must not share the parent's database connection.
+    from django.db import connection
+    connection.close()
+    from multiprocessing import Pool
+    return Pool(workers, initializer=_init_worker)
+
+def map_zones(func, zones, workers=1, kind='process'):
+    """
+    Calls func(zone) for every zone and yields (zone, rc, message) tuples
+    in the order they complete.
+
+    func must be a module level function so it can be sent to a process pool.
+    """
+    return map_tasks([(func, zone) for zone in zones], workers, kind)
+
+def map_tasks(items, workers=1, kind='process'):
+    """
+    Like map_zones for an iterable of (func, zone) pairs. items may be a
+    generator, it is read as the tasks are handed to the pool.
+    """
+    if kind not in POOL_KINDS:
+        raise errors.PszConfigError("batch_pool must be one of %s" %
+            ', '.join(POOL_KINDS))
+    # Zones run in this process set EXIT_ON_ERROR, put it back after.
+    exit_on_error = log.EXIT_ON_ERROR
+    try:
+        if workers <= 1:
+            _init_worker()
+            for item in items:
+                yield _run_zone(item)
+            return
+        pool = _make_pool(workers, kind)
+        try:
+            for result in pool.imap_unordered(_run_zone, items):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        log.EXIT_ON_ERROR = exit_on_error
+
+def run(func, zones, workers=1, kind='process', out=None):
+    """
+    Runs func over zones and prints a per zone summary.
+
+    Returns 0 if every zone succeeded, otherwise 1.
+    """
+    results = {}
+    for zone, rc, mesg in map_zones(func, zones, workers, kind):
+        results[zone] = (rc, mesg)
+    return summarize(func.__name__.lstrip('_'), zones, results, out)
+
+def summarize(name, zones, results, out=None):
+    """
+    Prints the result of each zone in results, a dict of zone to
+    (rc, message).
+
+    Returns 0 if every zone succeeded, otherwise 1.
+    """
+    if out is None:
+        out = sys.stdout
+    failed = 0
+    print >>out, "\n%s summary" % name
+    for zone in zones:
+        rc, mesg = results[zone]
+        if rc:
+            failed += 1
+            mesg = '; '.join(l.strip() for l in mesg.split('\n') if l.strip())
+            print >>out, "%s\tFAILED\t%s" % (zone, mesg)
+        else:
+            print >>out, "%s\tok" % zone
+    mesg = "%d zones, %d succeeded, %d failed" % (len(zones),
+        len(zones) - failed, failed)
+    print >>out, mesg
+    log.log("%s: %s" % (name, mesg))
+    return failed and 1 or 0
@@ -1,7 +1,14 @@
 """
 Module containing command-line tool functions for psz.
 
+Startup is kept light: Django, dnspython and syslog are only loaded by the
+commands that use them, and the commands in LIGHT_COMMANDS run without
+importing the tools module at all.
 """
+import time
+# When psz's own imports started, for --startup-profile
+_STARTED = time.time()
+
 import config
 import log
 import errors
@@ -9,8 +16,12 @@ import errors
 import os
 import sys
 from optparse import OptionParser
-from configobj import ConfigObj, ConfigObjError
-from django.conf import settings
+
+# Seconds the light commands should take to import everything they need
+STARTUP_BUDGET = 0.1
+
+# Config file path to (mtime, settings), so a file is only parsed once
+_CONFIG_CACHE = {}
 
 def _configure_django(opts):
     """
@@ -18,6 +29,9 @@ def _configure_django(opts):
     models. The settings need to be initialized before we can import out
     modles.
     """
+    from django.conf import settings
+    if settings.configured:
+        return
     settings.configure(
         DATABASE_ENGINE=opts['db_engine'],
         DATABASE_NAME=opts['db_name'],
@@ -32,20 +46,31 @@ def _get_config_from_file(config_path):
     """
     Read the config file. psz requires that a config file exists. 
     """
+    from configobj import ConfigObj, ConfigObjError
+    try:
+        mtime = os.stat(config_path).st_mtime
+    except OSError:
+        mtime = None
+    cached = _CONFIG_CACHE.get(config_path)
+    if mtime is not None and cached and cached[0] == mtime:
+        return dict(cached[1])
     try:
         cfg = ConfigObj(infile=config_path, file_error=True,
             unrepr=True, interpolation=False) 
     except (IOError, ConfigObjError), err:
         msg = "Error reading %s: %s" % (config_path, err)
         log.error(msg)
-    return cfg
+    cfg = dict(cfg)
+    _CONFIG_CACHE[config_path] = (mtime, cfg)
+    return dict(cfg)
 
-def parse_args():
+def parse_args(django=True):
     """
     Parse CLI args for most of psz's tools. 
 
+    Django is only configured if django is True.
     """
-    usage = "usage: %prog [options] zone"
+    usage = "usage: %prog [options] zone [zone...]"
     parser = OptionParser(usage=usage)
 
     defaults = config.DEFAULTS
@@ -64,25 +89,31 @@ def parse_args():
         help="Specifies the algorithm used for new KSK keys")
     parser.add_option("--ksk_keysize", dest="ksk_keysize",
         help="Specifies the number of bits in new ZSK keys")
-    parser.add_option("-d", dest="debug", action="store_true", default=False,
+    parser.add_option("-d", dest="debug", action="store_true",
         help="turns on extra debugging output and logging")
-    
-    # Parse args to get a config file arg if any
+    parser.add_option("-f", dest="zonefile",
+        help="Read zones from a file, one per line ('-' for stdin)")
+    parser.add_option("-j", dest="batch_workers", type="int",
+        help="Number of zones to work on at once")
+    parser.add_option("--pool", dest="batch_pool", choices=["process", "thread"],
+        help="Kind of worker pool used for many zones")
+
     options, args = parser.parse_args()
 
     cfg = _get_config_from_file(options.configfile)
     defaults.update(cfg)
 
-    parser.set_defaults(**defaults)
-    options, args = parser.parse_args()
-
-    # now update the config.defaults with any from command-line args
-    defaults.update(vars(options))
+    # now update the config.defaults with any from command-line args,
+    # options that weren't given are None and leave the config file's alone
+    defaults.update((key, value) for key, value in vars(options).items()
+                    if value is not None)
+    defaults.setdefault('debug', False)
 
-    if options.debug:
+    if defaults['debug']:
         config.DEBUG = True
 
-    _configure_django(defaults)
+    if django:
+        _configure_django(defaults)
 
     return defaults, args
 
@@ -98,6 +129,11 @@ def keystatus_parse_args():
         help="Specify path to config file")
     parser.add_option("-v", dest="verbose", action="store_true", default=False,
         help="shows more verbose output")
+    parser.add_option("--dns", dest="check_dns", action="store_true",
+        default=False, help="checks which keys are published in the DNS")
+    parser.add_option("--format", dest="status_format", default="text",
+        choices=["text", "csv", "json"],
+        help="output format: text, csv or json (one object per line)")
     options, args = parser.parse_args()
 
     defaults = config.DEFAULTS
@@ -105,6 +141,165 @@ def keystatus_parse_args():
     defaults.update(cfg)
 
     defaults['verbose'] = options.verbose
+    defaults['check_dns'] = options.check_dns
+    defaults['status_format'] = options.status_format
+    _configure_django(defaults)
+    return defaults, args
+
+def ds_parse_args():
+    """
+    Parse CLI args for psz's ds tool.
+    """
+    usage = "usage: %prog [options] [zone...]"
+    parser = OptionParser(usage=usage)
+
+    parser.add_option("-c", dest="configfile",
+        default=config.DEFAULT_CONFIG_PATH,
+        help="Specify path to config file")
+    parser.add_option("-f", dest="zonefile",
+        help="Read zones from a file, one per line ('-' for stdin)")
+    parser.add_option("--digest", dest="ds_digest_types",
+        help="comma separated digest types: 1 SHA-1, 2 SHA-256, 4 SHA-384")
+    parser.add_option("--format", dest="ds_format", default="text",
+        choices=["text", "cds", "csv", "json"],
+        help="output format: text (DS records), cds (CDS records), csv or "
+             "json (one object per line)")
+    options, args = parser.parse_args()
+
+    defaults = config.DEFAULTS
+    cfg = _get_config_from_file(options.configfile)
+    defaults.update(cfg)
+
+    defaults['zonefile'] = options.zonefile
+    defaults['ds_format'] = options.ds_format
+    if options.ds_digest_types:
+        defaults['ds_digest_types'] = options.ds_digest_types
+    _configure_django(defaults)
+    return defaults, args
+
+def showconfig():
+    opts, args = parse_args(django=False)
+    cf = opts.pop('configfile')
+    print "# Configuration file: %s\n" % cf
+    keys = opts.keys()
+    keys.sort()
+    for key in keys:
+        print '%s=%r' % (key, opts[key])
+    return 0
+
+def show_help():
+    sys.stdout.write(config.COMMAND_HELP)
+    return 0
+
+# Commands that don't need Django, dnspython or the tools module
+LIGHT_COMMANDS = {
+    'help': show_help,
+    'showconfig': showconfig,
+    'config': showconfig,
+}
+
+class _ImportTimer(object):
+    """
+    Replaces __import__ to add up the time spent importing modules.
+    """
+    def __init__(self):
+        import __builtin__
+        self.builtin = __builtin__
+        self.real_import = __builtin__.__import__
+        self.seconds = 0.0
+        self.depth = 0
+        __builtin__.__import__ = self
+
+    def __call__(self, *args, **kwargs):
+        self.depth += 1
+        start = time.time()
+        try:
+            return self.real_import(*args, **kwargs)
+        finally:
+            self.depth -= 1
+            if not self.depth:
+                self.seconds += time.time() - start
+
+    def stop(self):
+        self.builtin.__import__ = self.real_import
+
+def _report_startup(prog, seconds):
+    """
+    Writes how long the imports of command prog took to stderr.
+    """
+    loaded = [name for name, module in (('django', 'django.db'),
+              ('dnspython', 'dns.resolver'), ('syslog', 'logging.handlers'))
+              if module in sys.modules]
+    msg = "startup: %s imports took %.3fs" % (prog, seconds)
+    if prog in LIGHT_COMMANDS:
+        msg += ", budget %.3fs" % STARTUP_BUDGET
+        if seconds > STARTUP_BUDGET:
+            msg += " (OVER BUDGET)"
+    msg += "; loaded: %s\n" % (', '.join(loaded) or 'nothing heavy')
+    sys.stderr.write(msg)
+
+def schedule_parse_args():
+    """
+    Parse CLI args for psz's schedule tool.
+    """
+    usage = "usage: %prog [options] list | run | policy [zone...]"
+    parser = OptionParser(usage=usage)
+
+    parser.add_option("-c", dest="configfile",
+        default=config.DEFAULT_CONFIG_PATH,
+        help="Specify path to config file")
+    parser.add_option("-j", dest="batch_workers", type="int",
+        help="Number of zones to work on at once")
+    parser.add_option("--pool", dest="batch_pool", choices=["process", "thread"],
+        help="Kind of worker pool used for many zones")
+    parser.add_option("--zsk_lifetime_days", type="int",
+        help="policy: days a zone's ZSK signs before it's rolled over")
+    parser.add_option("--ksk_lifetime_days", type="int",
+        help="policy: days a zone's KSK signs before it's rolled over")
+    parser.add_option("--zone_max_ttl", type="int",
+        help="policy: largest TTL in the zone")
+    parser.add_option("--disable", dest="enabled", action="store_false",
+        help="policy: don't roll the zone's keys over")
+    parser.add_option("--enable", dest="enabled", action="store_true",
+        help="policy: roll the zone's keys over again")
+    options, args = parser.parse_args()
+
+    defaults = config.DEFAULTS
+    cfg = _get_config_from_file(options.configfile)
+    defaults.update(cfg)
+
+    if options.batch_workers is not None:
+        defaults['batch_workers'] = options.batch_workers
+    if options.batch_pool is not None:
+        defaults['batch_pool'] = options.batch_pool
+    defaults['policy_changes'] = dict((name, getattr(options, name))
+        for name in ('zsk_lifetime_days', 'ksk_lifetime_days',
+                     'zone_max_ttl', 'enabled')
+        if getattr(options, name) is not None)
+    _configure_django(defaults)
+    return defaults, args
+
+def serve_parse_args():
+    """
+    Parse CLI args for psz's serve tool.
+    """
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+
+    parser.add_option("-c", dest="configfile",
+        default=config.DEFAULT_CONFIG_PATH,
+        help="Specify path to config file")
+    parser.add_option("-s", dest="path_socket",
+        help="Unix socket to listen on")
+    options, args = parser.parse_args()
+
+    defaults = config.DEFAULTS
+    cfg = _get_config_from_file(options.configfile)
+    defaults.update(cfg)
+
+    defaults['configfile'] = options.configfile
+    if options.path_socket:
+        defaults['path_socket'] = options.path_socket
     _configure_django(defaults)
     return defaults, args
 
@@ -112,22 +307,48 @@ def main():
     """
     When 'psz toolname' is invoked from the command line, this function
     is the first to run. It then invokes the proper tool.
+
+    psz --startup-profile toolname reports the time spent importing modules.
+    Commands are sent to a psz serve daemon if PSZ_SOCKET names its socket
+    and it's listening.
     """
-    import tools
+    timer = None
+    if '--startup-profile' in sys.argv:
+        sys.argv.remove('--startup-profile')
+        timer = _ImportTimer()
+        timer.seconds = time.time() - _STARTED
     try:
         prog, sys.argv = sys.argv[1], sys.argv[1:]
     except IndexError:
         sys.stderr.write(config.COMMAND_HELP)
         sys.exit(1)
+    tool = LIGHT_COMMANDS.get(prog)
+    socket_path = os.environ.get('PSZ_SOCKET')
+    if tool is None and socket_path:
+        import server
+        if prog in server.SERVED_COMMANDS:
+            rc = server.call(socket_path, sys.argv)
+            if rc is not None:
+                if timer is not None:
+                    timer.stop()
+                    _report_startup(prog, timer.seconds)
+                sys.exit(rc)
+    if tool is None:
+        import tools
+        try:
+            tool = getattr(tools, prog)
+        except AttributeError:
+            sys.stderr.write(config.COMMAND_HELP)
+            sys.exit(1)
     try:
-        tool = getattr(tools, prog)
-    except AttributeError:
-        sys.stderr.write(config.COMMAND_HELP)
-        sys.exit(1)
-    try:
-        rc = tool()
-    except errors.PszConfigError, err:
-        log.error(err)
+        try:
+            rc = tool()
+        except errors.PszConfigError, err:
+            log.error(err)
+    finally:
+        if timer is not None:
+            timer.stop()
+            _report_startup(prog, timer.seconds)
     sys.exit(rc)
 
 if __name__ == '__main__':
@@ -30,6 +30,9 @@ DEFAULTS = {
     # Path to dnssec-keygen command
     'path_keygen'  : '/usr/local/sbin/dnssec-keygen',
 
+    # How keys are made: 'dnssec-keygen' or 'native' (needs cryptography)
+    'keygen_backend' : 'dnssec-keygen',
+
     # Path to nsupdate command
     'path_nsupdate' : '/usr/local/bin/nsupdate',
 
@@ -48,6 +51,43 @@ DEFAULTS = {
     # Path to keyfile for TSIG of dynamic updates
     'path_update_key' : '',
 
+    # Cache of the key file names in the zone directories, used by listkeys
+    # and fsck. It must be outside path_zonedir. Empty turns the cache off.
+    'path_keyindex' : '/var/tmp/psz-keyindex',
+
+    # Number of zone directories listkeys and fsck read at once
+    'inventory_workers' : 16,
+
+    # Write syslog records from a background thread instead of waiting
+    # on the syslog socket
+    'log_async' : False,
+
+    # Most records waiting for the background thread. When it's full
+    # records are written straight away.
+    'log_queue_size' : 10000,
+
+    # Syslog record format: 'text', 'kv' (key=value pairs) or 'json'
+    'log_format' : 'text',
+
+    # Name the calling function in each record
+    'log_caller' : True,
+
+    # Cache of the digests 'psz ds' computes. Empty turns the cache off.
+    'path_dscache' : '/var/tmp/psz-dscache',
+
+    # Digest types of the DS records 'psz ds' prints, 1 SHA-1, 2 SHA-256,
+    # 4 SHA-384
+    'ds_digest_types' : '2',
+
+    # Directory of pre-generated keys. The key pool is off if this is empty.
+    'path_keypool' : '',
+
+    # Number of keys of each kind 'psz keypool fill' keeps in the pool
+    'keypool_size' : 100,
+
+    # 'psz keypool refill' tops up kinds of keys with fewer than this many
+    'keypool_low_water' : 20,
+
     'zsk_algorithm'  : 'RSASHA1',
     'zsk_keysize'    : '1024',
     'ksk_algorithm'  : 'RSASHA1',
@@ -56,9 +96,51 @@ DEFAULTS = {
     # Address of nameserver for DNS lookups
     'nameserver'     : '127.0.0.1',
 
+    # Most DNS lookups in flight at once when checking many zones
+    'lookup_concurrency' : 50,
+
+    # Seconds to wait for each try of a lookup when checking many zones
+    'lookup_timeout' : 3,
+
+    # Number of times a timed out lookup is tried again
+    'lookup_retries' : 2,
+
+    # Seconds to wait for nameservers to agree on a zone's DNSKEYs after
+    # an update before giving up
+    'converge_timeout' : 120,
+
+    # First and longest pause in seconds between checks of the nameservers
+    'converge_initial_delay' : 1,
+    'converge_max_delay' : 16,
+
+    # Also wait for the zone's authoritative servers, at the IPv4 and IPv6
+    # addresses of its NS records
+    'converge_check_ns' : True,
+
     # Address of nameserver receiving dynamic updates
     'update_server'  : '127.0.0.1',
 
+    # How updates are sent: 'nsupdate' or 'native' (dnspython, no fork)
+    'update_backend' : 'nsupdate',
+
+    # Seconds to wait for a reply to a native dynamic update
+    'update_timeout' : 10,
+
+    # Most zones updated by one nsupdate process when updates are batched
+    'update_batch_size' : 500,
+
+    # Send lookups and native updates over pooled, persistent TCP connections
+    'dns_pool' : False,
+
+    # Most connections the pool keeps open to one server
+    'dns_pool_max_per_server' : 4,
+
+    # Seconds before the pool closes an unused connection
+    'dns_pool_idle_timeout' : 10,
+
+    # Number of queries sent down one connection before reading the replies
+    'dns_pool_pipeline' : 32,
+
     # TTL for DNS records added via dynamic update
     'update_ttl'     : 7200,
 
@@ -70,6 +152,46 @@ DEFAULTS = {
 
     # Does our dynamic update need to use TSIG?
     'update_use_tsig' : True,
+
+    # Number of zones worked on at once when a tool is given many zones
+    'batch_workers' : 1,
+
+    # Kind of worker pool for batches, 'process' or 'thread'
+    'batch_pool' : 'process',
+
+    # Unix socket 'psz serve' listens on. Clients use the daemon when the
+    # PSZ_SOCKET environment variable names this socket.
+    'path_socket' : '/var/run/psz/psz.sock',
+
+    # Most commands 'psz serve' runs at once
+    'serve_max_children' : 40,
+
+    # Days a ZSK or KSK signs before 'psz schedule run' rolls it over.
+    # Zones can have their own with 'psz schedule policy'.
+    'zsk_lifetime_days' : 30,
+    'ksk_lifetime_days' : 365,
+
+    # Largest TTL in a zone. Signatures made by an old ZSK stay in caches
+    # this long, so stage 2 of a ZSK rollover waits for it.
+    'zone_max_ttl' : 86400,
+
+    # TTL of the zone's DS records in its parent. Stage 2 of a KSK rollover
+    # waits for this and update_ttl after stage 1.
+    'ds_ttl' : 86400,
+
+    # Nameserver 'psz schedule run' looks up DS records with before KSK
+    # stage 2. It must be a resolver that can reach the parent zone, not
+    # just the zone's own server. Empty for the first one in resolv.conf.
+    'ds_nameserver' : '',
+
+    # Extra seconds rollovers wait for changes to reach every nameserver
+    'propagation_delay' : 3600,
+
+    # Rollovers 'psz schedule run' starts per second, in all and for the
+    # zones of each nameserver, and how many may start at once after a lull
+    'schedule_rate' : 1.0,
+    'schedule_rate_per_server' : 0.2,
+    'schedule_burst' : 5,
 }
 
 # These things aren't defaults so much.
@@ -80,7 +202,8 @@ try:
 except:
     USER = '<unknown user>'
 
-USAGE_ZONE = "You must supply the name of the DNS zone as the last argument.\n"
+USAGE_ZONE = ("You must supply the name of the DNS zone as the last argument"
+    " or a file of zones with -f.\n")
 
 DEBUG = False
 
@@ -114,9 +237,20 @@ commands:
   roll_ksk_stage1    perform the 1st stage rollover of zone's KSK
   roll_ksk_stage2    perform the 2nd stage rollover of zone's KSK
   unsign             removes all DNSKEYs from a zone
+  keypool            fill, refill or show stats of the pre-generated key pool
+  serve              runs a daemon that answers psz commands on a Unix socket
+  schedule           runs or lists the rollovers that are due by policy
 
   showconfig         display psz's configuration settings
+  help               display this list of commands
   createdb           creates database tables for the first time
+  migratedb          updates the tables of an older psz database
+  backfill           stores the DNSKEYs of older keys in the database
   shell              Runs interactive Python shell configured for psz
   listkeys           Displays all keyfiles for active keys
+  fsck               Checks the key files on disk against the database
+  audit              Compares the database, key files and DNS for all zones
+  ds                 Prints the DS records of zones' KSKs for their parents
+
+psz --startup-profile command ... reports how long psz took to import.
 """
@@ -0,0 +1,218 @@
+"""
+Pool of persistent TCP connections to nameservers.
+
+Opening a TCP connection for every query or dynamic update costs a handshake
+and leaves a socket in TIME_WAIT. The pool keeps connections to each server
+open between messages and sends several messages down one connection before
+reading the replies (RFC 7766 pipelining).
+
+    get_pool() - returns this process's ConnectionPool
+"""
+import config
+
+import dns.entropy
+import dns.exception
+import dns.message
+import os
+import socket
+import struct
+import threading
+import time
+
+class Connection(object):
+    """
+    A TCP connection to a nameserver that carries many DNS messages.
+    """
+    def __init__(self, server, port, timeout):
+        self.server = server
+        self.port = port
+        self.timeout = timeout
+        self.sock = socket.create_connection((server, port), timeout)
+        self.last_used = time.time()
+
+    def close(self):
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+    def _recv_exactly(self, count):
+        data = []
+        while count:
+            chunk = self.sock.recv(count)
+            if not chunk:
+                raise EOFError("%s closed the connection" % self.server)
+            data.append(chunk)
+            count -= len(chunk)
+        return ''.join(data)
+
+    def exchange(self, messages):
+        """
+        Writes all messages and then reads their responses. Returns the
+        responses in the same order as messages.
+        """
+        pending = {}
+        wires = []
+        for message in messages:
+            while message.id in pending:
+                message.id = dns.entropy.random_16()
+            # to_wire() signs TSIG messages and sets message.mac
+            wire = message.to_wire()
+            pending[message.id] = message
+            wires.append(struct.pack('!H', len(wire)) + wire)
+        self.sock.sendall(''.join(wires))
+
+        responses = {}
+        while pending:
+            size = struct.unpack('!H', self._recv_exactly(2))[0]
+            wire = self._recv_exactly(size)
+            msgid = struct.unpack('!H', wire[:2])[0]
+            query = pending.pop(msgid, None)
+            if query is None:
+                # A reply to something we've given up on, ignore it.
+                continue
+            response = dns.message.from_wire(wire, keyring=query.keyring,
+                request_mac=query.mac)
+            if not query.is_response(response):
+                raise dns.exception.FormError("unexpected response")
+            responses[msgid] = response
+        self.last_used = time.time()
+        return [responses[message.id] for message in messages]
+
+
+class ConnectionPool(object):
+    """
+    Keeps up to max_per_server connections open to each server and closes
+    connections that have been idle for idle_timeout seconds.
+    """
+    def __init__(self, max_per_server=4, idle_timeout=10, timeout=10):
+        self.max_per_server = max_per_server
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self._idle = {}
+        self._open = {}
+        self._cond = threading.Condition()
+
+    def _expire(self, now):
+        """
+        Closes idle connections that the server has probably given up on.
+        Called with the lock held.
+        """
+        for key, conns in self._idle.items():
+            fresh = []
+            for conn in conns:
+                if now - conn.last_used > self.idle_timeout:
+                    conn.close()
+                    self._open[key] -= 1
+                else:
+                    fresh.append(conn)
+            self._idle[key] = fresh
+
+    def _get(self, key):
+        """
+        Returns an idle connection to key or a new one, waiting up to
+        timeout seconds if the server already has max_per_server
+        connections in use.
+        """
+        deadline = time.time() + self.timeout
+        self._cond.acquire()
+        try:
+            while True:
+                now = time.time()
+                self._expire(now)
+                idle = self._idle.get(key)
+                if idle:
+                    return idle.pop()
+                if self._open.get(key, 0) < self.max_per_server:
+                    self._open[key] = self._open.get(key, 0) + 1
+                    break
+                if now >= deadline:
+                    raise dns.exception.Timeout("all %d connections to %s "
+                        "are busy" % (self.max_per_server, key[0]))
+                self._cond.wait(deadline - now)
+        finally:
+            self._cond.release()
+        try:
+            return Connection(key[0], key[1], self.timeout)
+        except Exception:
+            self._discard(key, None)
+            raise
+
+    def _put(self, key, conn):
+        self._cond.acquire()
+        try:
+            self._idle.setdefault(key, []).append(conn)
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def _discard(self, key, conn):
+        if conn is not None:
+            conn.close()
+        self._cond.acquire()
+        try:
+            self._open[key] -= 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def exchange(self, server, messages, port=53):
+        """
+        Sends messages to server down one pooled connection and returns the
+        responses in order. A connection that fails, usually because the
+        server closed it while it sat idle, is replaced and the messages are
+        sent once more.
+        """
+        key = (server, port)
+        for attempt in (1, 2):
+            conn = self._get(key)
+            try:
+                responses = conn.exchange(messages)
+            except (socket.error, EOFError, dns.exception.DNSException), err:
+                self._discard(key, conn)
+                if attempt == 2 or isinstance(err, dns.exception.FormError):
+                    raise
+                continue
+            self._put(key, conn)
+            return responses
+
+    def query(self, server, message, port=53):
+        """
+        Sends one message to server and returns the response.
+        """
+        return self.exchange(server, [message], port)[0]
+
+    def close(self):
+        """
+        Closes all idle connections.
+        """
+        self._cond.acquire()
+        try:
+            for key, conns in self._idle.items():
+                for conn in conns:
+                    conn.close()
+                    self._open[key] -= 1
+            self._idle = {}
+        finally:
+            self._cond.release()
+
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+def get_pool():
+    """
+    Returns the connection pool of this process, making it on first use.
+    A forked child gets a new pool rather than its parent's sockets.
+    """
+    global _POOL
+    _POOL_LOCK.acquire()
+    try:
+        if _POOL is None or _POOL.pid != os.getpid():
+            defaults = config.DEFAULTS
+            _POOL = ConnectionPool(defaults['dns_pool_max_per_server'],
+                defaults['dns_pool_idle_timeout'], defaults['update_timeout'])
+        return _POOL
+    finally:
+        _POOL_LOCK.release()
@@ -0,0 +1,144 @@
+"""
+DS records of KSKs, for the parent zone or a registrar.
+
+A DS record is a digest of the zone's name and a DNSKEY's rdata, which psz
+keeps in the database, so no DNS lookup is needed. Digests are cached in
+path_dscache by zone, keytag and digest type. Each entry keeps a checksum
+of the rdata it was made from so a key that was replaced isn't given the
+old key's digest.
+"""
+from config import DEFAULTS as defaults
+import errors
+
+import hashlib
+import json
+import os
+import zlib
+
+# Digest type numbers of RFC 4034, 4509 and 6605
+DIGEST_TYPES = {
+    1: hashlib.sha1,
+    2: hashlib.sha256,
+    4: hashlib.sha384,
+}
+
+def parse_digest_types(text):
+    """
+    Returns the digest type numbers in text, a comma separated list.
+    """
+    try:
+        types = [int(t) for t in str(text).split(',') if t.strip()]
+    except ValueError:
+        types = None
+    if not types or [t for t in types if t not in DIGEST_TYPES]:
+        raise errors.PszConfigError("digest types must be some of %s" %
+            ', '.join(str(t) for t in sorted(DIGEST_TYPES)))
+    return types
+
+def digest(zone, rdata, digest_type):
+    """
+    Returns the hex digest of the DS record of zone for the DNSKEY rdata
+    text, like '257 3 8 AwEAA...'.
+    """
+    import dns.name
+    import dns.rdata
+    import dns.rdataclass
+    import dns.rdatatype
+    owner = dns.name.from_text(zone).canonicalize().to_wire()
+    dnskey = dns.rdata.from_text(dns.rdataclass.IN, dns.rdatatype.DNSKEY,
+                                 rdata)
+    data = owner + dnskey.to_digestable()
+    return DIGEST_TYPES[digest_type](data).hexdigest().upper()
+
+def in_ds_rrset(zone, rdata, ds_rrset):
+    """
+    Returns True if ds_rrset, the DS records of zone in its parent, has one
+    for the DNSKEY rdata text.
+    """
+    import binascii
+    import dns.dnssec
+    import dns.rdata
+    import dns.rdataclass
+    import dns.rdatatype
+    dnskey = dns.rdata.from_text(dns.rdataclass.IN, dns.rdatatype.DNSKEY,
+                                 rdata)
+    keytag = dns.dnssec.key_id(dnskey)
+    for ds in ds_rrset:
+        if ds.key_tag != keytag or ds.algorithm != dnskey.algorithm:
+            continue
+        if ds.digest_type not in DIGEST_TYPES:
+            continue
+        if binascii.hexlify(ds.digest).upper() == digest(zone, rdata,
+                                                        ds.digest_type):
+            return True
+    return False
+
+
+class DigestCache(object):
+    """
+    Digests of DNSKEYs, saved to path between runs.
+    """
+    def __init__(self, path=None):
+        if path is None:
+            path = defaults['path_dscache']
+        self.path = path
+        self.cache = self._load()
+        self.computed = 0
+
+    def _load(self):
+        if not self.path:
+            return {}
+        try:
+            fp = open(self.path)
+            try:
+                cache = json.load(fp)
+            finally:
+                fp.close()
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(cache, dict):
+            return {}
+        return cache
+
+    def save(self):
+        if not self.path or not self.computed:
+            return
+        tmp = '%s.%d' % (self.path, os.getpid())
+        try:
+            fp = open(tmp, 'w')
+            try:
+                json.dump(self.cache, fp)
+            finally:
+                fp.close()
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            # The cache only saves time, run without it.
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    def digest(self, zone, keytag, rdata, digest_type):
+        """
+        Returns the digest of a DNSKEY from the cache or by computing it.
+        """
+        rdata = str(rdata)
+        ident = '%s %s %d' % (zone, keytag, digest_type)
+        checksum = zlib.crc32(rdata) & 0xffffffff
+        cached = self.cache.get(ident)
+        if cached and cached[0] == checksum:
+            return cached[1]
+        value = digest(zone, rdata, digest_type)
+        self.cache[ident] = [checksum, value]
+        self.computed += 1
+        return value
+
+    def ds_records(self, zone, keytag, rdata, digest_types):
+        """
+        Returns a (zone, keytag, algorithm number, digest type, digest)
+        tuple for each of digest_types.
+        """
+        algnum = int(rdata.split()[2])
+        return [(zone, keytag, algnum, digest_type,
+                 self.digest(zone, keytag, rdata, digest_type))
+                for digest_type in digest_types]
@@ -17,6 +17,9 @@ class PszError(Exception):
 class PszConfigError(PszError):
     _msg = 'There was a problem with your configuration. Check the following:\n'
 
+class PszFatalError(PszError):
+    pass
+
 class PszKeygenError(PszError):
     _msg = 'Keygen error: '
 
@@ -26,5 +29,28 @@ class PszDnsError(PszError):
 class PszDnsCountError(PszDnsError):
     pass
 
-class PszDnsUpdateServfail(PszDnsError):
+class PszDnsConvergenceError(PszDnsCountError):
+    _msg = "Nameservers didn't converge:"
+
+class PszDnsUpdateError(PszDnsError):
+    """
+    A dynamic update failed. rcode is the text of the response code, e.g.
+    'REFUSED', or None if the update got no response.
+    """
+    def __init__(self, *args, **kwargs):
+        self.rcode = kwargs.pop('rcode', None)
+        PszDnsError.__init__(self, *args)
+
+class PszDnsUpdateServfail(PszDnsUpdateError):
     _msg = 'Dns SERVFAIL Error'
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('rcode', 'SERVFAIL')
+        PszDnsUpdateError.__init__(self, *args, **kwargs)
+
+def update_error(rcode, *args):
+    """
+    Returns the exception for a dynamic update that failed with rcode.
+    """
+    if rcode == 'SERVFAIL':
+        return PszDnsUpdateServfail(*args)
+    return PszDnsUpdateError(rcode=rcode, *args)
@@ -0,0 +1,275 @@
+"""
+An index of the key files on disk.
+
+Key files live in path_zonedir/<zone> and its newkeys and oldkeys
+directories. scan() reads those directories on a pool of threads and returns
+an Index of the K*.key and K*.private files found, keyed by zone and keytag.
+The names in each directory are cached with the directory's mtime in
+path_keyindex, so a rescan only reads the directories that changed.
+
+check() compares an Index with the keys in the database and returns the
+problems it finds: files without a partner or a database row, rows whose
+files are missing and rows whose files aren't where their status says.
+"""
+from config import DEFAULTS as defaults
+
+import json
+import os
+import re
+import time
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+_KEYFILE_RE = re.compile(
+    r'^K(?P<zone>.+)\.\+(?P<algnum>\d{3})\+(?P<keytag>\d{5})\.(?P<ext>key|private)$')
+
+# Directory mtimes this close to the scan aren't trusted, the directory
+# could change again within the same tick.
+_RACY_SECONDS = 2
+
+def _list_dir(path):
+    """
+    Returns the names of the files in path and of its subdirectories.
+    """
+    files = []
+    dirs = []
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_dir():
+                dirs.append(entry.name)
+            else:
+                files.append(entry.name)
+        return files, dirs
+    for name in os.listdir(path):
+        if os.path.isdir(os.path.join(path, name)):
+            dirs.append(name)
+        else:
+            files.append(name)
+    return files, dirs
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class Index(object):
+    """
+    The key files found on disk.
+
+    keys is a dict of (zone, keytag) to a dict of directory to the set of
+    extensions ('key', 'private') found there.
+    """
+    def __init__(self):
+        self.keys = {}
+        self.algorithms = {}
+        self.zones = set()
+
+    def add(self, directory, name):
+        match = _KEYFILE_RE.match(name)
+        if match is None:
+            return
+        zone = match.group('zone').rstrip('.')
+        keytag = str(int(match.group('keytag')))
+        ident = (zone, keytag)
+        self.keys.setdefault(ident, {}).setdefault(directory, set()).add(
+            match.group('ext'))
+        self.algorithms[ident] = int(match.group('algnum'))
+
+    def directories(self, zone, keytag):
+        """
+        Returns the directories holding files of a key.
+        """
+        return self.keys.get((zone, keytag), {})
+
+    def items(self):
+        items = self.keys.items()
+        items.sort()
+        return items
+
+
+class Scanner(object):
+    """
+    Scans zone directories, reusing the cached names of directories that
+    haven't changed.
+    """
+    def __init__(self, zonedir=None, cache_path=None, workers=None):
+        if zonedir is None:
+            zonedir = defaults['path_zonedir']
+        if cache_path is None:
+            cache_path = defaults['path_keyindex']
+        if workers is None:
+            workers = defaults['inventory_workers']
+        self.zonedir = zonedir
+        self.cache_path = cache_path
+        self.workers = max(1, int(workers))
+        self.cache = self._load()
+        self.rescanned = 0
+
+    def _load(self):
+        if not self.cache_path:
+            return {}
+        try:
+            fp = open(self.cache_path)
+            try:
+                cache = json.load(fp)
+            finally:
+                fp.close()
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(cache, dict):
+            return {}
+        return cache
+
+    def save(self):
+        if not self.cache_path:
+            return
+        tmp = '%s.%d' % (self.cache_path, os.getpid())
+        try:
+            fp = open(tmp, 'w')
+            try:
+                json.dump(self.cache, fp)
+            finally:
+                fp.close()
+            os.rename(tmp, self.cache_path)
+        except (IOError, OSError):
+            # The cache only saves time, run without it.
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    def _names(self, path, started):
+        """
+        Returns (files, dirs) of path from the cache or by reading it.
+        """
+        mtime = _mtime(path)
+        if mtime is None:
+            self.cache.pop(path, None)
+            return [], []
+        cached = self.cache.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1], cached[2]
+        try:
+            files, dirs = _list_dir(path)
+        except OSError:
+            return [], []
+        self.rescanned += 1
+        if started - mtime > _RACY_SECONDS:
+            self.cache[path] = [mtime, files, dirs]
+        else:
+            self.cache.pop(path, None)
+        return files, dirs
+
+    def _scan_zone(self, zone_path, started):
+        """
+        Returns [(directory, names)] for a zone directory and its key
+        directories.
+        """
+        found = []
+        paths = [zone_path]
+        for sub in (defaults['path_newkeydir'], defaults['path_oldkeydir']):
+            if sub:
+                paths.append(os.path.join(zone_path, sub))
+        for path in paths:
+            files = self._names(path, started)[0]
+            found.append((path, [n for n in files if n.startswith('K')]))
+        return found
+
+    def scan(self, zones=None, save=True):
+        """
+        Returns an Index of the key files of zones, or of every zone
+        directory if zones is None. The cache is written unless save is
+        False, for callers scanning a few zones at a time who call save()
+        at the end.
+        """
+        started = time.time()
+        if zones is None:
+            zones = sorted(d for d in self._names(self.zonedir, started)[1]
+                           if not d.startswith('.'))
+        zone_paths = [os.path.join(self.zonedir, zone) for zone in zones]
+        func = lambda path: self._scan_zone(path, started)
+        if self.workers > 1 and len(zone_paths) > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(self.workers, len(zone_paths)))
+            try:
+                results = pool.map(func, zone_paths)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [func(path) for path in zone_paths]
+
+        index = Index()
+        index.zones.update(zones)
+        for found in results:
+            for directory, names in found:
+                for name in names:
+                    index.add(directory, name)
+        if save:
+            self.save()
+        return index
+
+
+def _expected_directory(zone, keytype, status):
+    import models
+    path = models._key_file_path(zone, keytype, status)
+    if path is None:
+        return None
+    return os.path.normpath(path)
+
+def key_problem(index, zone, keytag, keytype, status):
+    """
+    Returns what's wrong with the files of a key in the database, or None
+    if both are in the directory its status says.
+    """
+    where = index.directories(zone, str(int(keytag)))
+    expected = _expected_directory(zone, keytype, status)
+    if expected is None:
+        if status == 'deleted' and where:
+            return "%s is deleted but has files in %s" % (keytype,
+                ', '.join(sorted(where)))
+        return None
+    pairs = [os.path.normpath(d) for d, exts in where.items()
+             if len(exts) == 2]
+    if not where:
+        return "%s %s has no key files, expected in %s" % (keytype, status,
+                                                           expected)
+    if expected not in pairs:
+        return "%s %s should be in %s but is in %s" % (keytype, status,
+            expected, ', '.join(sorted(where)))
+    return None
+
+def check(index, rows):
+    """
+    Compares index with rows, the KeyRecords of the keys in the database.
+    Returns a sorted list of (zone, keytag, problem).
+    """
+    problems = []
+    tracked = set()
+    for row in rows:
+        ident = (row.zone, str(int(row.keytag)))
+        tracked.add(ident)
+        problem = key_problem(index, row.zone, row.keytag, row.type,
+                              row.status)
+        if problem is not None:
+            problems.append(ident + (problem,))
+
+    for ident, where in index.items():
+        for directory, exts in sorted(where.items()):
+            if len(exts) == 1:
+                missing = 'key' in exts and 'private' or 'key'
+                problems.append(ident + ("no .%s file next to the .%s in %s" %
+                    (missing, list(exts)[0], directory),))
+        if ident not in tracked and ident[0] in index.zones:
+            problems.append(ident + ("files in %s aren't in the database" %
+                ', '.join(sorted(where)),))
+    problems.sort()
+    return problems
@@ -2,13 +2,77 @@
 The module has one function:
 
     create_key - Creates DNSKEYs
+
+Keys are made by one of two backends, picked by the keygen_backend setting:
+
+    dnssec-keygen - runs BIND's dnssec-keygen command
+    native        - makes the key in this process with the cryptography
+                    library and writes BIND compatible key files itself
 """
-from config import DEFAULTS as defaults
+from config import DEFAULTS as defaults, KEY_ALGORITHMS
 from errors import PszKeygenError
 
+import base64
+import binascii
+import os
+import struct
 import subprocess
+import sys
+
+# The cryptography modules are only imported when the native backend is used.
+default_backend = ec = rsa = None
+
+def have_cryptography():
+    """
+    Imports the cryptography modules the native backend needs. Returns
+    False if they aren't installed.
+    """
+    global default_backend, ec, rsa
+    if rsa is None:
+        try:
+            from cryptography.hazmat.backends import default_backend
+            from cryptography.hazmat.primitives.asymmetric import ec, rsa
+        except ImportError:
+            return False
+    return True
+
+KEYGEN_BACKENDS = ('dnssec-keygen', 'native')
+
+# Algorithm mnemonics used in BIND's private key files
+_PRIVATE_ALGORITHM_NAMES = {
+    1: 'RSA',
+    5: 'RSASHA1',
+    7: 'NSEC3RSASHA1',
+    8: 'RSASHA256',
+    10: 'RSASHA512',
+    13: 'ECDSAP256SHA256',
+    14: 'ECDSAP384SHA384',
+}
+
+_RSA_ALGORITHMS = (1, 5, 7, 8, 10)
+
+# Algorithm number to (curve name, size in bytes of a coordinate)
+_ECDSA_CURVES = {
+    13: ('SECP256R1', 32),
+    14: ('SECP384R1', 48),
+}
 
-def create_key(zone, algorithm, keysize, keytype):
+def create_key(zone, algorithm, keysize, keytype, directory=None):
+    """
+    Create DNSKEY with specified parameters using the configured backend.
+
+    The key files are written to directory, or the current directory if
+    none is given. Returns the key's name and the contents of its .key file.
+    """
+    backend = defaults['keygen_backend']
+    if backend == 'native':
+        return _native_create_key(zone, algorithm, keysize, keytype,
+                                  directory)
+    elif backend == 'dnssec-keygen':
+        return _dnssec_keygen(zone, algorithm, keysize, keytype, directory)
+    raise PszKeygenError("Unknown keygen_backend '%s'" % backend)
+
+def _dnssec_keygen(zone, algorithm, keysize, keytype, directory=None):
     """
     Create DNSKEY using dnssec-keygen with specified parameters
     """
@@ -18,9 +82,10 @@ def create_key(zone, algorithm, keysize, keytype):
         cmd_args += ["-f", "KSK"]
     cmd_args.append(zone)
     try:
-        process = subprocess.Popen(cmd_args, stdout=subprocess.PIPE)
+        process = subprocess.Popen(cmd_args, stdout=subprocess.PIPE,
+            cwd=directory)
         output = process.communicate()[0]
-    except OSError, err: 
+    except OSError, err:
         raise PszKeygenError('%s' % err)
     returncode = process.returncode
     if returncode != 0:
@@ -30,8 +95,153 @@ def create_key(zone, algorithm, keysize, keytype):
     nameparts = keyname.split('+')
     keytag = nameparts[2]
     try:
-        dnsdata = open("%s.key" % keyname).read()[:-1]
-    except OSError, err:
+        path = os.path.join(directory or '', "%s.key" % keyname)
+        dnsdata = open(path).read()[:-1]
+    except (IOError, OSError), err:
         raise PszKeygenError('%s' % err)
 
     return keyname, dnsdata
+
+def _int_to_bytes(number, length=None):
+    """
+    Returns number as a big-endian string of bytes, zero padded to length.
+    """
+    hexed = '%x' % number
+    if len(hexed) % 2:
+        hexed = '0' + hexed
+    data = binascii.unhexlify(hexed)
+    if length is not None:
+        data = data.rjust(length, '\0')
+    return data
+
+def _b64(data):
+    return base64.b64encode(data)
+
+def _b64_words(data):
+    """
+    Base64 encodes data split into 56 character words, the way BIND
+    writes DNSKEY rdata in .key files.
+    """
+    encoded = _b64(data)
+    return ' '.join(encoded[i:i + 56] for i in range(0, len(encoded), 56))
+
+def _rsa_key(algnum, keysize):
+    """
+    Makes an RSA key. Returns its public key in RFC 3110 format and the
+    fields of its private key file.
+    """
+    key = rsa.generate_private_key(public_exponent=65537,
+        key_size=int(keysize), backend=default_backend())
+    numbers = key.private_numbers()
+    public = numbers.public_numbers
+    exponent = _int_to_bytes(public.e)
+    if len(exponent) < 256:
+        wire = chr(len(exponent))
+    else:
+        wire = '\0' + struct.pack('!H', len(exponent))
+    wire += exponent + _int_to_bytes(public.n)
+    fields = [
+        ('Modulus', public.n),
+        ('PublicExponent', public.e),
+        ('PrivateExponent', numbers.d),
+        ('Prime1', numbers.p),
+        ('Prime2', numbers.q),
+        ('Exponent1', numbers.dmp1),
+        ('Exponent2', numbers.dmq1),
+        ('Coefficient', numbers.iqmp),
+    ]
+    fields = [(name, _b64(_int_to_bytes(value))) for name, value in fields]
+    return wire, 'v1.2', fields
+
+def _ecdsa_key(algnum):
+    """
+    Makes an ECDSA key. Returns its public key in RFC 6605 format and the
+    fields of its private key file.
+    """
+    curve_name, size = _ECDSA_CURVES[algnum]
+    curve = getattr(ec, curve_name)()
+    key = ec.generate_private_key(curve, default_backend())
+    numbers = key.private_numbers()
+    public = numbers.public_numbers
+    wire = _int_to_bytes(public.x, size) + _int_to_bytes(public.y, size)
+    fields = [('PrivateKey', _b64(_int_to_bytes(numbers.private_value, size)))]
+    return wire, 'v1.3', fields
+
+def _native_create_key(zone, algorithm, keysize, keytype, directory=None):
+    """
+    Create DNSKEY in this process and write BIND style key files for it.
+    """
+    if not have_cryptography():
+        raise PszKeygenError("keygen_backend 'native' needs the "
+            "cryptography module")
+    import named
+
+    algnum = int(KEY_ALGORITHMS[algorithm])
+    if keytype.upper() == 'KSK':
+        flags = 257
+    else:
+        flags = 256
+    directory = directory or os.getcwd()
+    zone = zone.rstrip('.')
+
+    if algnum not in _RSA_ALGORITHMS and algnum not in _ECDSA_CURVES:
+        raise PszKeygenError("The native keygen backend can't make "
+            "%s keys" % algorithm)
+
+    for attempt in range(10):
+        try:
+            if algnum in _RSA_ALGORITHMS:
+                wire, version, fields = _rsa_key(algnum, keysize)
+            else:
+                wire, version, fields = _ecdsa_key(algnum)
+        except ValueError, err:
+            raise PszKeygenError('%s' % err)
+        keytag = named.keytag_from_parts(flags, 3, algnum, wire)
+        keyname = 'K%s.+%03d+%05d' % (zone, algnum, keytag)
+        path_private = os.path.join(directory, '%s.private' % keyname)
+        try:
+            # O_EXCL reserves the keytag, a clash means we try again.
+            fd = os.open(path_private, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0600)
+        except OSError, err:
+            if os.path.exists(path_private):
+                continue
+            raise PszKeygenError('%s' % err)
+        break
+    else:
+        raise PszKeygenError("Couldn't find an unused keytag for %s" % zone)
+
+    path_public = os.path.join(directory, '%s.key' % keyname)
+    try:
+        try:
+            private = ['Private-key-format: %s' % version,
+                       'Algorithm: %d (%s)' % (algnum,
+                                               _PRIVATE_ALGORITHM_NAMES[algnum])]
+            private.extend('%s: %s' % field for field in fields)
+            dnsdata = '%s. IN DNSKEY %d 3 %d %s' % (zone, flags, algnum,
+                                                     _b64_words(wire))
+            os.write(fd, '\n'.join(private) + '\n')
+            os.close(fd)
+            fd = None
+            fp = open(path_public, 'w')
+            try:
+                fp.write('%s\n' % dnsdata)
+            finally:
+                fp.close()
+        except (IOError, OSError), err:
+            raise PszKeygenError('%s' % err)
+    except:
+        # Half written files would pass for a key and hold its keytag.
+        exc_info = sys.exc_info()
+        if fd is not None:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        for path in (path_private, path_public):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        raise exc_info[0], exc_info[1], exc_info[2]
+    return keyname, dnsdata
@@ -3,14 +3,23 @@ Logging routines dnssec tools.
 
 Emits to syslog.
 
+Records can carry fields such as zone, keytag and stage, and are written as
+text, key=value pairs or JSON (log_format). With log_async on they are
+handed to a background thread so callers don't wait on syslog.
+
 This module needs refactoring.
 """
 
 import logging
-import logging.handlers
 import config
+import errors
 import sys
 import os
+import threading
+
+# When False, error() raises PszFatalError instead of exiting so that
+# batch runs can carry on with the next zone.
+EXIT_ON_ERROR = True
 
 if os.path.exists("/dev/log"):
     # Linux
@@ -24,28 +33,183 @@ else:
 
 LOGGER = logging.getLogger("dnssec")
 LOGGER.setLevel(logging.DEBUG)
-FACILITY = logging.handlers.SysLogHandler.LOG_DAEMON 
 
-SYSLOG_H = logging.handlers.SysLogHandler(address=SYSLOG_PATH,
-    facility=FACILITY)
-FORMATTER = logging.Formatter("%(message)s")
-SYSLOG_H.setFormatter(FORMATTER)
-LOGGER.addHandler(SYSLOG_H)
+# The syslog handler is made by the first log() call, so commands that
+# never log don't import logging.handlers or open the syslog socket.
+SYSLOG_H = None
+_SYSLOG_LOCK = threading.Lock()
+
+def _syslog_handler():
+    """
+    Returns the syslog handler, adding it to LOGGER on first use.
+    """
+    global SYSLOG_H
+    _SYSLOG_LOCK.acquire()
+    try:
+        if SYSLOG_H is None:
+            import logging.handlers
+            facility = logging.handlers.SysLogHandler.LOG_DAEMON
+            if SYSLOG_PATH is None:
+                handler = logging.handlers.SysLogHandler(facility=facility)
+            else:
+                handler = logging.handlers.SysLogHandler(address=SYSLOG_PATH,
+                    facility=facility)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            LOGGER.addHandler(handler)
+            SYSLOG_H = handler
+        return SYSLOG_H
+    finally:
+        _SYSLOG_LOCK.release()
+
+# Fields of structured records, in the order they are written
+FIELDS = ('zone', 'keytag', 'stage')
+
+def _format(caller, msg, fields):
+    """
+    Returns the text of a record in the log_format from the config file:
+    'text' (the message, with any fields after it as key=value), 'kv' or
+    'json'.
+    """
+    fmt = config.DEFAULTS.get('log_format', 'text')
+    if fmt == 'json':
+        import json
+        record = {'user': config.USER, 'msg': msg}
+        if caller:
+            record['caller'] = caller
+        record.update(fields)
+        return json.dumps(record, sort_keys=True)
+    pairs = [(key, fields[key]) for key in FIELDS if key in fields]
+    pairs.extend(sorted((key, value) for key, value in fields.items()
+                        if key not in FIELDS))
+    if fmt == 'kv':
+        head = [('caller', caller), ('user', config.USER), ('msg', msg)]
+        pairs = [(k, v) for k, v in head if v] + pairs
+        return ' '.join('%s=%s' % (k, _quote(v)) for k, v in pairs)
+    text = '%s: %s: %s' % (caller or '-', config.USER, msg)
+    if pairs:
+        text += ' ' + ' '.join('%s=%s' % (k, _quote(v)) for k, v in pairs)
+    return text
+
+def _quote(value):
+    value = str(value)
+    if not value or [c for c in ' \t\n"=' if c in value]:
+        return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+    return value
+
+
+class _AsyncWriter(object):
+    """
+    Hands records to a background thread that writes them to syslog, so
+    callers don't wait on the syslog socket. The thread writes whatever
+    has been queued each time it wakes up.
+    """
+    def __init__(self, size):
+        import atexit
+        import Queue
+        self.queue = Queue.Queue(size)
+        self.full = Queue.Full
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self._run,
+                                       name='psz-log-writer')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.flush)
+        if 'multiprocessing' in sys.modules:
+            # Pool workers leave through os._exit, which skips atexit.
+            from multiprocessing import util
+            util.Finalize(None, self.flush, exitpriority=10)
+
+    def _run(self):
+        while True:
+            records = [self.queue.get()]
+            while not self.queue.empty():
+                records.append(self.queue.get_nowait())
+            for record in records:
+                try:
+                    try:
+                        LOGGER.handle(record)
+                    except Exception:
+                        # The thread must live on, or flush() never returns.
+                        (SYSLOG_H or logging.Handler()).handleError(record)
+                finally:
+                    self.queue.task_done()
+
+    def put(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except self.full:
+            # Rather than drop records, write this one ourselves.
+            LOGGER.handle(record)
+
+    def flush(self):
+        self.queue.join()
+
+WRITER = None
+
+def _writer():
+    """
+    Returns the async writer if log_async is on in the config file, making
+    a new one in a child that was forked from a process with a writer.
+    """
+    global WRITER
+    if not config.DEFAULTS.get('log_async'):
+        return None
+    if WRITER is None or WRITER.pid != os.getpid():
+        _SYSLOG_LOCK.acquire()
+        try:
+            if WRITER is None or WRITER.pid != os.getpid():
+                if WRITER is not None:
+                    # Forked while the parent's writer thread may have
+                    # held a handler's lock.
+                    for handler in LOGGER.handlers:
+                        handler.createLock()
+                WRITER = _AsyncWriter(
+                    int(config.DEFAULTS.get('log_queue_size', 10000)))
+        finally:
+            _SYSLOG_LOCK.release()
+    return WRITER
+
+def flush():
+    """
+    Waits until the async writer has written every record queued.
+    """
+    if WRITER is not None and WRITER.pid == os.getpid():
+        WRITER.flush()
+
+def _emit(msg, fields, depth):
+    _syslog_handler()
+    caller = None
+    if config.DEFAULTS.get('log_caller', True):
+        caller = sys._getframe(depth).f_code.co_name
+    record = LOGGER.makeRecord(LOGGER.name, logging.INFO, '', 0,
+                               _format(caller, msg, fields), None, None)
+    writer = _writer()
+    if writer is None:
+        LOGGER.handle(record)
+    else:
+        writer.put(record)
 
-def log(msg):
+def log(msg, **fields):
     """
     Logs to syslog with username and caller.
+
+    fields, such as zone, keytag and stage, are added to the record.
     """
-    func_name = LOGGER.findCaller()[2]
-    LOGGER.info('%s: %s: %s' % (func_name, config.USER, msg))
-   
-def error(*msgs):
+    _emit(msg, fields, 2)
+
+def error(*msgs, **fields):
     """
     Logs error to syslog and stderr and bails.
+
+    Raises PszFatalError instead of exiting if EXIT_ON_ERROR is False.
     """
     msg = '\n'.join(str(m) for m in msgs)
+    if not EXIT_ON_ERROR:
+        _emit(msg, fields, 2)
+        raise errors.PszFatalError(msg)
     sys.stderr.write("%s\n" % msg)
-    log(msg)
+    _emit(msg, fields, 2)
+    flush()
     sys.exit(1)
 
 if __name__ == '__main__':
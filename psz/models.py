@@ -6,17 +6,30 @@ dnssec key files.
 
 BaseDnskey provides the persistance layer via Django's ORM.
 
+KeyRecord is a lighter, read only view of a Dnskey row for reports.
+
+PooledKey tracks key pairs made ahead of time so rollovers don't have to
+wait on dnssec-keygen.
+
 LogMessage is hardly used and should probably just go away.
+
+transition() changes the status of several keys and adds their log
+messages in one transaction.
 """
 
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Manager
+from collections import namedtuple
 from datetime import datetime
+import errno
+import hashlib
 import os
 import sys
+import time
 
 import config
 import keygen
+import log
 from errors import PszError
 
 KEY_TYPES = (
@@ -37,7 +50,37 @@ KEY_STATUSES = (
 )
 
 
-class DnskeyManager(Manager):
+def zone_hash(zone):
+    """
+    Returns the fixed width hash of a zone name that is indexed in place
+    of the unbounded zone column.
+    """
+    if isinstance(zone, unicode):
+        zone = zone.encode('utf-8')
+    return hashlib.sha1(zone).hexdigest()
+
+
+class ZoneManager(Manager):
+    """
+    Provides lookups by zone that use the indexed zone_hash column.
+    """
+    def for_zone(self, zone):
+        """
+        Returns the objects of a zone.
+        """
+        return self.get_query_set().filter(zone_hash=zone_hash(zone),
+                                           zone=zone)
+
+    def for_zones(self, zones):
+        """
+        Returns the objects of a list of zones.
+        """
+        return self.get_query_set().filter(
+            zone_hash__in=[zone_hash(zone) for zone in zones],
+            zone__in=zones)
+
+
+class DnskeyManager(ZoneManager):
     """
     Provides convenience methods for Dnskey objects.
     """
@@ -46,10 +89,18 @@ class DnskeyManager(Manager):
         Returns the non expired keys for a zone or for all zones if
         no zone is specified.
         """
-        qs = self.get_query_set().exclude(status__in=['expired', 'deleted'])
         if zone:
-            qs = qs.filter(zone=zone)
-        return qs
+            qs = self.for_zone(zone)
+        else:
+            qs = self.get_query_set()
+        return qs.exclude(status__in=['expired', 'deleted'])
+
+    def get_zone_key(self, zone, status, type):
+        """
+        Returns the key of zone with status and type. Raises DoesNotExist
+        or MultipleObjectsReturned unless there is exactly one.
+        """
+        return self.for_zone(zone).get(status=status, type=type)
 
 
 class BaseDnskey(models.Model):
@@ -59,7 +110,8 @@ class BaseDnskey(models.Model):
     """
     algorithm = models.CharField(max_length=128, choices=KEY_ALGOS)
     keytag = models.CharField(max_length=128, db_index=True)
-    zone = models.TextField(db_index=True)
+    zone = models.TextField()
+    zone_hash = models.CharField(max_length=40, db_index=True, editable=False)
     type = models.CharField(max_length=32, choices=KEY_TYPES)
     size = models.IntegerField()
     status = models.CharField(
@@ -67,6 +119,11 @@ class BaseDnskey(models.Model):
         default='new'
     )
     updated = models.DateTimeField(default=datetime.now)
+    # The key's DNSKEY rdata ("flags protocol algorithm key"), flags and
+    # algorithm number, so its .key file needn't be read
+    rdata = models.TextField(null=True, blank=True)
+    flags = models.IntegerField(null=True, blank=True)
+    algnum = models.IntegerField(null=True, blank=True)
 
     class Meta:
         abstract = True
@@ -76,6 +133,10 @@ class BaseDnskey(models.Model):
     def __cmp__(self, other):
         return cmp(self.type, other.type)
 
+    def save(self, *args, **kwargs):
+        self.zone_hash = zone_hash(self.zone)
+        super(BaseDnskey, self).save(*args, **kwargs)
+
     def __unicode__(self):
         return "%s %s %s (%s %s bits)" % (
             self.zone, self.type, self.keytag, self.algorithm, self.size
@@ -93,6 +154,25 @@ _KEY_LOCATIONS = {
 }
 
 
+def split_dnsdata(dnsdata):
+    """
+    Returns the rdata, flags and algorithm number of dnsdata, the text of
+    a .key file.
+    """
+    tokens = []
+    for line in dnsdata.splitlines():
+        line = line.split(';', 1)[0]
+        tokens.extend(line.split())
+    upper = [token.upper() for token in tokens]
+    try:
+        start = upper.index('DNSKEY') + 1
+        flags, protocol, algnum = [int(t) for t in tokens[start:start + 3]]
+    except ValueError:
+        raise PszError("Not a DNSKEY: %s" % dnsdata)
+    rdata = ' '.join(tokens[start:])
+    return rdata, flags, algnum
+
+
 def _key_file_path(zone, keytype, keystatus):
     """
     Returns the directory where a key's files should be located
@@ -107,6 +187,82 @@ def _key_file_path(zone, keytype, keystatus):
         return None
     return str(os.path.join(config.DEFAULTS['path_zonedir'], zone, subdir))
 
+def _read_key_file(path):
+    """
+    Returns the text of a .key file less its newline, or None if it can't
+    be read.
+    """
+    if path is None:
+        return None
+    try:
+        return open(path).read()[:-1]
+    except IOError:
+        return None
+
+# Columns of a KeyRecord, in order. rdata is last so it can be left out.
+KEY_RECORD_FIELDS = ('id', 'zone', 'type', 'keytag', 'algorithm', 'size',
+                     'status', 'updated', 'rdata')
+
+class KeyRecord(namedtuple('KeyRecord', KEY_RECORD_FIELDS)):
+    """
+    A read only Dnskey row for reports. It's a tuple made straight from
+    values_list, without Dnskey's __init__ or its cached paths, and works
+    out its file names when they are asked for.
+    """
+    __slots__ = ()
+
+    @property
+    def keyname(self):
+        if not (self.algorithm and self.zone and self.keytag):
+            return None
+        algonum = config.KEY_ALGORITHMS[self.algorithm]
+        return str('K%s.+%s+%s' % (self.zone, algonum, self.keytag))
+
+    @property
+    def directory(self):
+        if not self.zone:
+            return None
+        return _key_file_path(self.zone, self.type, self.status)
+
+    def _path(self, ext):
+        directory = self.directory
+        keyname = self.keyname
+        if directory is None or keyname is None:
+            return None
+        return os.path.join(directory, '%s.%s' % (keyname, ext))
+
+    @property
+    def path_public(self):
+        return self._path('key')
+
+    @property
+    def path_private(self):
+        return self._path('private')
+
+    def read_dnsdata(self):
+        """Returns the text of the key's .key file or None if it can't
+        be read.
+        """
+        return _read_key_file(self.path_public)
+
+    def __str__(self):
+        return "%s %s %s (%s %s bits)" % (self.zone, self.type, self.keytag,
+                                          self.algorithm, self.size)
+
+def key_records(keys, rdata=False):
+    """
+    Yields a KeyRecord for each of the keys of a queryset, streamed from
+    the database. The rdata column is only read if rdata is True.
+    """
+    fields = KEY_RECORD_FIELDS
+    if not rdata:
+        fields = fields[:-1]
+    make = KeyRecord._make
+    for row in keys.values_list(*fields).iterator():
+        if not rdata:
+            row += (None,)
+        yield make(row)
+
 
 class Dnskey(BaseDnskey):
     """
@@ -122,20 +278,48 @@ class Dnskey(BaseDnskey):
 
     @property
     def dnsdata(self):
-        """Returns the public key portion of the DNSKEY's rdata."""
+        """Returns the public key portion of the DNSKEY's rdata.
+
+        It comes from the database and the .key file is only read for
+        keys saved before the rdata was stored.
+        """
         if self._dnsdata is not None:
             return self._dnsdata
-        if self.path_public is None:
-            return None
-        try:
-            self._dnsdata = open(self.path_public).read()[:-1]
-        except IOError:
-            pass
+        if self.rdata:
+            self._dnsdata = '%s. IN DNSKEY %s' % (self.zone.rstrip('.'),
+                                                  self.rdata)
+            return self._dnsdata
+        dnsdata = self.read_dnsdata()
+        if dnsdata is not None:
+            self.dnsdata = dnsdata
         return self._dnsdata
 
     @dnsdata.setter
     def dnsdata(self, value):
         self._dnsdata = value
+        if value is not None:
+            try:
+                self.rdata, self.flags, self.algnum = split_dnsdata(value)
+            except PszError:
+                pass
+
+    def read_dnsdata(self):
+        """Returns the text of the key's .key file or None if it can't
+        be read.
+        """
+        return _read_key_file(self.path_public)
+
+    def verify_dnsdata(self):
+        """Returns True if the key's .key file has the DNSKEY stored in
+        the database.
+        """
+        dnsdata = self.read_dnsdata()
+        if dnsdata is None or not self.rdata:
+            return False
+        try:
+            return split_dnsdata(dnsdata)[0] == self.rdata
+        except PszError:
+            return False
 
     @property
     def keyname(self):
@@ -203,9 +387,11 @@ class Dnskey(BaseDnskey):
         self._path_private = new_path_private
         self.directory = destination
 
-    def unlink(self):
+    def unlink(self, save=True):
         """
-        Unlinks a key's public and private files.
+        Unlinks a key's public and private files and marks it deleted.
+        With save False the new status is left for the caller to save,
+        with transition(). Returns False if the key has no files.
         """
         if self.path_public and self.path_private:
             try:
@@ -216,7 +402,10 @@ class Dnskey(BaseDnskey):
                 os.unlink(self.path_private)
             except OSError, e:
                 print >>sys.stderr, "%s" % e
-            self.update('deleted')
+            if save:
+                self.update('deleted')
+            return True
+        return False
 
     def update(self, status):
         """
@@ -229,8 +418,10 @@ class Dnskey(BaseDnskey):
         self.save()
 
     @classmethod
-    def from_dnssec_keygen(cls, zone, keytype='ZSK', algname=None, size=None):
+    def from_dnssec_keygen(cls, zone, keytype='ZSK', algname=None, size=None,
+                           directory=None):
         """Create key pair on disk and returns Dnskey instance
+        The key pair is made in directory or the current directory.
         The instance isn't saved in the ORM by default.
         XXX move this to keygen directory?
         """
@@ -238,7 +429,8 @@ class Dnskey(BaseDnskey):
             algname = config.DEFAULTS[keytype.lower() + '_algorithm']
         if size is None:
             size = config.DEFAULTS[keytype.lower() + '_keysize']
-        keyname, dnsdata = keygen.create_key(zone, algname, size, keytype)
+        keyname, dnsdata = keygen.create_key(zone, algname, size, keytype,
+                                             directory)
         nameparts = keyname.split('+')
         keytag = nameparts[2]
         inst = cls(
@@ -247,12 +439,327 @@ class Dnskey(BaseDnskey):
         )
         inst.dnsdata = dnsdata
         inst.keyname = keyname
-        inst.directory = os.getcwd()
+        inst.directory = directory or os.getcwd()
         return inst
 
+    @classmethod
+    def from_keypool(cls, zone, keytype='ZSK', algname=None, size=None,
+                     directory=None):
+        """Claims a key pair from the key pool for zone and returns a
+        Dnskey instance, or None if the pool has no suitable key.
+        The key pair is moved to directory or the current directory.
+        The instance isn't saved in the ORM by default.
+        """
+        if algname is None:
+            algname = config.DEFAULTS[keytype.lower() + '_algorithm']
+        if size is None:
+            size = config.DEFAULTS[keytype.lower() + '_keysize']
+        if directory is None:
+            directory = os.getcwd()
+        claimed = PooledKey.objects.claim(zone, keytype, algname, size,
+                                          directory)
+        if claimed is None:
+            return None
+        keyname, dnsdata = claimed
+        inst = cls(
+            algorithm=algname, keytag=keyname.split('+')[2],
+            zone=zone, type=keytype.upper(), size=size,
+        )
+        inst.dnsdata = dnsdata
+        inst.keyname = keyname
+        inst.directory = directory
+        return inst
+
+    @classmethod
+    def generate(cls, zone, keytype='ZSK', algname=None, size=None,
+                 directory=None):
+        """Returns a new Dnskey for zone, taken from the key pool when
+        possible and made with dnssec-keygen otherwise.
+        """
+        inst = cls.from_keypool(zone, keytype, algname, size, directory)
+        if inst is None:
+            inst = cls.from_dnssec_keygen(zone, keytype, algname, size,
+                                          directory)
+        return inst
+
+
+# Placeholder owner name of keys in the pool. A key's tag doesn't depend on
+# its owner name, so a pooled key is renamed for its zone when claimed.
+POOL_ZONE = 'keypool.psz.invalid'
+
+
+class PooledKeyManager(Manager):
+    """
+    Fills and hands out keys from the key pool.
+    """
+    def pool_dir(self):
+        """
+        Returns the directory holding the pool's key files or None if the
+        pool isn't configured.
+        """
+        return config.DEFAULTS['path_keypool'] or None
+
+    def fill(self, keytype, algname, size, count, workers=1):
+        """
+        Adds count new keys of a kind to the pool. Returns the number made.
+        """
+        pool_dir = self.pool_dir()
+        if pool_dir is None or count <= 0:
+            return 0
+
+        def make(i):
+            return keygen.create_key(POOL_ZONE, algname, str(size), keytype,
+                                     pool_dir)
+
+        if workers > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(workers)
+            try:
+                made = pool.map(make, range(count))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            made = [make(i) for i in range(count)]
+        for keyname, dnsdata in made:
+            self.create(
+                algorithm=algname, keytag=keyname.split('+')[2],
+                type=keytype, size=int(size), keyname=keyname,
+            )
+        return len(made)
+
+    def stats(self):
+        """
+        Returns a dict of (type, algorithm, size) to the number of keys
+        of that kind in the pool.
+        """
+        counts = {}
+        for kind in self.get_query_set().values_list('type', 'algorithm',
+                                                     'size'):
+            counts[kind] = counts.get(kind, 0) + 1
+        return counts
+
+    def claim(self, zone, keytype, algname, size, directory):
+        """
+        Moves a pooled key of the given kind into directory, renamed for zone.
+
+        Returns (keyname, dnsdata) or None if the pool has no such key.
+        Renaming the private key file is the atomic step, so two processes
+        can't both claim the same key.
+        """
+        pool_dir = self.pool_dir()
+        if pool_dir is None:
+            return None
+        candidates = self.get_query_set().filter(
+            type=keytype.upper(), algorithm=algname, size=int(size),
+        ).order_by('id')
+        for pooled in candidates[:10]:
+            algonum = config.KEY_ALGORITHMS[algname]
+            keyname = str('K%s.+%s+%s' % (zone, algonum, pooled.keytag))
+            public = os.path.join(directory, '%s.key' % keyname)
+            private = os.path.join(directory, '%s.private' % keyname)
+            if os.path.exists(public) or os.path.exists(private):
+                continue
+            pool_public = os.path.join(pool_dir, '%s.key' % pooled.keyname)
+            pool_private = os.path.join(pool_dir,
+                                        '%s.private' % pooled.keyname)
+            try:
+                os.rename(pool_private, private)
+            except OSError, err:
+                if err.errno == errno.ENOENT and not self._claimed(pooled):
+                    # The files are gone, don't let the row hide the keys
+                    # after it.
+                    log.log("key pool: %s has no private key file, "
+                            "dropping it" % pooled.keyname)
+                    pooled.delete()
+                # Otherwise somebody else got it first.
+                continue
+            try:
+                pool_data = open(pool_public).read()[:-1]
+                dnsdata = '%s. %s' % (zone, pool_data.split(None, 1)[1])
+                fp = open(public, 'w')
+                fp.write('%s\n' % dnsdata)
+                fp.close()
+                os.unlink(pool_public)
+            except (IOError, OSError), err:
+                log.log("key pool: failed claiming %s: %s" %
+                    (pooled.keyname, err))
+                try:
+                    os.unlink(private)
+                except OSError:
+                    pass
+                pooled.delete()
+                continue
+            pooled.delete()
+            self._check_low_water(keytype, algname, size)
+            return keyname, dnsdata
+        return None
+
+    def _claimed(self, pooled):
+        """
+        Returns True if another process claimed pooled. The last step of a
+        claim is deleting the row, so a claim still going gets a moment to
+        finish before the row is taken to be stale.
+        """
+        rows = self.get_query_set().filter(pk=pooled.pk)
+        if not rows.count():
+            return True
+        time.sleep(0.1)
+        return not rows.count()
+
+    def _check_low_water(self, keytype, algname, size):
+        """
+        Logs a warning when a kind of key is running low in the pool.
+        """
+        low_water = config.DEFAULTS['keypool_low_water']
+        left = self.get_query_set().filter(
+            type=keytype.upper(), algorithm=algname, size=int(size),
+        ).count()
+        if left < low_water:
+            log.log("key pool: only %d %s %s %s bit keys left" %
+                (left, keytype.upper(), algname, size))
+
+
+class PooledKey(models.Model):
+    """
+    A key pair in the key pool, waiting to be claimed by a zone.
+    """
+    algorithm = models.CharField(max_length=128, choices=KEY_ALGOS)
+    keytag = models.CharField(max_length=128)
+    type = models.CharField(max_length=32, choices=KEY_TYPES)
+    size = models.IntegerField()
+    keyname = models.CharField(max_length=255)
+    created = models.DateTimeField(default=datetime.now)
+
+    objects = PooledKeyManager()
+
+    def __unicode__(self):
+        return "%s %s (%s %s bits)" % (
+            self.type, self.keytag, self.algorithm, self.size
+            )
+
 
 class LogMessage(models.Model):
-    zone = models.TextField(db_index=True)
+    zone = models.TextField()
+    zone_hash = models.CharField(max_length=40, db_index=True, editable=False)
     user = models.CharField(max_length=32, default=config.USER)
     timestamp = models.DateTimeField(default=datetime.now)
     message = models.TextField()
+
+    objects = ZoneManager()
+
+    def save(self, *args, **kwargs):
+        self.zone_hash = zone_hash(self.zone)
+        super(LogMessage, self).save(*args, **kwargs)
+
+
+def add_log_messages(messages, now=None):
+    """
+    Adds LogMessages for a list of (zone, message) pairs with one INSERT.
+    """
+    from django.db import connection
+    if not messages:
+        return
+    if now is None:
+        now = datetime.now()
+    timestamp = connection.ops.value_to_db_datetime(now)
+    qn = connection.ops.quote_name
+    columns = ('zone', 'zone_hash', 'user', 'timestamp', 'message')
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        qn(LogMessage._meta.db_table), ', '.join(qn(c) for c in columns),
+        ', '.join(['%s'] * len(columns)))
+    rows = [(zone, zone_hash(zone), config.USER, timestamp, message)
+            for zone, message in messages]
+    cursor = connection.cursor()
+    cursor.executemany(sql, rows)
+    transaction.commit_unless_managed()
+
+@transaction.commit_on_success
+def _apply_transition(changes, messages, now):
+    by_status = {}
+    for key, status in changes:
+        if key.pk is None:
+            key.save()
+        else:
+            by_status.setdefault(status, []).append(key.pk)
+    for status, pks in by_status.items():
+        Dnskey.objects.filter(pk__in=pks).update(status=status, updated=now)
+    add_log_messages(messages, now)
+
+def transition(changes, messages=()):
+    """
+    Moves keys to new statuses and adds log messages in one transaction.
+
+    changes is a list of (Dnskey, status) pairs and messages a list of
+    (zone, message) pairs. The keys going to each status are changed with
+    one UPDATE and the messages are added with one INSERT, so a crash
+    can't leave some of the changes made. Keys that aren't saved yet are
+    inserted with their new status. Keys already in their new status are
+    left alone, as update() does.
+    """
+    now = datetime.now()
+    changes = [(key, status) for key, status in changes
+               if key.pk is None or key.status != status]
+    saved = [(key, key.pk, key.status, key.updated) for key, status in changes]
+    for key, status in changes:
+        key.status = status
+        key.updated = now
+    try:
+        _apply_transition(changes, messages, now)
+    except:
+        for key, pk, status, updated in saved:
+            key.pk, key.status, key.updated = pk, status, updated
+        raise
+
+
+class ZonePolicy(models.Model):
+    """
+    A zone's rollover policy. Fields that are None use the defaults from
+    the config file.
+    """
+    zone = models.TextField()
+    zone_hash = models.CharField(max_length=40, unique=True, editable=False)
+    zsk_lifetime_days = models.IntegerField(null=True, blank=True)
+    ksk_lifetime_days = models.IntegerField(null=True, blank=True)
+    zone_max_ttl = models.IntegerField(null=True, blank=True)
+    enabled = models.BooleanField(default=True)
+
+    objects = ZoneManager()
+
+    def save(self, *args, **kwargs):
+        self.zone_hash = zone_hash(self.zone)
+        super(ZonePolicy, self).save(*args, **kwargs)
+
+    def __unicode__(self):
+        return "%s policy" % self.zone
+
+
+# Indexes Django can't make for us: (name suffix, model, columns)
+COMPOSITE_INDEXES = (
+    ('zone_status_type', Dnskey, ('zone_hash', 'status', 'type')),
+    ('status_type_updated', Dnskey, ('status', 'type', 'updated')),
+    ('zone_timestamp', LogMessage, ('zone_hash', 'timestamp')),
+)
+
+
+def create_indexes(cursor, quote_name):
+    """
+    Creates the COMPOSITE_INDEXES that don't exist yet. Returns the names
+    of the indexes made.
+    """
+    made = []
+    for suffix, model, columns in COMPOSITE_INDEXES:
+        table = model._meta.db_table
+        name = '%s_%s' % (table, suffix)
+        sql = 'CREATE INDEX %s ON %s (%s)' % (quote_name(name),
+            quote_name(table), ', '.join(quote_name(c) for c in columns))
+        try:
+            cursor.execute(sql)
+        except Exception, err:
+            transaction.rollback_unless_managed()
+            if 'exist' not in str(err).lower() and \
+               'duplicate' not in str(err).lower():
+                raise
+            continue
+        made.append(name)
+    return made
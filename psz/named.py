@@ -1,14 +1,153 @@
 """
 Funtions for talking to the nameserver for queies and updates.
+
+Dynamic updates are sent by one of two backends, picked by the
+update_backend setting:
+
+    nsupdate - runs the nsupdate command for each update
+    native   - sends the update from this process with dnspython
 """
 import config
+import connpool
 import errors
 import log
 
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.query
+import dns.rcode
+import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
 import dns.resolver
+import dns.tsig
+import dns.tsigkeyring
+import dns.update
+import array
+import os
+import re
 import struct
+import sys
+import time
 from subprocess import Popen, PIPE
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+UPDATE_BACKENDS = ('nsupdate', 'native')
+
+# TSIG algorithm numbers used in the names of dnssec-keygen's HMAC key files
+_TSIG_ALGORITHMS = {
+    157: dns.tsig.HMAC_MD5,
+    161: dns.tsig.HMAC_SHA1,
+    162: dns.tsig.HMAC_SHA224,
+    163: dns.tsig.HMAC_SHA256,
+    164: dns.tsig.HMAC_SHA384,
+    165: dns.tsig.HMAC_SHA512,
+}
+
+_KEY_STATEMENT_RE = re.compile(
+    r'key\s+"?([^"\s{]+)"?\s*{.*?algorithm\s+"?([\w.-]+)"?\s*;'
+    r'.*?secret\s+"([^"]+)"', re.S)
+
+_NSUPDATE_RCODE_RE = re.compile(r'update failed: (\w+)')
+
+# TSIG keys read from disk, by path
+_TSIG_KEYS = {}
+
+def _read_tsig_key(path):
+    """
+    Reads a TSIG key from path, either a dnssec-keygen K*.private (or .key)
+    file or a file with a named.conf style key statement, the two kinds
+    of file that nsupdate -k takes.
+
+    Returns a (keyring, keyname, algorithm) tuple.
+    """
+    if path in _TSIG_KEYS:
+        return _TSIG_KEYS[path]
+    filename = os.path.basename(path)
+    if filename.startswith('K') and filename.endswith('.key'):
+        path = path[:-len('.key')] + '.private'
+        filename = os.path.basename(path)
+    try:
+        text = open(path).read()
+    except IOError, err:
+        raise errors.PszConfigError("path_update_key: %s" % err)
+    match = _KEY_STATEMENT_RE.search(text)
+    if match:
+        keyname, algorithm, secret = match.groups()
+        algorithm = dns.name.from_text(algorithm)
+        if algorithm == dns.name.from_text('hmac-md5'):
+            algorithm = dns.tsig.HMAC_MD5
+    else:
+        try:
+            keyname, rest = filename[1:].split('.+', 1)
+            algorithm = _TSIG_ALGORITHMS[int(rest.split('+')[0])]
+            secret = re.search(r'^Key:\s*(\S+)', text, re.M).group(1)
+        except (ValueError, KeyError, AttributeError):
+            raise errors.PszConfigError(
+                "path_update_key '%s' isn't a TSIG key file" % path)
+    keyring = dns.tsigkeyring.from_text({keyname: secret})
+    key = (keyring, dns.name.from_text(keyname), algorithm)
+    _TSIG_KEYS[path] = key
+    return key
+
+def _answer_rrset(query, response):
+    """
+    Returns the rrset answering query from response or () if there isn't
+    one, like Dns.lookup does for NXDOMAIN and NoAnswer.
+    """
+    rcode = response.rcode()
+    if rcode == dns.rcode.NXDOMAIN:
+        return ()
+    if rcode != dns.rcode.NOERROR:
+        raise errors.PszDnsError("lookup of %s failed: %s" %
+            (query.question[0].name, dns.rcode.to_text(rcode)))
+    question = query.question[0]
+    try:
+        return response.find_rrset(response.answer, question.name,
+            question.rdclass, question.rdtype)
+    except KeyError:
+        return ()
+
+def _serial_gte(serial, other):
+    """
+    Is SOA serial the same as or later than other? See RFC 1982.
+    """
+    return serial == other or ((serial - other) % 2**32) < 2**31
+
+def _dnskey_problem(keytags, present, absent, count):
+    """
+    Returns why a set of keytags doesn't meet a wait_for_dnskeys condition,
+    or None if it does.
+    """
+    missing = present - keytags
+    if missing:
+        return "keyid %s not published" % ', '.join(map(str, sorted(missing)))
+    extra = absent & keytags
+    if extra:
+        return "keyid %s still published" % ', '.join(map(str, sorted(extra)))
+    if count is not None and len(keytags) != count:
+        return "%d DNSKEYs, expected %d" % (len(keytags), count)
+    return None
+
+def _dnskey_rdata(dnsdata):
+    """
+    Returns the DNSKEY rdata of dnsdata, the text of a key's .key file.
+    """
+    tokens = dnsdata.split()
+    upper = [token.upper() for token in tokens]
+    try:
+        start = upper.index('DNSKEY') + 1
+    except ValueError:
+        raise errors.PszDnsError("Not a DNSKEY: %s" % dnsdata)
+    return dns.rdata.from_text(dns.rdataclass.IN, dns.rdatatype.DNSKEY,
+                               ' '.join(tokens[start:]))
+
 class Dns(object):
     """
     Interface to the DNS.
@@ -48,12 +187,113 @@ class Dns(object):
         Lookup a given domain name and rdtype in the local nameserver.
 
         Returns instance of a dns.resolver.Answer or ().
+        With dns_pool on, the answer's rrset is returned instead.
         """
+        if config.DEFAULTS['dns_pool']:
+            return self.query_many([qname], rdtype)[0]
         try:
             return self._resolver.query(qname, rdtype)
         except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
             return () 
 
+    def lookup_many(self, qnames, rdtype):
+        """
+        Looks up rdtype for many names at once, lookup_concurrency at a time.
+
+        Each query waits lookup_timeout seconds for an answer and is tried
+        lookup_retries more times before giving up. Truncated UDP answers
+        are retried over TCP. With dns_pool on, the names are instead
+        pipelined over pooled TCP connections.
+
+        Returns a dict of qname to the answer's rrset, () if there isn't
+        one, or a PszDnsError if the lookup failed.
+        """
+        defaults = config.DEFAULTS
+        qnames = list(qnames)
+        if defaults['dns_pool']:
+            step = defaults['dns_pool_pipeline']
+            chunks = [qnames[i:i + step] for i in range(0, len(qnames), step)]
+            func = lambda chunk: self._query_chunk(chunk, rdtype)
+        else:
+            chunks = [[qname] for qname in qnames]
+            func = lambda chunk: [self._lookup_one(chunk[0], rdtype)]
+        workers = max(1, min(defaults['lookup_concurrency'], len(chunks)))
+        if workers > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(workers)
+            try:
+                results = pool.map(func, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [func(chunk) for chunk in chunks]
+        answers = {}
+        for chunk, result in zip(chunks, results):
+            answers.update(zip(chunk, result))
+        return answers
+
+    def _query_chunk(self, qnames, rdtype):
+        """
+        query_many for lookup_many, returning errors instead of raising.
+        """
+        try:
+            return self.query_many(qnames, rdtype)
+        except errors.PszDnsError, err:
+            return [err] * len(qnames)
+
+    def _lookup_one(self, qname, rdtype):
+        """
+        Looks up qname over UDP, falling back to TCP if the answer is
+        truncated. Returns the answer's rrset, () or a PszDnsError.
+        """
+        defaults = config.DEFAULTS
+        timeout = defaults['lookup_timeout']
+        query = dns.message.make_query(qname, rdtype, use_edns=0,
+                                       payload=4096)
+        err = None
+        for attempt in range(defaults['lookup_retries'] + 1):
+            try:
+                response = dns.query.udp(query, self.server, timeout=timeout)
+                if response.flags & dns.flags.TC:
+                    response = dns.query.tcp(query, self.server,
+                                             timeout=timeout)
+                return _answer_rrset(query, response)
+            except dns.exception.Timeout, err:
+                continue
+            except errors.PszDnsError, err:
+                return err
+            except Exception, err:
+                break
+        return errors.PszDnsError("lookup of %s %s via %s failed: %s" %
+            (qname, rdtype, self.server, err or 'timed out'))
+
+    def query_many(self, qnames, rdtype):
+        """
+        Looks up rdtype for each of qnames over pooled TCP connections to
+        the nameserver, pipelining dns_pool_pipeline queries at a time.
+
+        Returns a list of rrsets or () in the same order as qnames.
+        """
+        pool = connpool.get_pool()
+        rdtype = dns.rdatatype.from_text(rdtype)
+        step = config.DEFAULTS['dns_pool_pipeline']
+        answers = []
+        for i in range(0, len(qnames), step):
+            queries = []
+            for qname in qnames[i:i + step]:
+                query = dns.message.make_query(qname, rdtype)
+                query.flags |= dns.flags.RD
+                queries.append(query)
+            try:
+                responses = pool.exchange(self.server, queries)
+            except Exception, err:
+                raise errors.PszDnsError("lookup via %s failed: %s" %
+                    (self.server, err))
+            for query, response in zip(queries, responses):
+                answers.append(_answer_rrset(query, response))
+        return answers
+
     def update(self, updates, ttl=None):
         """
         Dynamically update the nameserver from a list/str of updates.
@@ -77,10 +317,70 @@ class Dns(object):
         except OSError, err:
             raise errors.PszDnsError('%s' % err)
         if process.returncode != 0:
-            if 'SERVFAIL' in stderr:
+            match = _NSUPDATE_RCODE_RE.search(stderr)
+            if match:
+                raise errors.update_error(match.group(1), stderr)
+            elif 'SERVFAIL' in stderr:
                 raise errors.PszDnsUpdateServfail(stderr)
             else:
-                raise errors.PszDnsError(stderr)
+                raise errors.PszDnsUpdateError(stderr)
+
+    def _native_update(self, zone, adds, deletes, ttl=None):
+        """
+        Sends a dynamic update of zone's DNSKEYs straight to the update
+        server. adds and deletes are lists of DNSKEY rdata.
+        """
+        defaults = config.DEFAULTS
+        if ttl is None:
+            ttl = defaults['update_ttl']
+        kwargs = {}
+        if defaults['update_use_tsig']:
+            keyring, keyname, algorithm = _read_tsig_key(
+                defaults['path_update_key'])
+            kwargs = dict(keyring=keyring, keyname=keyname,
+                          keyalgorithm=algorithm)
+        origin = dns.name.from_text(zone)
+        update = dns.update.Update(origin, **kwargs)
+        for rdata in deletes:
+            update.delete(origin, rdata)
+        for rdata in adds:
+            update.add(origin, ttl, rdata)
+        update_server = defaults['update_server']
+        if config.DEBUG:
+            log.log("dns update: %s" % update.to_text())
+        try:
+            if defaults['dns_pool']:
+                response = connpool.get_pool().query(update_server, update)
+            else:
+                response = dns.query.tcp(update, update_server,
+                                         timeout=defaults['update_timeout'])
+        except Exception, err:
+            mesg = "update of %s via %s failed: %s" % (zone, update_server,
+                err)
+            raise errors.PszDnsUpdateError(mesg)
+        rcode = dns.rcode.to_text(response.rcode())
+        if rcode != 'NOERROR':
+            mesg = "update of %s via %s failed: %s" % (zone, update_server,
+                rcode)
+            raise errors.update_error(rcode, mesg)
+
+    def update_dnskeys(self, zone, adds=(), deletes=()):
+        """
+        Adds and deletes DNSKEYs of zone in a single dynamic update.
+        adds and deletes are lists of Dnskey objects.
+        """
+        for key in list(adds) + list(deletes):
+            if key.dnsdata is None:
+                raise errors.PszDnsError("%s: no DNSKEY stored or on disk "
+                                         "for keyid=%s" % (zone, key.keytag))
+        if config.DEFAULTS['update_backend'] == 'native':
+            self._native_update(zone,
+                [_dnskey_rdata(key.dnsdata) for key in adds],
+                [_dnskey_rdata(key.dnsdata) for key in deletes])
+            return
+        updates = ['update delete %s' % key.dnsdata for key in deletes]
+        updates.extend('update add %s' % key.dnsdata for key in adds)
+        self.update(updates)
 
     def assert_count(self, qname, rdtype, expected_number):
         """
@@ -95,13 +395,203 @@ class Dns(object):
             mesg %= (expected_number, got_number)
             raise errors.PszDnsCountError(mesg)
 
+    def _convergence_servers(self, zone):
+        """
+        Returns the addresses of the servers that must agree on a zone's
+        DNSKEYs: the update server, our nameserver and, with
+        converge_check_ns on, the IPv4 and IPv6 addresses of the zone's
+        authoritative servers.
+        """
+        defaults = config.DEFAULTS
+        servers = [defaults['update_server']]
+        if self.server not in servers:
+            servers.append(self.server)
+        if not defaults['converge_check_ns']:
+            return servers
+        try:
+            nsnames = [str(rdata.target) for rdata in self.lookup(zone, 'NS')]
+        except Exception, err:
+            log.log("%s: can't look up NS: %s" % (zone, err))
+            return servers
+        for rdtype in ('A', 'AAAA'):
+            answers = self.lookup_many(nsnames, rdtype)
+            for nsname, answer in sorted(answers.items()):
+                if isinstance(answer, errors.PszDnsError):
+                    log.log("%s: can't look up %s %s: %s" % (zone, nsname,
+                                                            rdtype, answer))
+                    continue
+                for rdata in answer:
+                    if rdata.address not in servers:
+                        servers.append(rdata.address)
+        return servers
+
+    def _server_state(self, server, zone):
+        """
+        Returns a zone's SOA serial and set of DNSKEY keytags as seen by
+        server, or a PszDnsError.
+        """
+        nameserver = Dns(server)
+        soa = nameserver._lookup_one(zone, 'SOA')
+        if isinstance(soa, errors.PszDnsError):
+            return soa
+        if not soa:
+            return errors.PszDnsError("%s has no SOA for %s" % (server, zone))
+        dnskeys = nameserver._lookup_one(zone, 'DNSKEY')
+        if isinstance(dnskeys, errors.PszDnsError):
+            return dnskeys
+        return soa[0].serial, keytag_set(dnskeys)
+
+    def wait_for_dnskeys(self, zone, present=(), absent=(), count=None):
+        """
+        Waits until the DNSKEYs of zone include the keytags in present, don't
+        include those in absent and, if count is given, number count, on the
+        update server and on every server from _convergence_servers() whose
+        SOA serial has caught up with the update server's.
+
+        Servers are polled in parallel, with exponential backoff from
+        converge_initial_delay up to converge_max_delay seconds. Raises
+        PszDnsConvergenceError if they haven't converged after
+        converge_timeout seconds.
+        """
+        defaults = config.DEFAULTS
+        present = set(int(tag) for tag in present)
+        absent = set(int(tag) for tag in absent)
+        primary = defaults['update_server']
+        waiting = self._convergence_servers(zone)
+        deadline = time.time() + defaults['converge_timeout']
+        delay = defaults['converge_initial_delay']
+        target = None
+        problems = {}
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(len(waiting), defaults['lookup_concurrency']))
+        try:
+            while True:
+                states = pool.map(lambda s: self._server_state(s, zone),
+                                  waiting)
+                still_waiting = []
+                for server, state in zip(waiting, states):
+                    if isinstance(state, errors.PszDnsError):
+                        problems[server] = str(state)
+                        still_waiting.append(server)
+                        continue
+                    serial, keytags = state
+                    problem = _dnskey_problem(keytags, present, absent, count)
+                    if problem is None and server == primary:
+                        target = serial
+                    elif problem is None and target is None:
+                        problem = "waiting for %s" % primary
+                    elif problem is None and not _serial_gte(serial, target):
+                        problem = "serial %d is behind %d" % (serial, target)
+                    if problem is None:
+                        problems.pop(server, None)
+                    else:
+                        problems[server] = problem
+                        still_waiting.append(server)
+                waiting = still_waiting
+                if not waiting:
+                    return
+                if time.time() + delay > deadline:
+                    break
+                time.sleep(delay)
+                delay = min(delay * 2, defaults['converge_max_delay'])
+        finally:
+            pool.close()
+            pool.join()
+        raise errors.PszDnsConvergenceError(*["%s: %s: %s" %
+            (zone, server, problems[server]) for server in waiting])
+
+    def update_zones(self, blocks):
+        """
+        Sends the DNSKEY updates of several zones through one nsupdate
+        process, in one zone/send block per zone. blocks is a list of
+        (zone, adds, deletes) tuples where adds and deletes are lists of
+        Dnskey objects.
+        """
+        data = []
+        for zone, adds, deletes in blocks:
+            lines = ['zone %s' % zone]
+            lines.extend('update delete %s' % key.dnsdata for key in deletes)
+            lines.extend('update add %s' % key.dnsdata for key in adds)
+            data.append('\n'.join(lines))
+        self.update('\nsend\n'.join(data))
+
+    def add_dnskey(self, dnskey):
+        self.update_dnskeys(dnskey.zone, adds=[dnskey])
+
+    def delete_dnskey(self, dnskey):
+        self.update_dnskeys(dnskey.zone, deletes=[dnskey])
+
+
+class UpdateBatcher(object):
+    """
+    Collects DNSKEY adds and deletes for many zones and sends them with as
+    few nsupdate processes as possible, at most update_batch_size zones
+    per process.
+
+    nsupdate only reports that something in its input failed, not which
+    zone. A failed batch is split in half and each half sent again until
+    the zones at fault are found. That is safe because adding a record
+    that exists or deleting one that doesn't is a no-op.
+    """
+    def __init__(self, nameserver=None):
+        if nameserver is None:
+            nameserver = Dns()
+        self.nameserver = nameserver
+        self._zones = []
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._zones)
+
+    def _block(self, zone):
+        if zone not in self._pending:
+            self._zones.append(zone)
+            self._pending[zone] = ([], [])
+        return self._pending[zone]
+
     def add_dnskey(self, dnskey):
-        update = 'update add %s' % dnskey.dnsdata
-        self.update(update)
+        self._block(dnskey.zone)[0].append(dnskey)
 
     def delete_dnskey(self, dnskey):
-        update = 'update delete %s' % dnskey.dnsdata
-        self.update(update)
+        self._block(dnskey.zone)[1].append(dnskey)
+
+    def flush(self):
+        """
+        Sends all pending updates. Returns a dict of zone to None if the
+        zone's updates worked or to the PszDnsError it failed with.
+        """
+        blocks = [(zone,) + self._pending[zone] for zone in self._zones]
+        self._zones = []
+        self._pending = {}
+        results = {}
+        if config.DEFAULTS['update_backend'] == 'native':
+            for zone, adds, deletes in blocks:
+                try:
+                    self.nameserver.update_dnskeys(zone, adds, deletes)
+                except errors.PszDnsError, err:
+                    results[zone] = err
+                else:
+                    results[zone] = None
+            return results
+        size = max(1, config.DEFAULTS['update_batch_size'])
+        for i in range(0, len(blocks), size):
+            self._send(blocks[i:i + size], results)
+        return results
+
+    def _send(self, blocks, results):
+        try:
+            self.nameserver.update_zones(blocks)
+        except errors.PszDnsError, err:
+            if len(blocks) == 1:
+                results[blocks[0][0]] = err
+                return
+            middle = len(blocks) // 2
+            self._send(blocks[:middle], results)
+            self._send(blocks[middle:], results)
+            return
+        for block in blocks:
+            results[block[0]] = None
         
         
 def keytag(dnskey):
@@ -110,19 +600,83 @@ def keytag(dnskey):
     
     See rfc2535 section 4.1.6 for details.
     """
-    if dnskey.algorithm == 1:
-        a = ord(dnskey.key[-3]) << 8
-        b = ord(dnskey.key[-2])
+    return keytag_from_parts(dnskey.flags, dnskey.protocol, dnskey.algorithm,
+                             dnskey.key)
+
+def keytag_from_parts(flags, protocol, algorithm, key):
+    """
+    Compute the keytag of a DNSKEY from its rdata fields. key is the
+    public key as a string of bytes.
+    """
+    if algorithm == 1:
+        a = ord(key[-3]) << 8
+        b = ord(key[-2])
         return a + b
     else:
-        header = struct.pack("!HBB", dnskey.flags, dnskey.protocol,
-                                dnskey.algorithm)
-        key = header + dnskey.key
-        ac = 0
-        for i, value in enumerate(ord(x) for x in key):
-            if i % 2:
-                ac += value
-            else:
-                ac += (value << 8)
+        data = struct.pack("!HBB", flags, protocol, algorithm) + key
+        if len(data) % 2:
+            data += '\0'
+        # Sum the rdata as big-endian 16 bit words
+        words = array.array('H', data)
+        if _LITTLE_ENDIAN:
+            words.byteswap()
+        ac = sum(words)
         ac += (ac >> 16) & 0xffff
         return ac & 0xffff
+
+_LITTLE_ENDIAN = sys.byteorder == 'little'
+
+# Below this many keys NumPy's setup costs more than it saves
+_NUMPY_MIN_KEYS = 64
+
+def _flatten_dnskeys(dnskeys):
+    """
+    Returns a list of DNSKEY rdata from a DNSKEY rrset or a list of them.
+    """
+    rdatas = []
+    for item in dnskeys:
+        if hasattr(item, 'algorithm'):
+            rdatas.append(item)
+        else:
+            rdatas.extend(item)
+    return rdatas
+
+def _keytags_numpy(rdatas):
+    """
+    Computes keytags by summing the words of all the keys in one pass.
+    """
+    chunks = []
+    offsets = []
+    position = 0
+    for rdata in rdatas:
+        data = struct.pack("!HBB", rdata.flags, rdata.protocol,
+                           rdata.algorithm) + rdata.key
+        if len(data) % 2:
+            data += '\0'
+        chunks.append(data)
+        offsets.append(position)
+        position += len(data) // 2
+    words = numpy.frombuffer(''.join(chunks), dtype='>u2').astype(numpy.int64)
+    sums = numpy.add.reduceat(words, offsets)
+    tags = ((sums + ((sums >> 16) & 0xffff)) & 0xffff).tolist()
+    for i, rdata in enumerate(rdatas):
+        if rdata.algorithm == 1:
+            tags[i] = keytag(rdata)
+    return tags
+
+def keytags(dnskeys):
+    """
+    Returns the keytags of a DNSKEY rrset, or of a list of DNSKEY rrsets,
+    in order. Uses NumPy for large numbers of keys when it's available.
+    """
+    rdatas = _flatten_dnskeys(dnskeys)
+    if numpy is not None and len(rdatas) >= _NUMPY_MIN_KEYS:
+        return _keytags_numpy(rdatas)
+    return [keytag(rdata) for rdata in rdatas]
+
+def keytag_set(dnskeys):
+    """
+    Returns a frozenset of the keytags of a DNSKEY rrset, or of a list of
+    DNSKEY rrsets, for membership checks.
+    """
+    return frozenset(keytags(dnskeys))
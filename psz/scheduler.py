@@ -0,0 +1,320 @@
+"""
+Schedules key rollovers by policy.
+
+A zone's policy says how long its ZSK and KSK sign before they're rolled
+over. It also gives its largest TTL, which sets how long stage 2 of a
+rollover waits after stage 1. Zones without a ZonePolicy row use the
+defaults from the config file.
+
+    find_due - finds the rollover stages that are due, one per zone
+    release  - yields due stages in priority order within the rate limits
+    waiting_for_ds - finds the KSK stage 2s whose new KSK has no DS yet
+    one_per_zone   - picks each zone's first due stage that isn't held
+
+KSK stage 2 removes the old KSK, so it waits until the parent zone has a
+DS record for the new KSK, however long ago stage 1 was. The zone's other
+due stages run in the meantime. The DS records are looked up through
+ds_nameserver, which must be able to reach the parent zone.
+
+Stages that finish a rollover go first, then the longest overdue. Starts are
+limited by token buckets, one for all zones and one per nameserver, so the
+updates and zone transfers are spread out rather than sent in bursts.
+"""
+from config import DEFAULTS as defaults
+import errors
+
+import heapq
+import time
+from datetime import datetime, timedelta
+
+# (key type, key status, stage) in the order stages are run when a zone
+# has several due.
+STAGES = (
+    ('ZSK', 'rolled-stage1', 'rollover_zsk_stage2'),
+    ('KSK', 'rolled-stage1', 'rollover_ksk_stage2'),
+    ('ZSK', 'active', 'rollover_zsk_stage1'),
+    ('KSK', 'active', 'rollover_ksk_stage1'),
+)
+
+class Policy(object):
+    """
+    When a zone's keys are due to be rolled over.
+    """
+    def __init__(self, zsk_lifetime_days=None, ksk_lifetime_days=None,
+                 zone_max_ttl=None, enabled=True):
+        if zsk_lifetime_days is None:
+            zsk_lifetime_days = defaults['zsk_lifetime_days']
+        if ksk_lifetime_days is None:
+            ksk_lifetime_days = defaults['ksk_lifetime_days']
+        if zone_max_ttl is None:
+            zone_max_ttl = defaults['zone_max_ttl']
+        self.zsk_lifetime_days = int(zsk_lifetime_days)
+        self.ksk_lifetime_days = int(ksk_lifetime_days)
+        self.zone_max_ttl = int(zone_max_ttl)
+        self.enabled = enabled
+
+    def due_after(self, keytype, status):
+        """
+        Returns how long a key of keytype stays in status before the next
+        stage of its rollover is due.
+        """
+        if status == 'active':
+            if keytype == 'KSK':
+                return timedelta(days=self.ksk_lifetime_days)
+            return timedelta(days=self.zsk_lifetime_days)
+        # Stage 2 waits for caches to drop what stage 1 replaced: the old
+        # ZSK's signatures, or the old KSK's DNSKEY and DS records.
+        seconds = int(defaults['propagation_delay'])
+        if keytype == 'KSK':
+            seconds += int(defaults['update_ttl']) + int(defaults['ds_ttl'])
+        else:
+            seconds += self.zone_max_ttl
+        return timedelta(seconds=seconds)
+
+    def __repr__(self):
+        return "Policy(%d, %d, %d, %r)" % (self.zsk_lifetime_days,
+            self.ksk_lifetime_days, self.zone_max_ttl, self.enabled)
+
+
+def zone_policies():
+    """
+    Returns a dict of zone to the Policy of each zone with a ZonePolicy.
+    """
+    import models
+    policies = {}
+    rows = models.ZonePolicy.objects.values_list('zone', 'zsk_lifetime_days',
+        'ksk_lifetime_days', 'zone_max_ttl', 'enabled')
+    for row in rows.iterator():
+        policies[row[0]] = Policy(*row[1:])
+    return policies
+
+def find_due(now=None, policies=None, every=False):
+    """
+    Returns a list of (priority, zone, stage) for the zones with a rollover
+    stage due at now, at most one stage for each zone unless every is True.
+
+    The keys are found with one query, on the shortest wait of any policy,
+    and then checked against their own zone's policy.
+    """
+    from django.db.models import Q
+    import models
+    if now is None:
+        now = datetime.now()
+    if policies is None:
+        policies = zone_policies()
+    default = Policy()
+    enabled = [default] + [p for p in policies.values() if p.enabled]
+
+    where = None
+    for keytype, status, stage in STAGES:
+        wait = min(p.due_after(keytype, status) for p in enabled)
+        q = Q(type=keytype, status=status, updated__lte=now - wait)
+        if where is None:
+            where = q
+        else:
+            where = where | q
+    rows = models.Dnskey.objects.filter(where).values_list('zone', 'type',
+        'status', 'updated')
+
+    ranks = dict(((keytype, status), (rank, stage))
+                 for rank, (keytype, status, stage) in enumerate(STAGES))
+    due = []
+    for zone, keytype, status, updated in rows.iterator():
+        policy = policies.get(zone, default)
+        if not policy.enabled:
+            continue
+        overdue = now - updated - policy.due_after(keytype, status)
+        if overdue < timedelta(0):
+            continue
+        rank, stage = ranks[(keytype, status)]
+        overdue = overdue.days * 86400 + overdue.seconds
+        due.append(((rank, -overdue), zone, stage))
+    due.sort()
+    if every:
+        return due
+    return one_per_zone(due)
+
+def one_per_zone(tasks, held=()):
+    """
+    Returns the first of tasks, sorted (priority, zone, stage) tuples, for
+    each zone, passing over the (zone, stage) pairs in held.
+    """
+    picked = []
+    zones = set()
+    for task in tasks:
+        priority, zone, stage = task
+        if zone in zones or (zone, stage) in held:
+            continue
+        zones.add(zone)
+        picked.append(task)
+    return picked
+
+def _ds_nameserver():
+    """
+    Returns the address of the nameserver to look up DS records with:
+    ds_nameserver, or the first nameserver in /etc/resolv.conf.
+    """
+    server = defaults['ds_nameserver']
+    if server:
+        return server
+    import dns.resolver
+    try:
+        return dns.resolver.Resolver().nameservers[0]
+    except Exception, err:
+        raise errors.PszDnsError("no ds_nameserver and no resolver: %s" % err)
+
+def waiting_for_ds(tasks, dns=None):
+    """
+    Returns a dict of zone to why its KSK stage 2, if one of tasks, has to
+    wait: the parent zone has no DS record for the zone's active KSK yet,
+    or the DS records couldn't be looked up.
+    """
+    import delegation
+    import models
+    zones = [zone for priority, zone, stage in tasks
+             if stage == 'rollover_ksk_stage2']
+    if not zones:
+        return set()
+    if dns is None:
+        import named
+        try:
+            dns = named.Dns(_ds_nameserver())
+        except errors.PszDnsError, err:
+            return dict((zone, "DS lookup failed: %s" % err) for zone in zones)
+    keys = models.Dnskey.objects.filter(type='KSK', status='active')
+    keys = keys & models.Dnskey.objects.for_zones(zones)
+    rdatas = {}
+    for record in models.key_records(keys, rdata=True):
+        rdata = record.rdata
+        if not rdata:
+            try:
+                rdata = models.split_dnsdata(record.read_dnsdata() or '')[0]
+            except errors.PszError:
+                continue
+        rdatas.setdefault(record.zone, []).append(rdata)
+    waiting = {}
+    answers = dns.lookup_many(zones, 'DS')
+    for zone in zones:
+        answer = answers.get(zone)
+        if isinstance(answer, errors.PszDnsError):
+            waiting[zone] = "DS lookup failed: %s" % answer
+        elif not rdatas.get(zone):
+            waiting[zone] = "no DNSKEY for the active KSK"
+        elif not answer:
+            waiting[zone] = "no DS in parent yet"
+        else:
+            for rdata in rdatas[zone]:
+                if not delegation.in_ds_rrset(zone, rdata, answer):
+                    waiting[zone] = "no DS for the new KSK in parent yet"
+    return waiting
+
+
+class TokenBucket(object):
+    """
+    Allows rate events a second on average and up to burst at once.
+    A rate of 0 or less is unlimited.
+    """
+    def __init__(self, rate, burst, now):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.stamp = now
+
+    def _refill(self, now):
+        if now > self.stamp:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+
+    def wait_time(self, now):
+        """
+        Returns the seconds until an event is allowed.
+        """
+        if self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        if self.rate > 0:
+            self._refill(now)
+            self.tokens -= 1
+
+
+class RateLimiter(object):
+    """
+    A TokenBucket for all events and one for each server.
+    """
+    def __init__(self, rate, per_server_rate, burst, now):
+        self.per_server_rate = per_server_rate
+        self.burst = burst
+        self.total = TokenBucket(rate, burst, now)
+        self.servers = {}
+
+    def _buckets(self, servers, now):
+        buckets = [self.total]
+        for server in servers:
+            if server not in self.servers:
+                self.servers[server] = TokenBucket(self.per_server_rate,
+                                                   self.burst, now)
+            buckets.append(self.servers[server])
+        return buckets
+
+    def wait_time(self, servers, now):
+        """
+        Returns the seconds until an event for all of servers is allowed.
+        """
+        return max(b.wait_time(now) for b in self._buckets(servers, now))
+
+    def take(self, servers, now):
+        for bucket in self._buckets(servers, now):
+            bucket.take(now)
+
+
+def nameservers(zones):
+    """
+    Returns a dict of zone to the names of its nameservers, or the update
+    server if they can't be found.
+    """
+    import named
+    fallback = (defaults['update_server'],)
+    servers = {}
+    for zone, answer in named.Dns().lookup_many(zones, 'NS').items():
+        if isinstance(answer, errors.PszDnsError):
+            servers[zone] = fallback
+            continue
+        names = set(str(rdata.target).lower() for rdata in answer)
+        servers[zone] = tuple(sorted(names)) or fallback
+    return servers
+
+def release(tasks, servers, limiter, clock=time.time, sleep=time.sleep):
+    """
+    Yields tasks, (priority, zone, stage) tuples, in priority order as the
+    limiter allows. A task waiting on a busy nameserver doesn't hold up
+    tasks of other nameservers.
+    """
+    queue = list(tasks)
+    heapq.heapify(queue)
+    while queue:
+        now = clock()
+        waiting = []
+        task = None
+        wait = None
+        while queue:
+            candidate = heapq.heappop(queue)
+            delay = limiter.wait_time(servers.get(candidate[1], ()), now)
+            if delay <= 0:
+                task = candidate
+                break
+            waiting.append(candidate)
+            if wait is None or delay < wait:
+                wait = delay
+        for candidate in waiting:
+            heapq.heappush(queue, candidate)
+        if task is None:
+            sleep(wait)
+            continue
+        limiter.take(servers.get(task[1], ()), now)
+        yield task
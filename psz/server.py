@@ -0,0 +1,269 @@
+"""
+A psz daemon that runs commands sent to it over a Unix socket.
+
+Every psz command pays for importing Django and dnspython and reading the
+config file before it does any work. 'psz serve' does all that once and then
+forks a child for each command it's sent, so the child starts warm. The child
+runs the command just as bin/psz would and sends its stdout, stderr and exit
+code back to the client.
+
+    serve - runs the daemon
+    call  - sends a command to the daemon, used by cli.main when PSZ_SOCKET
+            is set
+
+Children inherit the daemon's Django settings, so the daemon must be
+restarted after changing the database settings. Other settings are read
+again by each command when the config file changes.
+
+Messages both ways are frames of a one byte kind, a four byte length and
+the data.
+"""
+import config
+
+import json
+import os
+import socket
+import struct
+import sys
+
+# Frame kinds
+REQUEST = 'R'
+STDOUT = 'O'
+STDERR = 'E'
+EXIT = 'X'
+
+# Commands the daemon will run
+SERVED_COMMANDS = frozenset([
+    'status', 'key_status', 'ds',
+    'secure', 'securezone',
+    'retry', 'retrysecure', 'retrysecurezone',
+    'unsign', 'unsecure',
+    'roll_zsk_stage1', 'rollover_zsk_stage1',
+    'roll_zsk_stage2', 'rollover_zsk_stage2',
+    'roll_ksk_stage1', 'rollover_ksk_stage1',
+    'roll_ksk_stage2', 'rollover_ksk_stage2',
+])
+
+_HEADER = struct.Struct('!cI')
+
+def _send_frame(sock, kind, data):
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    sock.sendall(_HEADER.pack(kind, len(data)) + data)
+
+def _recv_exactly(sock, count):
+    data = []
+    while count:
+        chunk = sock.recv(count)
+        if not chunk:
+            raise EOFError("psz daemon closed the connection")
+        data.append(chunk)
+        count -= len(chunk)
+    return ''.join(data)
+
+def _recv_frame(sock):
+    kind, size = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))
+    return kind, _recv_exactly(sock, size)
+
+
+class _FrameWriter(object):
+    """
+    A file-like object that sends what's written to it to the client as
+    frames of one kind.
+    """
+    def __init__(self, sock, kind):
+        self.sock = sock
+        self.kind = kind
+        self.softspace = 0
+
+    def write(self, data):
+        if data:
+            _send_frame(self.sock, self.kind, data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def _exit_code(err):
+    """
+    Returns the exit code a process would have for SystemExit err.
+    """
+    if err.code is None:
+        return 0
+    if isinstance(err.code, int):
+        return err.code
+    sys.stderr.write('%s\n' % err.code)
+    return 1
+
+def _run_request(request):
+    """
+    Runs the command in request, with sys.stdout and sys.stderr already
+    sent to the client. Returns the exit code.
+    """
+    import log
+    try:
+        return _run_command(request)
+    finally:
+        # The child leaves through os._exit, which skips the atexit flush
+        # of log_async's queue.
+        log.flush()
+
+def _run_command(request):
+    import errors
+    import log
+    import tools
+
+    argv = [arg.encode('utf-8') for arg in request['argv']]
+    if not argv or argv[0] not in SERVED_COMMANDS:
+        sys.stderr.write("psz serve can't run %s\n" % ' '.join(argv))
+        return 1
+    try:
+        os.chdir(request['cwd'])
+    except (KeyError, OSError), err:
+        sys.stderr.write("%s\n" % err)
+        return 1
+    if request.get('user'):
+        config.USER = request['user'].encode('utf-8')
+    import StringIO
+    sys.stdin = StringIO.StringIO((request.get('stdin') or '').encode('utf-8'))
+    sys.argv = argv
+    try:
+        try:
+            return getattr(tools, argv[0])() or 0
+        except errors.PszConfigError, err:
+            log.error(err)
+    except SystemExit, err:
+        return _exit_code(err)
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        return 1
+
+
+def _make_server(path, max_children):
+    import SocketServer
+    import signal
+
+    class Handler(SocketServer.BaseRequestHandler):
+        def handle(self):
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            sock = self.request
+            try:
+                kind, data = _recv_frame(sock)
+            except EOFError:
+                # serve() checking whether we're running
+                return
+            if kind != REQUEST:
+                return
+            sys.stdout = _FrameWriter(sock, STDOUT)
+            sys.stderr = _FrameWriter(sock, STDERR)
+            rc = _run_request(json.loads(data))
+            _send_frame(sock, EXIT, str(rc))
+
+    class Server(SocketServer.ForkingMixIn, SocketServer.UnixStreamServer):
+        pass
+
+    Server.max_children = max_children
+    # Only our user may connect.
+    umask = os.umask(077)
+    try:
+        return Server(path, Handler)
+    finally:
+        os.umask(umask)
+
+def _warm_up(opts):
+    """
+    Imports and loads what every command needs so children don't have to.
+    """
+    import tools
+    import models
+    import named
+    import dns.resolver
+    import dns.update
+    import dns.query
+    if opts['update_backend'] == 'native' and opts['update_use_tsig']:
+        named._read_tsig_key(opts['path_update_key'])
+
+def serve():
+    """
+    Runs the psz daemon until it's sent SIGTERM or interrupted.
+    """
+    import cli
+    import log
+    import signal
+
+    opts, args = cli.serve_parse_args()
+    path = opts['path_socket']
+    if os.path.exists(path):
+        if call(path, None) is not None:
+            log.error("psz serve is already running on %s" % path)
+        os.unlink(path)
+    _warm_up(opts)
+    server = _make_server(path, opts['serve_max_children'])
+
+    def _stop(signum, frame):
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, _stop)
+
+    log.log("psz serve listening on %s" % path)
+    try:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    finally:
+        server.server_close()
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+    log.log("psz serve on %s stopped" % path)
+    return 0
+
+def call(path, argv):
+    """
+    Runs the command argv (command name first) in the daemon listening on
+    path, copying its output to our stdout and stderr. Returns the
+    command's exit code, or None if no daemon is listening.
+
+    With argv None, only checks that the daemon is listening.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except socket.error:
+            return None
+        if argv is None:
+            return 0
+        stdin = None
+        if '-' in argv:
+            # Zones are read from stdin with "-f -"
+            stdin = sys.stdin.read()
+        request = {
+            'argv': argv,
+            'cwd': os.getcwd(),
+            'user': config.USER,
+            'stdin': stdin,
+        }
+        _send_frame(sock, REQUEST, json.dumps(request))
+        streams = {STDOUT: sys.stdout, STDERR: sys.stderr}
+        try:
+            while True:
+                kind, data = _recv_frame(sock)
+                if kind == EXIT:
+                    return int(data)
+                streams[kind].write(data)
+                streams[kind].flush()
+        except (EOFError, socket.error), err:
+            sys.stderr.write("%s\n" % err)
+            return 1
+    finally:
+        sock.close()
@@ -5,22 +5,29 @@ and key rollovers.
 Most are invoked from the cli module's main() method via command line tools.
 """
 
+import batch
 import cli
+import keygen
 from config import USAGE_ZONE, DEFAULTS as defaults
 import log
 import named
 import errors
 
-import os
+import csv
 import datetime
+import itertools
+import json
+import operator
+import os
+import sys
+import time
 
 def _cleanup(keys):
     """
     Delete a list of keys.
     """
-    for key in keys:
-        key.unlink()
-        key.save()
+    models.transition([(key, 'deleted') for key in keys
+                       if key.unlink(save=False)])
 
 def _fix_zone(zone):
     """
@@ -50,15 +57,27 @@ def _check_permissions(zone):
     if not os.access(oldkeydir, os.W_OK):
         failures.append("path_oldkeydir '%s' is not writable" % oldkeydir)
 
-    # Check that keygen command is executable
-    keygen = defaults['path_keygen']
-    if not os.access(keygen, os.X_OK):
-        failures.append("path_keygen '%s' is not executable" % keygen)
-
-    # Check that nsupdate command is executable
-    nsupdate = defaults['path_nsupdate']
-    if not os.access(nsupdate, os.X_OK):
-        failures.append("path_nsupdate '%s' is not executable" % nsupdate)
+    # Check that we can make keys
+    backend = defaults['keygen_backend']
+    if backend not in keygen.KEYGEN_BACKENDS:
+        failures.append("keygen_backend '%s' is unknown" % backend)
+    elif backend == 'native':
+        if not keygen.have_cryptography():
+            failures.append("keygen_backend 'native' needs cryptography")
+    else:
+        keygen_path = defaults['path_keygen']
+        if not os.access(keygen_path, os.X_OK):
+            failures.append("path_keygen '%s' is not executable" %
+                            keygen_path)
+
+    # Check that we can send updates
+    backend = defaults['update_backend']
+    if backend not in named.UPDATE_BACKENDS:
+        failures.append("update_backend '%s' is unknown" % backend)
+    elif backend == 'nsupdate':
+        nsupdate = defaults['path_nsupdate']
+        if not os.access(nsupdate, os.X_OK):
+            failures.append("path_nsupdate '%s' is not executable" % nsupdate)
 
     if defaults['update_use_tsig']:
         # Check that required TSIG key file is readable 
@@ -80,36 +99,69 @@ def _check_permissions(zone):
     if failures:
         raise errors.PszConfigError(*failures)
 
+def _read_zones(opts, args):
+    """
+    Returns the zones named on the command line and in the -f zone file.
+    """
+    zones = list(args)
+    zonefile = opts.get('zonefile')
+    if zonefile:
+        if zonefile == '-':
+            fp = sys.stdin
+        else:
+            try:
+                fp = open(zonefile)
+            except IOError, err:
+                log.error("Error reading %s: %s" % (zonefile, err))
+        for line in fp:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                zones.append(line)
+    seen = set()
+    result = []
+    for zone in zones:
+        zone = _fix_zone(zone)
+        if zone not in seen:
+            seen.add(zone)
+            result.append(zone)
+    return result
+
 def _setup_tools():
     """
     Common setup for various tools.
     """
     opts, args = cli.parse_args()
-    try:
-        zone = _fix_zone(args[0])
-    except IndexError:
+    zones = _read_zones(opts, args)
+    if not zones:
         log.error(USAGE_ZONE)
-    _check_permissions(zone)
 
     # We have to wait until Django is configured to import our models
     import models
     globals()['models'] = models
-    return opts, zone
+    return opts, zones
+
+def _run_tool(tool):
+    """
+    Runs the per zone function tool for each zone given on the command line.
+
+    A single zone is handled in this process the way it always has been.
+    Several zones are run as a batch which reports on every zone.
+    """
+    opts, zones = _setup_tools()
+    if len(zones) == 1 and not opts.get('zonefile'):
+        return tool(zones[0])
+    return batch.run(tool, zones, opts['batch_workers'], opts['batch_pool'])
 
 def _add_keys_to_dns(keys, zone, nameserver):
     """
     Adds a set of keys to the DNS.
     """
-    update = 'update add %s'
-    updates = []
-    for key in keys: 
-        updates.append(update % key.dnsdata)
+    fields = {'zone': zone, 'stage': 'securezone'}
     try:
-        nameserver.update(updates)
+        nameserver.update_dnskeys(zone, adds=keys)
     except errors.PszDnsError, err:
-        log.error("Dns update error: (%s)" % err)
-    expected_num_keys = len(keys)
-    nameserver.assert_count(zone, 'DNSKEY', expected_num_keys)
+        log.error("Dns update error: (%s)" % err, **fields)
+    nameserver.wait_for_dnskeys(zone, present=[key.keytag for key in keys])
 
 def securezone():
     """
@@ -118,43 +170,48 @@ def securezone():
     create ksk, zsk1 in keydir and zsk2 in newkeydir
     publish all three dnskey records.
     """
-    opts, zone = _setup_tools()
+    return _run_tool(_securezone)
+
+def _securezone(zone):
+    """
+    Secures a single zone.
+    """
+    fields = {'zone': zone, 'stage': 'securezone'}
+    _check_permissions(zone)
     Dnskey = models.Dnskey 
     keys = Dnskey.objects.get_zone_keys(zone) 
     if keys.count():
-        _show_zone_keystatus(zone, verbose=False)
+        _show_zone_keystatus([zone], verbose=False)
         log.error("\n%s already has the above keys." % zone,
-            "psz retrysecurezone might work for this zone.")
+            "psz retrysecurezone might work for this zone.", **fields)
 
     nameserver = named.Dns()
     dnskey_rrset = nameserver.lookup(zone, 'DNSKEY')
     if dnskey_rrset:
         num_keys = len(dnskey_rrset)
-        log.error("The zone %s already has %d DNSKEYs" % (zone, num_keys))
+        log.error("The zone %s already has %d DNSKEYs" % (zone, num_keys),
+                  **fields)
 
     newkeydir = defaults['path_newkeydir']
     key_dir = os.path.join(defaults['path_zonedir'], zone, newkeydir)
-    try:
-        os.chdir(key_dir)
-    except OSError, err:
-        log.error("chdir failed: %s" % err) 
 
+    # The keys are saved together once they are all in place
     keys_made = []
     try:
-        zsk2 = Dnskey.from_dnssec_keygen(zone)
+        zsk2 = Dnskey.generate(zone, directory=key_dir)
     except errors.PszKeygenError, err:
-        log.error("keygen failed making ZSK2 for zone %s. %s" % (zone, err))
-    zsk2.save()
+        log.error("keygen failed making ZSK2 for zone %s. %s" % (zone, err),
+                  **fields)
     keys_made.append(zsk2)
 
     zonedir = os.path.join(defaults['path_zonedir'], zone)
     try:
-        zsk1 = Dnskey.from_dnssec_keygen(zone)
+        zsk1 = Dnskey.generate(zone, directory=key_dir)
     except errors.PszKeygenError, err:
         _cleanup(keys_made)
         mesg = "keygen failed making ZSK1 for zone %s. %s" % (zone, err)
-        log.error(mesg)
-    zsk1.update('pre-active')
+        log.error(mesg, **fields)
+    zsk1.status = 'pre-active'
     keys_made.append(zsk1)
 
     try:
@@ -162,37 +219,46 @@ def securezone():
     except errors.PszError, err:
         _cleanup(keys_made)
         mesg = "Failed to move ZSK1: %s." % err
-        log.error(mesg)
+        log.error(mesg, **fields)
 
     try:
-        ksk = Dnskey.from_dnssec_keygen(zone, keytype='KSK')
+        ksk = Dnskey.generate(zone, keytype='KSK', directory=key_dir)
     except errors.PszKeygenError, err:
         _cleanup(keys_made)
-        log.error("keygen failed making KSK for zone %s. %s" % (zone, err))
-    ksk.update('pre-active')
+        log.error("keygen failed making KSK for zone %s. %s" % (zone, err),
+                  **fields)
+    ksk.status = 'pre-active'
     keys_made.append(ksk)
 
     try:
         ksk.move(zonedir)
     except errors.PszError, err:
         _cleanup(keys_made)
-        log.error("Failed to move KSK: %s" % err)
+        log.error("Failed to move KSK: %s" % err, **fields)
 
+    models.transition([(key, key.status) for key in keys_made])
     return _common_securezone(keys_made, zone, nameserver)
 
 def retrysecurezone():
     """
     Attempts to sign a zone if keys already exist. 
     """
-    opts, zone = _setup_tools()
+    return _run_tool(_retrysecurezone)
+
+def _retrysecurezone(zone):
+    """
+    Retries securing a single zone.
+    """
+    fields = {'zone': zone, 'stage': 'retrysecurezone'}
+    _check_permissions(zone)
     Dnskey = models.Dnskey 
     nameserver = named.Dns()
     dnskey_rrset = nameserver.lookup(zone, 'DNSKEY')
-    keytags = [named.keytag(dnskey) for dnskey in dnskey_rrset]
+    keytags = named.keytag_set(dnskey_rrset)
     keys = Dnskey.objects.get_zone_keys(zone)
     num_keys = len(keys)
     if num_keys != 3:
-        log.error("wrong number of keys.")
+        log.error("wrong number of keys.", **fields)
     num_pre = num_zsk = num_ksk = 0
     for key in keys:
         if key.status == 'pre-active':
@@ -204,17 +270,19 @@ def retrysecurezone():
     if num_pre != 2:
         mesg = "wrong number of 'pre-active' keys. Need two, got %d"
         mesg %= num_pre
-        log.error(mesg)
+        log.error(mesg, **fields)
     if num_ksk != 1:
-        log.error("wrong number of KSK keys. Need one, got %d." % num_ksk)
+        log.error("wrong number of KSK keys. Need one, got %d." % num_ksk,
+                  **fields)
     if num_zsk != 2:
-        log.error("wrong number of ZSK keys. Need two, got %d" % num_zsk)
+        log.error("wrong number of ZSK keys. Need two, got %d" % num_zsk,
+                  **fields)
     keys_to_add = []
     for key in keys:
         if not int(key.keytag) in keytags:
             keys_to_add.append(key)
     if not keys_to_add:
-        log.error("All the keys are in the DNS already.")
+        log.error("All the keys are in the DNS already.", **fields)
 
     return _common_securezone(keys_to_add, zone, nameserver)
 
@@ -223,53 +291,120 @@ def _common_securezone(keys, zone, nameserver):
     Operational steps that both securezone and retrysecurezone
     have in common.
     """
+    fields = {'zone': zone, 'stage': 'securezone'}
     rs = "\nUse 'retrysecure' command to try again with existing keys."
     try:
         _add_keys_to_dns(keys, zone, nameserver)
     except errors.PszDnsError, err:
-        log.error("Dns update error: (%s)" % err, rs)
+        log.error("Dns update error: (%s)" % err, rs, **fields)
     except errors.PszDnsCountError, err:
-        log.error(err, rs)
+        log.error(err, rs, **fields)
     
+    changes = []
     for key in keys:
         if key.status == 'pre-active':
-            key.update('active')
+            changes.append((key, 'active'))
         else:
-            key.update('published')
+            changes.append((key, 'published'))
 
     mesg = "%s secured." % zone
     print mesg 
-    models.LogMessage(zone=zone, message=mesg).save()
-    log.log(mesg)
+    models.transition(changes, [(zone, mesg)])
+    log.log(mesg, **fields)
     return 0
 
 def unsign():
     """
     Deletes a zone's DNSKEYs from the DNS and deletes the on disk keys.
+
+    Many zones are unsigned with a few nsupdate runs between them, unless
+    -j asks for a pool of workers.
     """
-    opts, zone = _setup_tools()
+    opts, zones = _setup_tools()
+    if len(zones) == 1 and not opts.get('zonefile'):
+        return _unsign(zones[0])
+    if opts['batch_workers'] > 1:
+        return batch.run(_unsign, zones, opts['batch_workers'],
+                         opts['batch_pool'])
+    return _unsign_coalesced(zones)
+
+def _unsign_coalesced(zones):
+    """
+    Unsigns many zones, sending their DNSKEY deletes through an
+    UpdateBatcher.
+    """
+    Dnskey = models.Dnskey
+    results = {}
+    zone_keys = {}
+    batcher = named.UpdateBatcher()
+    for zone in zones:
+        try:
+            _check_permissions(zone)
+        except errors.PszConfigError, err:
+            results[zone] = (1, str(err))
+            continue
+        keys = list(Dnskey.objects.get_zone_keys(zone))
+        zone_keys[zone] = keys
+        for key in keys:
+            batcher.delete_dnskey(key)
+
+    for zone, err in batcher.flush().items():
+        if err is not None:
+            results[zone] = (1, "Dns update error: (%s)" % err)
+
+    for zone in zones:
+        if zone in results:
+            continue
+        changes = []
+        for key in zone_keys[zone]:
+            if key.unlink(save=False):
+                changes.append((key, 'deleted'))
+            print "Deleted %s" % key
+        mesg = "%s has been unsigned." % zone
+        print mesg
+        models.transition(changes, [(zone, mesg)])
+        log.log(mesg, zone=zone, stage='unsign')
+        results[zone] = (0, '')
+    return batch.summarize('unsign', zones, results)
+
+def _unsign(zone):
+    """
+    Unsigns a single zone.
+    """
+    fields = {'zone': zone, 'stage': 'unsign'}
+    _check_permissions(zone)
     Dnskey = models.Dnskey 
     keys = Dnskey.objects.get_zone_keys(zone) 
     nameserver = named.Dns()
 
     retry_keys = []
-    for key in keys:
-        try:
-            nameserver.delete_dnskey(key)
-        except errors.PszDnsUpdateServfail:
-            retry_keys.append(key)
-            continue
-        key.unlink()
-        print "Deleted %s" % key
+    changes = []
+    try:
+        for key in keys:
+            try:
+                nameserver.delete_dnskey(key)
+            except errors.PszDnsUpdateServfail:
+                retry_keys.append(key)
+                continue
+            if key.unlink(save=False):
+                changes.append((key, 'deleted'))
+            print "Deleted %s" % key
 
-    for key in retry_keys:
-        nameserver.delete_dnskey(key)
-        key.unlink()
-        print "Deleted %s" % key
+        for key in retry_keys:
+            nameserver.delete_dnskey(key)
+            if key.unlink(save=False):
+                changes.append((key, 'deleted'))
+            print "Deleted %s" % key
+    except:
+        # Record the keys that are gone before giving up
+        models.transition(changes)
+        raise
 
     mesg = "%s has been unsigned." % zone
     print mesg 
-    models.LogMessage(zone=zone, message=mesg).save()
+    models.transition(changes, [(zone, mesg)])
+    log.log(mesg, **fields)
+    return 0
 
 def rollover_zsk_stage1():
     """
@@ -280,33 +415,45 @@ def rollover_zsk_stage1():
 
     Does not change contents of the zone in the DNS.
     """
-    opts, zone = _setup_tools()
+    return _run_tool(_rollover_zsk_stage1)
+
+def _rollover_zsk_stage1(zone):
+    """
+    Stage 1 ZSK rollover of a single zone.
+    """
+    fields = {'zone': zone, 'stage': 'rollover_zsk_stage1'}
+    _check_permissions(zone)
     Dnskey = models.Dnskey 
 
     zone_dir = os.path.join(defaults['path_zonedir'], zone)
     oldkey_dir = os.path.join(zone_dir, defaults['path_oldkeydir'])
 
     try:
-        newkey = Dnskey.objects.get(zone=zone, status='published', type='ZSK')
-    except Dnskey.DoesNotExist, Dnskey.MultipleObjectsReturned:
-        log.error("Unable to determine the published ZSK for %s" % zone)
+        newkey = Dnskey.objects.get_zone_key(zone, 'published', 'ZSK')
+    except (Dnskey.DoesNotExist, Dnskey.MultipleObjectsReturned):
+        log.error("Unable to determine the published ZSK for %s" % zone,
+                  **fields)
 
     try:
-        oldkey = Dnskey.objects.get(zone=zone, status='active', type='ZSK')
-    except Dnskey.DoesNotExist, Dnskey.MultipleObjectsReturned:
-        log.error("Unable to determine the active ZSK for %s" % zone)
+        oldkey = Dnskey.objects.get_zone_key(zone, 'active', 'ZSK')
+    except (Dnskey.DoesNotExist, Dnskey.MultipleObjectsReturned):
+        log.error("Unable to determine the active ZSK for %s" % zone, **fields)
 
     try:
         oldkey.move(oldkey_dir)
     except errors.PszError, err:
-        log.error("Failed moving ZSK (keyid=%s): %s." % (oldkey.keytag, err))
-    oldkey.update('rolled-stage1')
+        log.error("Failed moving ZSK (keyid=%s): %s." % (oldkey.keytag, err),
+                  **fields)
+    changes = [(oldkey, 'rolled-stage1')]
 
     try:
         newkey.move(zone_dir)
     except errors.PszError, err:
-        log.error("Failed moving ZSK (keyid=%s): %s." % (newkey.keytag, err))
-    newkey.update('active')
+        models.transition(changes)
+        log.error("Failed moving ZSK (keyid=%s): %s." % (newkey.keytag, err),
+                  **fields)
+    changes.append((newkey, 'active'))
+    models.transition(changes, [(zone, "did stage 1 ZSK rollover")])
 
     s = "keyid=%s is still published but no longer signing RRsets."
     s %= oldkey.keytag
@@ -316,9 +463,8 @@ def rollover_zsk_stage1():
         s, 
     ]
     for emit in emits:
-        log.log(emit)
+        log.log(emit, **fields)
         print emit
-    models.LogMessage(zone=zone, message="did stage 1 ZSK rollover").save()
     return 0
 
 def rollover_zsk_stage2():
@@ -328,71 +474,72 @@ def rollover_zsk_stage2():
     Deletes the old ZSK from the DNS.
     Creates a new ZSK and adds it to the DNS.
     """
-    opts, zone = _setup_tools() 
+    return _run_tool(_rollover_zsk_stage2)
+
+def _rollover_zsk_stage2(zone):
+    """
+    Stage 2 ZSK rollover of a single zone.
+    """
+    fields = {'zone': zone, 'stage': 'rollover_zsk_stage2'}
+    _check_permissions(zone)
     Dnskey = models.Dnskey 
 
     nameserver = named.Dns()
     dnskey_rrset = nameserver.lookup(zone, 'DNSKEY')
     prev_num_dnskeys = len(dnskey_rrset)
     if not prev_num_dnskeys:
-        log.error("There are no DNSKEYs in the DNS for %s" % zone)
+        log.error("There are no DNSKEYs in the DNS for %s" % zone, **fields)
 
     try:
-        oldzsk = Dnskey.objects.get(zone=zone, status='rolled-stage1',
-                                    type='ZSK')
-    except Dnskey.DoesNotExist, Dnskey.MultipleObjectsReturned:
-        log.error("Unable to determine old ZSK for %s" % zone)
+        oldzsk = Dnskey.objects.get_zone_key(zone, 'rolled-stage1', 'ZSK')
+    except (Dnskey.DoesNotExist, Dnskey.MultipleObjectsReturned):
+        log.error("Unable to determine old ZSK for %s" % zone, **fields)
 
-    newkeydir = opts['path_newkeydir']
-    key_dir = os.path.join(opts['path_zonedir'], zone, newkeydir)
-    try:
-        os.chdir(key_dir)
-    except OSError, err:
-        log.error("chdir failed: %s" % err) 
+    newkeydir = defaults['path_newkeydir']
+    key_dir = os.path.join(defaults['path_zonedir'], zone, newkeydir)
 
     try:
-        newzsk = Dnskey.from_dnssec_keygen(zone)
+        newzsk = Dnskey.generate(zone, directory=key_dir)
     except errors.PszKeygenError, err:
-        log.error("keygen failed making ZSK for zone %s. %s" % (zone, err))
+        log.error("keygen failed making ZSK for zone %s. %s" % (zone, err),
+                  **fields)
     newzsk.save()
 
     try:
         nameserver.delete_dnskey(oldzsk)
     except errors.PszDnsError, err:
-        # xxx retry
-        newzsk.unlink()
-        newzsk.save()
+        _cleanup([newzsk])
         msg = "named.update failed to delete old ZSK, keyid=%s"
         msg %= oldzsk.keytag
-        log.error(msg)
+        log.error(msg, **fields)
 
-    dnskey_rrset = nameserver.lookup(zone, 'DNSKEY')
     expected_num_dnskeys = prev_num_dnskeys - 1
-    num_dnskeys = len(dnskey_rrset)
-    if num_dnskeys != expected_num_dnskeys:
-        # xxx retry
-        msg = "Got %d DNSKEYs, expected %d after deleting keyid=%s"
-        log.error(msg % (num_dnskeys, expected_num_dnskeys, oldzsk.keytag))
+    try:
+        nameserver.wait_for_dnskeys(zone, absent=[oldzsk.keytag],
+                                    count=expected_num_dnskeys)
+    except errors.PszDnsCountError, err:
+        msg = "DNSKEYs didn't converge after deleting keyid=%s" % oldzsk.keytag
+        log.error(msg, err, **fields)
 
-    oldzsk.update('expired')
+    changes = [(oldzsk, 'expired')]
 
     try:
         nameserver.add_dnskey(newzsk)
     except errors.PszDnsError, err:
-        # XXX retry
+        models.transition(changes)
         msg = "DNS update failed to add new ZSK, keyid=%s" % newzsk.keytag
-        log.error(msg)
+        log.error(msg, **fields)
     
-    expected_num_dnskeys = num_dnskeys 
-    dnskey_rrset = nameserver.lookup(zone, 'DNSKEY')
-    num_dnskeys = len(dnskey_rrset)
-    if num_dnskeys != expected_num_dnskeys + 1:
-        # XXX retry
-        msg = "Got %d DNSKEYs, expected %d after adding keyid=%s"
-        msg %= (num_dnskeys, expected_num_dnskeys, newzsk.keytag)
-        log.error(msg)
+    try:
+        nameserver.wait_for_dnskeys(zone, present=[newzsk.keytag],
+                                    count=expected_num_dnskeys + 1)
+    except errors.PszDnsCountError, err:
+        models.transition(changes)
+        msg = "DNSKEYs didn't converge after adding keyid=%s" % newzsk.keytag
+        log.error(msg, err, **fields)
 
-    newzsk.update('published')
+    changes.append((newzsk, 'published'))
+    models.transition(changes, [(zone, "did stage 2 ZSK rollover")])
 
     emits = [
         "%s rollover_zsk_stage2 complete." % zone, 
@@ -400,9 +547,8 @@ def rollover_zsk_stage2():
         "keyid=%s removed from the DNS and expired." % oldzsk.keytag,
     ]
     for emit in emits:
-        log.log(emit)
+        log.log(emit, **fields)
         print emit
-    models.LogMessage(zone=zone, message="did stage 2 ZSK rollover").save()
     return 0
 
 def rollover_ksk_stage1():
@@ -412,57 +558,58 @@ def rollover_ksk_stage1():
     Makes a new active KSK for the zone.
     Adds the new KSK to the DNS.
     """
-    opts, zone = _setup_tools() 
+    return _run_tool(_rollover_ksk_stage1)
+
+def _rollover_ksk_stage1(zone):
+    """
+    Stage 1 KSK rollover of a single zone.
+    """
+    fields = {'zone': zone, 'stage': 'rollover_ksk_stage1'}
+    _check_permissions(zone)
     Dnskey = models.Dnskey 
 
     nameserver = named.Dns()
     dnskey_rrset = nameserver.lookup(zone, 'DNSKEY')
     prev_num_dnskeys = len(dnskey_rrset)
     if not prev_num_dnskeys:
-        log.error("There are no DNSKEYs for %s" % zone)
+        log.error("There are no DNSKEYs for %s" % zone, **fields)
 
     try:
-        oldksk = Dnskey.objects.get(zone=zone, type='KSK', status='active')
-    except Dnskey.DoesNotExist, Dnskey.MultipleObjectsReturned:
-        log.error("Unable to determine old KSK for %s" % zone)
+        oldksk = Dnskey.objects.get_zone_key(zone, 'active', 'KSK')
+    except (Dnskey.DoesNotExist, Dnskey.MultipleObjectsReturned):
+        log.error("Unable to determine old KSK for %s" % zone, **fields)
     
-    newkeydir = opts['path_newkeydir']
-    key_dir = os.path.join(opts['path_zonedir'], zone, newkeydir)
-    try:
-        os.chdir(key_dir)
-    except OSError, err:
-        log.error("chdir failed: %s" % err) 
+    newkeydir = defaults['path_newkeydir']
+    key_dir = os.path.join(defaults['path_zonedir'], zone, newkeydir)
 
     try:
-        newksk = Dnskey.from_dnssec_keygen(zone, keytype='KSK')
+        newksk = Dnskey.generate(zone, keytype='KSK', directory=key_dir)
     except errors.PszKeygenError, err:
-        log.error("keygen failed making new KSK for zone %s. %s" % (zone, err))
+        log.error("keygen failed making new KSK for zone %s. %s" % (zone, err),
+                  **fields)
    
     try:
         nameserver.add_dnskey(newksk)
     except errors.PszDnsError, err:
-        # xxx retry
         msg = "Failed adding new KSK to DNS. %s" % err
-        log.error(msg)
+        log.error(msg, **fields)
     
-    dnskey_rrset = nameserver.lookup(zone, 'DNSKEY')
-    expected_num_dnskeys = prev_num_dnskeys + 1
-    num_dnskeys = len(dnskey_rrset)
-    if num_dnskeys != expected_num_dnskeys:
-        # xxx retry
-        msg = "Got %d DNSKEYs, expected %d after adding new KSK keyid=%s"
-        log.error(msg % (num_dnskeys, expected_num_dnskeys, newksk.keytag))
+    try:
+        nameserver.wait_for_dnskeys(zone, present=[newksk.keytag],
+                                    count=prev_num_dnskeys + 1)
+    except errors.PszDnsCountError, err:
+        msg = "DNSKEYs didn't converge after adding new KSK keyid=%s"
+        log.error(msg % newksk.keytag, err, **fields)
 
-    oldksk.update('rolled-stage1')
-    newksk.update('active')
+    models.transition([(oldksk, 'rolled-stage1'), (newksk, 'active')],
+                      [(zone, "did stage1 KSK rollover")])
 
     msg = "keyid=%s was created, published and is signing the DNSKEY RRset."
     msg %= newksk.keytag
     emits = [ "%s rollover_ksk_stage1 complete" % zone, msg ]
     for emit in emits:
-        log.log(emit)
+        log.log(emit, **fields)
         print emit
-    models.LogMessage(zone=zone, message="did stage1 KSK rollover").save()
     return 0
 
 def rollover_ksk_stage2():
@@ -472,92 +619,192 @@ def rollover_ksk_stage2():
     Makes old KSK stop signing by moving it to the old key directory.
     And removes the old KSK from the DNS.
     """
-    opts, zone = _setup_tools() 
+    return _run_tool(_rollover_ksk_stage2)
+
+def _rollover_ksk_stage2(zone):
+    """
+    Stage 2 KSK rollover of a single zone.
+    """
+    fields = {'zone': zone, 'stage': 'rollover_ksk_stage2'}
+    _check_permissions(zone)
     Dnskey = models.Dnskey 
 
     try:
-        oldksk = Dnskey.objects.get(zone=zone, status='rolled-stage1',
-                                    type='KSK')
-    except Dnskey.DoesNotExist, Dnskey.MultipleObjectsReturned:
-        log.error("Unable to determine the old KSK for %s" % zone)
+        oldksk = Dnskey.objects.get_zone_key(zone, 'rolled-stage1', 'KSK')
+    except (Dnskey.DoesNotExist, Dnskey.MultipleObjectsReturned):
+        log.error("Unable to determine the old KSK for %s" % zone, **fields)
 
     nameserver = named.Dns()
     dnskey_rrset = nameserver.lookup(zone, 'DNSKEY')
     prev_num_dnskeys = len(dnskey_rrset)
     if not prev_num_dnskeys:
-        log.error("There are no DNSKEYs for %s" % zone)
+        log.error("There are no DNSKEYs for %s" % zone, **fields)
 
     try:
         nameserver.delete_dnskey(oldksk)
     except errors.PszDnsError, err:
-        # XXX retry
-        log.error("failed to delete old KSK keyid=%s from DNS" % oldksk.keytag)
+        log.error("failed to delete old KSK keyid=%s from DNS" % oldksk.keytag,
+                  **fields)
 
-    dnskey_rrset = nameserver.lookup(zone, 'DNSKEY')
-    expected_num_dnskeys = prev_num_dnskeys - 1
-    num_dnskeys = len(dnskey_rrset)
-    if num_dnskeys != expected_num_dnskeys:
-        # XXX retry?
-        msg = "Got %d DNSKEYs, expected %d after deleting KSK keyid=%s"
-        log.error(msg % (num_dnskeys, expected_num_dnskeys, oldksk.keytag))
+    try:
+        nameserver.wait_for_dnskeys(zone, absent=[oldksk.keytag],
+                                    count=prev_num_dnskeys - 1)
+    except errors.PszDnsCountError, err:
+        msg = "DNSKEYs didn't converge after deleting KSK keyid=%s"
+        log.error(msg % oldksk.keytag, err, **fields)
 
     zone_dir = os.path.join(defaults['path_zonedir'], zone)
     oldkey_dir = os.path.join(zone_dir, defaults['path_oldkeydir'])
     try:
         oldksk.move(oldkey_dir)
     except errors.PszError, err:
-        log.error("Failed to move old KSK: %s." % err)
+        log.error("Failed to move old KSK: %s." % err, **fields)
 
-    oldksk.update('expired')
+    models.transition([(oldksk, 'expired')],
+                      [(zone, "did stage2 KSK rollover")])
    
     emits = [
         "%s rollover_ksk_stage2 complete." % zone,
         "keyid=%s was deleted the DNSKEY RRset." % oldksk.keytag,
     ]
     for emit in emits:
-        log.log(emit)
+        log.log(emit, **fields)
         print emit
-    models.LogMessage(zone=zone, message="did stage2 KSK rollover").save()
     return 0
 
-def _show_zone_keystatus(zone, verbose=False):
+def _dns_keytags(zones):
+    """
+    Looks up the DNSKEYs of zones concurrently. Returns a dict of zone to
+    the set of its published keytags or None if the lookup failed.
+    """
+    answers = named.Dns().lookup_many(zones, 'DNSKEY')
+    keytags = {}
+    for zone, answer in answers.items():
+        if isinstance(answer, errors.PszDnsError):
+            log.log("%s" % answer)
+            keytags[zone] = None
+        else:
+            keytags[zone] = named.keytag_set(answer)
+    return keytags
+
+def _in_dns(keytag, published):
+    """
+    Is a key in the DNS given its zone's published keytags? None if the
+    zone's lookup failed.
+    """
+    if published is None:
+        return None
+    return int(keytag) in published
+
+_DNS_NOTES = {
+    None: ' [DNS lookup failed]',
+    True: ' [in DNS]',
+    False: ' [not in DNS]',
+}
+
+# Columns of the status report, in the order they are read from the database
+STATUS_FIELDS = ('zone', 'type', 'keytag', 'algorithm', 'size', 'status',
+                 'updated')
+
+def _status_rows(zones):
+    """
+    Returns an iterator over KeyRecords of the non expired keys of zones,
+    or of all zones if zones is empty, ordered by zone and type. Rows are
+    streamed from the database rather than cached.
+    """
+    keys = models.Dnskey.objects.get_zone_keys()
+    if zones:
+        keys = keys.filter(zone_hash__in=map(models.zone_hash, zones),
+                           zone__in=zones)
+    return models.key_records(keys.order_by('zone', 'type'))
+
+def _zone_chunks(rows, chunk_size):
     """
-    Display the status of keys for a zone.
+    Yields lists of up to chunk_size (zone, rows of zone) pairs for
+    KeyRecords ordered by zone.
+    """
+    chunk = []
+    for zone, zone_rows in itertools.groupby(rows, operator.attrgetter('zone')):
+        chunk.append((zone, list(zone_rows)))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _with_dns(rows, chunk_size):
+    """
+    Yields (row, published keytags) pairs for rows from _status_rows,
+    looking up the DNSKEYs of chunk_size zones at a time.
+    """
+    for chunk in _zone_chunks(rows, chunk_size):
+        published = _dns_keytags([zone for zone, zone_rows in chunk])
+        for zone, zone_rows in chunk:
+            for row in zone_rows:
+                yield row, published[zone]
+
+def _show_zone_keystatus(zones, verbose=False, check_dns=False,
+                         output='text'):
+    """
+    Display the status of keys for a list of zones, or for all zones if
+    zones is empty, as text, csv or json (one object per line).
     """
     if verbose:
         fmt = "%s %s (%s key, %d bits) has been %s since"
     else:
         fmt = "%s %s (%s key, %d bits) is %s"
-    Dnskey = models.Dnskey 
-    zones = {}
-    zonekeys = Dnskey.objects.get_zone_keys(zone)
-    for key in zonekeys:
-        zones.setdefault(key.zone, []).append(key)
-    if not zones:
-        s = "%s either has no keys in the DNS or doesn't exist."
-        print s % zone
-        return
-    zone_list = zones.keys()
-    zone_list.sort()
+    rows = _status_rows(zones)
+    if check_dns:
+        rows = _with_dns(rows, defaults['lookup_concurrency'] * 10)
+    else:
+        rows = ((row, None) for row in rows)
+
+    columns = list(STATUS_FIELDS) + ['age_days']
+    if check_dns:
+        columns.append('in_dns')
+    if output == 'csv':
+        writer = csv.writer(sys.stdout)
+        writer.writerow(columns)
+
     now = datetime.datetime.now()
-    for zone in zone_list:
-        zones[zone].sort()
-        print '\n', zone
-        print '-' * len(zone)
-        for key in zones[zone]:
-            s = fmt % (key.type, key.keytag, key.algorithm,
-                        key.size, key.status)
-            print s,
-            if not verbose:
-                print
-                continue
-            updated = key.updated
-            age = now - updated
-            days = age.days
+    seen = set()
+    last_zone = None
+    for row, published in rows:
+        zone, keytag = row.zone, row.keytag
+        days = (now - row.updated).days
+        if output != 'text':
+            values = [getattr(row, field) for field in STATUS_FIELDS]
+            values[6] = row.updated.isoformat()
+            values.append(days)
+            if check_dns:
+                values.append(_in_dns(keytag, published))
+            if output == 'csv':
+                writer.writerow(values)
+            else:
+                print json.dumps(dict(zip(columns, values)))
+            continue
+        if zone != last_zone:
+            print '\n', zone
+            print '-' * len(zone)
+            last_zone = zone
+            seen.add(zone)
+        s = fmt % (row.type, keytag, row.algorithm, row.size, row.status)
+        if verbose:
             if days:
-                print '%d days ago' % days
+                s += ' %d days ago' % days
             else:
-                print 'earlier today' 
+                s += ' earlier today'
+        if check_dns:
+            s += _DNS_NOTES[_in_dns(keytag, published)]
+        print s
+
+    if output == 'text':
+        s = "%s either has no keys in the DNS or doesn't exist."
+        if not zones and not seen:
+            print s % None
+        for zone in zones:
+            if zone not in seen:
+                print s % zone
 
 def key_status():
     """
@@ -566,23 +813,83 @@ def key_status():
     opts, args = cli.keystatus_parse_args()
     import models
     globals()['models'] = models
-    verbose = opts['verbose']
-    if not args:
-        _show_zone_keystatus(None, verbose)
-    else:
-        for zone in args:
-            zone = _fix_zone(zone)
-            _show_zone_keystatus(zone, verbose)
+    zones = [_fix_zone(zone) for zone in args]
+    _show_zone_keystatus(zones, opts['verbose'], opts['check_dns'],
+                         opts['status_format'])
     return 0
 
-def showconfig():
+def _keypool_kinds():
+    """
+    Returns the (type, algorithm, size) kinds of keys kept in the pool.
+    """
+    kinds = []
+    for keytype in ('ZSK', 'KSK'):
+        algname = defaults[keytype.lower() + '_algorithm']
+        size = int(defaults[keytype.lower() + '_keysize'])
+        kinds.append((keytype, algname, size))
+    return kinds
+
+def _keypool_wants(counts, size, low_water=None):
+    """
+    Returns ((type, algorithm, size), count) for each kind of key the pool
+    needs count more of to hold size keys. With low_water, only kinds with
+    fewer keys than that are topped up.
+    """
+    wants = []
+    for kind in _keypool_kinds():
+        have = counts.get(kind, 0)
+        if low_water is not None and have >= low_water:
+            continue
+        if size > have:
+            wants.append((kind, size - have))
+    return wants
+
+def keypool():
+    """
+    Manages the pool of pre-generated keys.
+
+    fill    tops up every kind of key to keypool_size
+    refill  tops up the kinds of keys below keypool_low_water
+    stats   shows how many keys of each kind are in the pool
+    """
     opts, args = cli.parse_args()
-    cf = opts.pop('configfile')
-    print "# Configuration file: %s\n" % cf
-    keys = opts.keys()
-    keys.sort()
-    for key in keys:
-        print '%s=%r' % (key, opts[key])
+    import models
+    PooledKey = models.PooledKey
+    action = args and args[0] or 'stats'
+    if action not in ('fill', 'refill', 'stats'):
+        log.error("usage: psz keypool [fill|refill|stats]")
+    pool_dir = PooledKey.objects.pool_dir()
+    if pool_dir is None:
+        log.error("The key pool is off. Set path_keypool to use it.")
+    if action != 'stats' and not os.access(pool_dir, os.W_OK):
+        log.error("path_keypool '%s' is not writable" % pool_dir)
+
+    counts = PooledKey.objects.stats()
+    for kind in _keypool_kinds():
+        counts.setdefault(kind, 0)
+    if action == 'stats':
+        for kind in sorted(counts):
+            low = ''
+            if counts[kind] < opts['keypool_low_water']:
+                low = '\t(low)'
+            print '%s %s %d bits\t%d%s' % (kind + (counts[kind], low))
+        return 0
+
+    low_water = None
+    if action == 'refill':
+        low_water = opts['keypool_low_water']
+    wants = _keypool_wants(counts, opts['keypool_size'], low_water)
+    for (keytype, algname, size), want in wants:
+        try:
+            made = PooledKey.objects.fill(keytype, algname, size, want,
+                                          opts['batch_workers'])
+        except errors.PszKeygenError, err:
+            log.error("keygen failed filling the key pool. %s" % err)
+        if made:
+            mesg = "key pool: added %d %s %s %d bit keys" % (made, keytype,
+                algname, size)
+            print mesg
+            log.log(mesg)
     return 0
 
 def createdb():
@@ -593,17 +900,444 @@ def createdb():
     opts, args = cli.parse_args()
     cmd = syncdb.Command()
     cmd.handle_noargs()
-    from django.db import connection
+    # Django 1.1 can't index several columns together, or MySQL text
+    # fields (http://code.djangoproject.com/ticket/2495), so zones are
+    # looked up by an indexed hash and the rest we make by hand.
+    _create_indexes()
+    return 0
+
+def _create_indexes():
+    import models
+    from django.db import connection, transaction
     cursor = connection.cursor()
-    # Django can't created indexes on MySQL text fields
-    # http://code.djangoproject.com/ticket/2495
-    # so we have to do it by hand
-    if DEFAULTS['db_engine'] == 'mysql': 
-        # XXX we should construct the table name dynamically
-        cursor.execute('create index zone_index on psz_dnskey (zone(255))')
-        cursor.execute('create index zone_index on psz_logmessage (zone(255))')
+    for name in models.create_indexes(cursor, connection.ops.quote_name):
+        print "Created index %s" % name
+    transaction.commit_unless_managed()
+
+def _add_columns(cursor, model):
+    """
+    Adds the columns of model that its table doesn't have yet.
+    """
+    from django.db import connection, transaction
+    quote_name = connection.ops.quote_name
+    table = model._meta.db_table
+    columns = [row[0] for row in
+        connection.introspection.get_table_description(cursor, table)]
+    for field in model._meta.fields:
+        if field.column in columns:
+            continue
+        sql = "ALTER TABLE %s ADD COLUMN %s %s" % (quote_name(table),
+            quote_name(field.column), field.db_type())
+        if field.null:
+            sql += " NULL"
+        else:
+            default = field.get_default()
+            if isinstance(default, basestring):
+                default = "'%s'" % default.replace("'", "''")
+            sql += " NOT NULL DEFAULT %s" % default
+        cursor.execute(sql)
+        transaction.commit_unless_managed()
+        print "Added %s.%s" % (table, field.column)
+
+def migratedb():
+    """
+    Brings the tables of an older psz database up to date: makes new
+    tables, adds new columns, fills in the zone_hash columns and makes the
+    composite indexes.
+    """
+    from django.core.management.commands import syncdb
+    opts, args = cli.parse_args()
+    syncdb.Command().handle_noargs()
+    import models
+    from django.db import connection, transaction
+    cursor = connection.cursor()
+    for model in (models.Dnskey, models.LogMessage):
+        table = model._meta.db_table
+        _add_columns(cursor, model)
+        unhashed = model.objects.filter(zone_hash='')
+        zones = unhashed.values_list('zone', flat=True).distinct()
+        count = 0
+        for zone in list(zones):
+            count += unhashed.filter(zone=zone).update(
+                zone_hash=models.zone_hash(zone))
+        transaction.commit_unless_managed()
+        print "Filled in zone_hash for %d rows of %s" % (count, table)
+    _create_indexes()
+    print "Run 'psz backfill' to store the DNSKEYs of existing keys."
     return 0
 
+def _print_policy(name, policy):
+    print "%s\tzsk=%dd\tksk=%dd\tmax_ttl=%d\t%s" % (name,
+        policy.zsk_lifetime_days, policy.ksk_lifetime_days,
+        policy.zone_max_ttl, policy.enabled and 'enabled' or 'disabled')
+
+def _schedule_policy(zones, changes):
+    """
+    Shows the policies of zones, or of all zones that have one, after
+    making changes to them.
+    """
+    import scheduler
+    ZonePolicy = models.ZonePolicy
+    if changes:
+        mesg = "set rollover policy %s" % ' '.join('%s=%s' % item
+                                                   for item in changes.items())
+        for zone in zones:
+            try:
+                policy = ZonePolicy.objects.for_zone(zone).get()
+            except ZonePolicy.DoesNotExist:
+                policy = ZonePolicy(zone=zone)
+            for name, value in changes.items():
+                setattr(policy, name, value)
+            policy.save()
+            log.log("%s: %s" % (zone, mesg), zone=zone)
+            models.LogMessage(zone=zone, message=mesg).save()
+
+    policies = scheduler.zone_policies()
+    _print_policy('default', scheduler.Policy())
+    for zone in zones or sorted(policies):
+        _print_policy(zone, policies.get(zone, scheduler.Policy()))
+    return 0
+
+def schedule():
+    """
+    Runs the key rollovers that are due by policy.
+
+    psz schedule list              shows the rollover stages that are due
+    psz schedule run               runs them within the rate limits
+    psz schedule policy [zone...]  shows or sets the policies of zones
+    """
+    opts, args = cli.schedule_parse_args()
+    import models
+    globals()['models'] = models
+    import scheduler
+
+    if not args or args[0] not in ('list', 'run', 'policy'):
+        log.error("usage: psz schedule list | run | policy [zone...]")
+    action = args[0]
+    if action == 'policy':
+        zones = [_fix_zone(zone) for zone in args[1:]]
+        return _schedule_policy(zones, opts['policy_changes'])
+
+    due = scheduler.find_due(every=True)
+    # The old KSK can't go until the parent has the new KSK's DS. The
+    # zone's next due stage runs instead.
+    waiting = scheduler.waiting_for_ds(due)
+    held = set((zone, 'rollover_ksk_stage2') for zone in waiting)
+    tasks = scheduler.one_per_zone(due, held)
+    for zone, why in sorted(waiting.items()):
+        print "%s\trollover_ksk_stage2\twaiting: %s" % (zone, why)
+    for priority, zone, stage in tasks:
+        print "%s\t%s" % (zone, stage)
+    mesg = "%d zones have rollovers due" % len(tasks)
+    if waiting:
+        mesg += ", %d waiting for DS" % len(waiting)
+    print mesg
+    if action == 'list' or not tasks:
+        return 0
+    log.log(mesg)
+
+    zones = [zone for priority, zone, stage in tasks]
+    limiter = scheduler.RateLimiter(opts['schedule_rate'],
+        opts['schedule_rate_per_server'], opts['schedule_burst'], time.time())
+    released = scheduler.release(tasks, scheduler.nameservers(zones), limiter)
+    # The per zone functions are module level so process pools can run them
+    stages = globals()
+    items = ((stages['_' + stage], zone) for priority, zone, stage in released)
+    results = {}
+    for zone, rc, mesg in batch.map_tasks(items, opts['batch_workers'],
+                                          opts['batch_pool']):
+        results[zone] = (rc, mesg)
+    return batch.summarize('schedule', zones, results)
+
+def _inventory(opts, zones):
+    """
+    Returns an Index of the key files of zones, or of all zones, and the
+    KeyRecords of the same zones' keys.
+    """
+    import inventory
+    index = inventory.Scanner().scan(zones or None)
+    keys = models.Dnskey.objects.all()
+    if zones:
+        keys = keys & models.Dnskey.objects.for_zones(zones)
+    return index, list(models.key_records(keys))
+
+# Statuses of keys that should be in the DNS
+_PUBLISHED_STATUSES = ('published', 'active', 'rolled-stage1')
+
+def _audit_zone(zone, rows, index, published):
+    """
+    Yields a dict for each way the database, the key files and the DNS
+    disagree about zone. rows are its KeyRecords.
+    """
+    import inventory
+    live = set()
+    for row in rows:
+        keytype, keytag, status = row.type, row.keytag, row.status
+        found = {'zone': zone, 'keytag': keytag, 'type': keytype,
+                 'status': status}
+        live.add(int(keytag))
+        problem = inventory.key_problem(index, zone, keytag, keytype, status)
+        if problem is not None:
+            yield dict(found, source='disk', problem=problem)
+        if published is None:
+            continue
+        should = status in _PUBLISHED_STATUSES
+        if should and int(keytag) not in published:
+            yield dict(found, source='dns', problem="%s %s isn't in the DNS"
+                       % (keytype, status))
+        elif not should and int(keytag) in published:
+            yield dict(found, source='dns', problem="%s %s is in the DNS"
+                       % (keytype, status))
+    if published is None:
+        yield {'zone': zone, 'keytag': None, 'type': None, 'status': None,
+               'source': 'dns', 'problem': "DNSKEY lookup failed"}
+        return
+    for keytag in sorted(published - live):
+        yield {'zone': zone, 'keytag': str(keytag), 'type': None,
+               'status': None, 'source': 'db',
+               'problem': "keyid %d is in the DNS but isn't a live key in "
+                          "the database" % keytag}
+
+def _audit_chunks(zones, chunk_size):
+    """
+    Yields the chunks of _zone_chunks for the live keys of zones, or of
+    all zones in the database, and then chunks of the zones without live
+    keys, whose DNSKEYs could still be in the DNS.
+    """
+    seen = set()
+    for chunk in _zone_chunks(_status_rows(zones), chunk_size):
+        seen.update(zone for zone, rows in chunk)
+        yield chunk
+    if not zones:
+        zones = models.Dnskey.objects.order_by('zone').values_list('zone',
+            flat=True).distinct().iterator()
+    rest = [(zone, []) for zone in zones if zone not in seen]
+    for i in range(0, len(rest), chunk_size):
+        yield rest[i:i + chunk_size]
+
+def audit():
+    """
+    Compares the keys in the database with the key files and the DNSKEYs
+    in the DNS for zones, or for all zones in the database. Prints each
+    discrepancy as a JSON object on a line of its own.
+
+    The keys are read in one pass ordered by zone. The key files and the
+    DNSKEYs of each chunk of zones are fetched concurrently. Zones without
+    live keys are checked last, for DNSKEYs the database doesn't know.
+    """
+    opts, args = cli.parse_args()
+    import models
+    globals()['models'] = models
+    import inventory
+    zones = _read_zones(opts, args)
+    scanner = inventory.Scanner()
+    chunk_size = opts['lookup_concurrency'] * 10
+    checked = found = 0
+    for chunk in _audit_chunks(zones, chunk_size):
+        chunk_zones = [zone for zone, rows in chunk]
+        index = scanner.scan(chunk_zones, save=False)
+        published = _dns_keytags(chunk_zones)
+        for zone, rows in chunk:
+            checked += 1
+            for problem in _audit_zone(zone, rows, index, published[zone]):
+                found += 1
+                print json.dumps(problem, sort_keys=True)
+    scanner.save()
+    mesg = "audit: %d zones, %d discrepancies" % (checked, found)
+    sys.stderr.write("%s\n" % mesg)
+    log.log(mesg)
+    return found and 1 or 0
+
+def listkeys():
+    """
+    Lists the key files of zones, or of all zones, with their status in
+    the database.
+    """
+    opts, args = cli.parse_args()
+    import models
+    globals()['models'] = models
+    zones = _read_zones(opts, args)
+    index, rows = _inventory(opts, zones)
+    statuses = dict(((row.zone, str(int(row.keytag))), (row.type, row.status))
+                    for row in rows)
+    for (zone, keytag), where in index.items():
+        keytype, status = statuses.get((zone, keytag), ('-', 'untracked'))
+        for directory, exts in sorted(where.items()):
+            files = '+'.join(sorted(exts))
+            print "%s\t%s\t%s\t%s\t%s\t%s" % (zone, keytag, keytype, status,
+                                               directory, files)
+    return 0
+
+def fsck():
+    """
+    Checks the key files of zones, or of all zones, against the database.
+    Reports files without a partner or a database row, keys whose files
+    are missing and keys whose files aren't where their status says.
+    """
+    opts, args = cli.parse_args()
+    import models
+    globals()['models'] = models
+    import inventory
+    zones = _read_zones(opts, args)
+    index, rows = _inventory(opts, zones)
+    problems = inventory.check(index, rows)
+    for zone, keytag, problem in problems:
+        print "%s\t%s\t%s" % (zone, keytag, problem)
+    mesg = "fsck: %d zones, %d keys on disk, %d problems" % (len(index.zones),
+        len(index.keys), len(problems))
+    print mesg
+    log.log(mesg)
+    return problems and 1 or 0
+
+def _map_keys(func, keys, workers):
+    """
+    Yields (key, func(key)) for keys, on workers threads at once since
+    func usually waits on a (network) filesystem.
+    """
+    if workers <= 1:
+        for key in keys:
+            yield key, func(key)
+        return
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(workers)
+    try:
+        for item in pool.imap(lambda key: (key, func(key)), keys):
+            yield item
+    finally:
+        pool.close()
+        pool.join()
+
+def backfill():
+    """
+    Stores the DNSKEYs of keys saved before psz kept them in the database,
+    reading each key's .key file one last time.
+
+    'psz backfill verify' checks the stored DNSKEYs against the .key files.
+    """
+    opts, args = cli.parse_args()
+    import models
+    from django.db.models import Q
+    Dnskey = models.Dnskey
+    keys = Dnskey.objects.exclude(status='deleted')
+    workers = opts['batch_workers']
+
+    if args and args[0] == 'verify':
+        keys = keys.exclude(Q(rdata__isnull=True) | Q(rdata=''))
+        checked = bad = 0
+        for key, ok in _map_keys(Dnskey.verify_dnsdata, keys.iterator(),
+                                 workers):
+            checked += 1
+            if not ok:
+                bad += 1
+                print "%s\t%s\tdoesn't match" % (key, key.path_public)
+        print "%d keys checked, %d don't match their .key files" % (checked,
+                                                                   bad)
+        return bad and 1 or 0
+
+    keys = keys.filter(Q(rdata__isnull=True) | Q(rdata=''))
+    stored = unreadable = 0
+    for key, dnsdata in _map_keys(Dnskey.read_dnsdata, keys.iterator(),
+                                  workers):
+        try:
+            if dnsdata is None:
+                raise errors.PszError("can't read %s" % key.path_public)
+            rdata, flags, algnum = models.split_dnsdata(dnsdata)
+        except errors.PszError, err:
+            unreadable += 1
+            print "%s\t%s" % (key, err)
+            continue
+        Dnskey.objects.filter(pk=key.pk).update(rdata=rdata, flags=flags,
+                                                algnum=algnum)
+        stored += 1
+    mesg = "backfill: stored the DNSKEYs of %d keys, %d couldn't be read"
+    mesg %= (stored, unreadable)
+    print mesg
+    log.log(mesg)
+    return unreadable and 1 or 0
+
+# Columns of the ds report
+DS_FIELDS = ('zone', 'keytag', 'algorithm', 'digest_type', 'digest', 'status')
+
+def _ksk_rdata(zones, workers):
+    """
+    Yields (zone, keytag, status, rdata) for the KSKs of zones, or of all
+    zones, that are or are about to be in the DNS, ordered by zone. The
+    rdata comes from the database, or from the .key file of keys saved
+    before it was stored there, or is None if neither has it.
+    """
+    Dnskey = models.Dnskey
+    keys = Dnskey.objects.filter(type='KSK', status__in=_PUBLISHED_STATUSES)
+    if zones:
+        keys = keys & Dnskey.objects.for_zones(zones)
+    rows = list(models.key_records(keys.order_by('zone', 'keytag'),
+                                   rdata=True))
+    missing = [row for row in rows if not row.rdata]
+    found = {}
+    for row, dnsdata in _map_keys(models.KeyRecord.read_dnsdata, missing,
+                                  workers):
+        try:
+            found[row.id] = models.split_dnsdata(dnsdata or '')[0]
+        except errors.PszError:
+            found[row.id] = None
+    for row in rows:
+        rdata = row.rdata or found.get(row.id)
+        yield row.zone, str(int(row.keytag)), row.status, rdata
+
+def ds():
+    """
+    Prints the DS records of the KSKs of zones, or of all zones, that are
+    or are about to be in the DNS, for their parent zones or registrars.
+
+    The DNSKEYs come from the database, so nothing is looked up in the DNS.
+    """
+    opts, args = cli.ds_parse_args()
+    import models
+    globals()['models'] = models
+    import delegation
+    zones = _read_zones(opts, args)
+    digest_types = delegation.parse_digest_types(opts['ds_digest_types'])
+    output = opts['ds_format']
+    cache = delegation.DigestCache()
+    if output == 'csv':
+        writer = csv.writer(sys.stdout)
+        writer.writerow(DS_FIELDS)
+    rrtype = output == 'cds' and 'CDS' or 'DS'
+
+    seen = set()
+    rc = 0
+    for zone, keytag, status, rdata in _ksk_rdata(zones,
+                                                  opts['batch_workers']):
+        seen.add(zone)
+        if rdata is None:
+            log.log("%s KSK keyid=%s has no DNSKEY stored or on disk" %
+                    (zone, keytag))
+            sys.stderr.write("%s: KSK keyid=%s has no DNSKEY stored or on "
+                             "disk\n" % (zone, keytag))
+            rc = 1
+            continue
+        for record in cache.ds_records(zone, keytag, rdata, digest_types):
+            if output == 'csv':
+                writer.writerow(record + (status,))
+            elif output == 'json':
+                print json.dumps(dict(zip(DS_FIELDS, record + (status,))),
+                                 sort_keys=True)
+            else:
+                print "%s. IN %s %s %d %d %s" % ((record[0].rstrip('.'),
+                    rrtype) + record[1:])
+    cache.save()
+    for zone in zones:
+        if zone not in seen:
+            sys.stderr.write("%s has no KSKs in the database\n" % zone)
+            rc = 1
+    return rc
+
+def serve():
+    """
+    Run the psz daemon, see the server module.
+    """
+    import server
+    return server.serve()
+
 def shell():
     """
     Run an interactive Python shell configured for our models. 
@@ -615,7 +1349,7 @@ def shell():
     return 0
 
 # Make a few aliases for commands
-config = showconfig
+config = showconfig = cli.showconfig
 secure = securezone
 unsecure = unsign
 retry = retrysecure = retrysecurezone
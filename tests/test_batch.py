@@ -0,0 +1,62 @@
+from psz import batch, errors, log
+import StringIO
+import sys
+
+ZONES = ['ok.test', 'error.test', 'exit0.test', 'exit2.test', 'exitmsg.test',
+         'crash.test']
+
+def _tool(zone):
+    if zone == 'error.test':
+        log.error("no keys", zone=zone)
+    if zone == 'exit0.test':
+        sys.exit(0)
+    if zone == 'exit2.test':
+        sys.exit(2)
+    if zone == 'exitmsg.test':
+        sys.exit("gave up")
+    if zone == 'crash.test':
+        raise ValueError("bad")
+    return 0
+
+EXPECTED = {
+    'ok.test': (0, ''),
+    'error.test': (1, 'no keys'),
+    'exit0.test': (0, ''),
+    'exit2.test': (2, 'exited'),
+    'exitmsg.test': (1, 'gave up'),
+    'crash.test': (1, 'ValueError: bad'),
+}
+
+def _map(workers, kind):
+    return dict((zone, (rc, mesg)) for zone, rc, mesg in
+                batch.map_zones(_tool, ZONES, workers, kind))
+
+def test_map_zones():
+    assert _map(1, 'process') == EXPECTED
+    assert _map(3, 'thread') == EXPECTED
+    # the parent still exits on errors
+    assert log.EXIT_ON_ERROR
+
+def test_map_zones_processes():
+    assert _map(2, 'process') == EXPECTED
+
+def test_bad_pool_kind():
+    try:
+        list(batch.map_zones(_tool, ZONES, 2, 'fiber'))
+    except errors.PszConfigError:
+        pass
+    else:
+        assert False, 'expected PszConfigError'
+
+def test_run_and_summarize():
+    out = StringIO.StringIO()
+    assert batch.run(_tool, ['ok.test', 'exit0.test'], 2, 'thread', out) == 0
+    assert out.getvalue().endswith('2 zones, 2 succeeded, 0 failed\n')
+
+    out = StringIO.StringIO()
+    results = {'a.test': (0, ''), 'b.test': (1, 'first\n  second\n')}
+    assert batch.summarize('tool', ['a.test', 'b.test'], results, out) == 1
+    lines = out.getvalue().splitlines()
+    assert lines[1:] == ['tool summary', 'a.test\tok',
+                         'b.test\tFAILED\tfirst; second',
+                         '2 zones, 1 succeeded, 1 failed']
@@ -0,0 +1,140 @@
+from psz import connpool
+import dns.exception
+import dns.message
+import socket
+import struct
+import threading
+import time
+
+class _Server(object):
+    """
+    A TCP nameserver that answers each batch of queries it reads in reverse
+    order, closing the connection after close_after batches.
+    """
+    def __init__(self, close_after=None):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        self.close_after = close_after
+        self.accepted = 0
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error:
+                return
+            self.accepted += 1
+            thread = threading.Thread(target=self._serve, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn):
+        batches = 0
+        try:
+            while self.close_after is None or batches < self.close_after:
+                queries = [self._read(conn)]
+                conn.settimeout(0.05)
+                try:
+                    while True:
+                        queries.append(self._read(conn))
+                except socket.timeout:
+                    pass
+                conn.settimeout(None)
+                queries.reverse()
+                for query in queries:
+                    wire = dns.message.make_response(query).to_wire()
+                    conn.sendall(struct.pack('!H', len(wire)) + wire)
+                batches += 1
+        except (socket.error, EOFError):
+            pass
+        conn.close()
+
+    def _read(self, conn):
+        size = struct.unpack('!H', self._read_exactly(conn, 2))[0]
+        return dns.message.from_wire(self._read_exactly(conn, size))
+
+    def _read_exactly(self, conn, count):
+        data = ''
+        while len(data) < count:
+            chunk = conn.recv(count - len(data))
+            if not chunk:
+                raise EOFError()
+            data += chunk
+        return data
+
+    def close(self):
+        self.sock.close()
+
+def _queries(count):
+    return [dns.message.make_query('%d.example.com' % i, 'A')
+            for i in range(count)]
+
+def test_pipelined_order():
+    server = _Server()
+    pool = connpool.ConnectionPool(timeout=2)
+    try:
+        queries = _queries(5)
+        responses = pool.exchange('127.0.0.1', queries, server.port)
+        assert [r.question[0].name for r in responses] == \
+               [q.question[0].name for q in queries]
+        assert server.accepted == 1
+    finally:
+        pool.close()
+        server.close()
+
+def test_idle_expiry():
+    server = _Server()
+    pool = connpool.ConnectionPool(idle_timeout=5, timeout=2)
+    key = ('127.0.0.1', server.port)
+    try:
+        pool.exchange('127.0.0.1', _queries(1), server.port)
+        pool.exchange('127.0.0.1', _queries(1), server.port)
+        assert server.accepted == 1
+        pool._idle[key][0].last_used -= 10
+        pool.exchange('127.0.0.1', _queries(1), server.port)
+        assert server.accepted == 2
+        assert pool._open[key] == 1
+    finally:
+        pool.close()
+        server.close()
+
+def test_discard_after_error():
+    # the server hangs up after each answer, so the idle connection fails
+    server = _Server(close_after=1)
+    pool = connpool.ConnectionPool(timeout=2)
+    key = ('127.0.0.1', server.port)
+    try:
+        pool.exchange('127.0.0.1', _queries(2), server.port)
+        time.sleep(0.1)
+        responses = pool.exchange('127.0.0.1', _queries(2), server.port)
+        assert len(responses) == 2
+        assert server.accepted == 2
+        assert pool._open[key] == 1
+        assert len(pool._idle[key]) == 1
+    finally:
+        pool.close()
+        server.close()
+
+def test_busy_timeout():
+    server = _Server()
+    pool = connpool.ConnectionPool(max_per_server=1, timeout=0.2)
+    key = ('127.0.0.1', server.port)
+    try:
+        held = pool._get(key)
+        started = time.time()
+        try:
+            pool._get(key)
+        except dns.exception.Timeout:
+            assert time.time() - started < 1
+        else:
+            assert False, 'expected Timeout'
+        pool._discard(key, held)
+        assert pool._open[key] == 0
+    finally:
+        pool.close()
+        server.close()
@@ -1,4 +1,13 @@
-from psz import named
+from psz import config, errors, named
+import base64
+import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+import dns.tsig
+import os
+import random
+import struct
 
 def setup_module():
     pass
@@ -17,3 +26,150 @@ def test_dns_resolver_server():
 def test_dns_update():
     dns = named.Dns()
     assert dns.update is not None
+
+def test_dnskey_rdata():
+    dnsdata = ('example.com. IN DNSKEY 256 3 5 AwEAAbsD4Tcz8hl2Rldov4CrfYpK3ORI'
+               'h/giSGDlZaDTZR4gpGxGvMBw JgI7Lz8h')
+    rdata = named._dnskey_rdata(dnsdata)
+    assert rdata.flags == 256
+    assert rdata.algorithm == 5
+
+def test_update_dnskeys_without_dnsdata():
+    from psz.models import Dnskey
+    saved = config.DEFAULTS['update_backend']
+    config.DEFAULTS['update_backend'] = 'native'
+    try:
+        key = Dnskey(zone='example.com', keytag='1234')
+        try:
+            named.Dns().update_dnskeys('example.com', adds=[key])
+        except errors.PszDnsError, err:
+            assert 'keyid=1234' in str(err)
+        else:
+            assert False, 'expected PszDnsError'
+    finally:
+        config.DEFAULTS['update_backend'] = saved
+
+def test_read_tsig_key():
+    import tempfile
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, 'update.key')
+    open(path, 'w').write('key "update-key" {\n\talgorithm hmac-sha256;\n'
+                          '\tsecret "c2VjcmV0";\n};\n')
+    keyring, keyname, algorithm = named._read_tsig_key(path)
+    assert str(keyname) == 'update-key.'
+    assert algorithm == dns.tsig.HMAC_SHA256
+    path = os.path.join(tmpdir, 'Kupdate.+157+12345.private')
+    open(path, 'w').write('Private-key-format: v1.2\nAlgorithm: 157 '
+                          '(HMAC_MD5)\nKey: c2VjcmV0\nBits: AAA=\n')
+    keyring, keyname, algorithm = named._read_tsig_key(path[:-8] + '.key')
+    assert str(keyname) == 'update.'
+    assert algorithm == dns.tsig.HMAC_MD5
+
+class _Key(object):
+    def __init__(self, zone):
+        self.zone = zone
+        self.dnsdata = '%s. IN DNSKEY 256 3 5 AwEAAQ==' % zone
+
+class _BatchDns(named.Dns):
+    sends = 0
+    def update_zones(self, blocks):
+        self.sends += 1
+        for zone, adds, deletes in blocks:
+            if zone.startswith('bad'):
+                raise errors.PszDnsUpdateError('update failed: REFUSED',
+                                               rcode='REFUSED')
+
+def test_update_batcher():
+    nameserver = _BatchDns()
+    batcher = named.UpdateBatcher(nameserver)
+    zones = ['z%d.example' % i for i in range(31)] + ['bad.example']
+    for zone in zones:
+        batcher.delete_dnskey(_Key(zone))
+        batcher.add_dnskey(_Key(zone))
+    assert len(batcher) == len(zones)
+    results = batcher.flush()
+    assert len(batcher) == 0
+    assert results['bad.example'].rcode == 'REFUSED'
+    for zone in zones[:-1]:
+        assert results[zone] is None
+    assert nameserver.sends < len(zones)
+
+def _reference_keytag(dnskey):
+    # The per byte RFC 4034 appendix B checksum
+    if dnskey.algorithm == 1:
+        return (ord(dnskey.key[-3]) << 8) + ord(dnskey.key[-2])
+    header = struct.pack("!HBB", dnskey.flags, dnskey.protocol,
+                         dnskey.algorithm)
+    ac = 0
+    for i, value in enumerate(ord(x) for x in header + dnskey.key):
+        if i % 2:
+            ac += value
+        else:
+            ac += (value << 8)
+    ac += (ac >> 16) & 0xffff
+    return ac & 0xffff
+
+def _random_dnskeys(count):
+    rdatas = []
+    for i in range(count):
+        algorithm = random.choice((1, 5, 8, 13))
+        key = os.urandom(random.randint(3, 300))
+        text = '%d 3 %d %s' % (random.choice((256, 257)), algorithm,
+                               base64.b64encode(key))
+        rdatas.append(dns.rdata.from_text(dns.rdataclass.IN,
+                                          dns.rdatatype.DNSKEY, text))
+    return rdatas
+
+def test_keytag():
+    rdatas = _random_dnskeys(200)
+    for rdata in rdatas:
+        assert named.keytag(rdata) == _reference_keytag(rdata)
+    expected = [_reference_keytag(rdata) for rdata in rdatas]
+    assert named.keytags(rdatas) == expected
+    assert named.keytags([rdatas[:3], rdatas[3:]]) == expected
+    assert named.keytags(rdatas[:5]) == expected[:5]
+    assert named.keytag_set(rdatas) == frozenset(expected)
+
+class _ConvergingDns(named.Dns):
+    # The primary has the new key at once, the secondary after two polls.
+    polls = 0
+    def _convergence_servers(self, zone):
+        return ['127.0.0.1', '192.0.2.1']
+    def _server_state(self, server, zone):
+        if server == '127.0.0.1':
+            return 11, frozenset([1, 2])
+        self.polls += 1
+        if self.polls < 3:
+            return 10, frozenset([1])
+        return 11, frozenset([1, 2])
+
+def test_wait_for_dnskeys():
+    saved = config.DEFAULTS.copy()
+    config.DEFAULTS['converge_initial_delay'] = 0.01
+    try:
+        nameserver = _ConvergingDns()
+        nameserver.wait_for_dnskeys('example.com', present=['2'], count=2)
+        assert nameserver.polls == 3
+        config.DEFAULTS['converge_timeout'] = 0.05
+        try:
+            nameserver.wait_for_dnskeys('example.com', absent=['2'])
+        except errors.PszDnsConvergenceError, err:
+            assert 'keyid 2 still published' in str(err)
+        else:
+            assert False, 'expected PszDnsConvergenceError'
+    finally:
+        config.DEFAULTS.update(saved)
+
+class _NsDns(named.Dns):
+    def lookup(self, qname, rdtype):
+        return dns.rrset.from_text(qname, 300, 'IN', 'NS', 'ns1.example.com.')
+    def lookup_many(self, qnames, rdtype):
+        addresses = {'A': '192.0.2.1', 'AAAA': '2001:db8::1'}
+        return dict((qname, dns.rrset.from_text(qname, 300, 'IN', rdtype,
+                                                addresses[rdtype]))
+                    for qname in qnames)
+
+def test_convergence_servers():
+    servers = _NsDns()._convergence_servers('example.com')
+    assert '192.0.2.1' in servers
+    assert '2001:db8::1' in servers
@@ -50,6 +50,45 @@ def test_key_dnskey_read():
     key = Dnskey.objects.get(pk=keyid)
     assert key.dnsdata == dns
 
+def test_key_rdata_stored():
+    key = Dnskey.from_dnssec_keygen(TEST_ZONE_NAME, keytype='KSK')
+    dns = key.dnsdata
+    key.save()
+    assert key.flags == 257
+    assert key.verify_dnsdata()
+    os.rename(key.path_public, key.path_public + '.moved')
+    try:
+        key = Dnskey.objects.get(pk=key.id)
+        assert key.dnsdata == dns
+        assert not key.verify_dnsdata()
+    finally:
+        os.rename(key.path_public + '.moved', key.path_public)
+
+def test_key_transition():
+    from psz import models
+    zsk = Dnskey.from_dnssec_keygen(TEST_ZONE_NAME)
+    zsk.save()
+    ksk = Dnskey.from_dnssec_keygen(TEST_ZONE_NAME, keytype='KSK')
+    ksk.status = 'pre-active'
+    before = models.LogMessage.objects.for_zone(TEST_ZONE_NAME).count()
+    models.transition([(zsk, 'published'), (ksk, 'active')],
+                      [(TEST_ZONE_NAME, 'first'), (TEST_ZONE_NAME, 'second')])
+    assert ksk.pk is not None
+    assert Dnskey.objects.get(pk=zsk.pk).status == 'published'
+    assert Dnskey.objects.get(pk=ksk.pk).status == 'active'
+    logged = models.LogMessage.objects.for_zone(TEST_ZONE_NAME)
+    assert logged.count() == before + 2
+
+    # a failure part way leaves the database and the keys as they were
+    try:
+        models.transition([(zsk, 'active')], [(None, 'no zone')])
+    except Exception:
+        pass
+    else:
+        assert False, "transition with a bad message didn't fail"
+    assert zsk.status == 'published'
+    assert Dnskey.objects.get(pk=zsk.pk).status == 'published'
+
 def test_key_unlink():
     key = Dnskey.from_dnssec_keygen(TEST_ZONE_NAME)
     path = os.path.join(config.DEFAULTS['path_zonedir'],
@@ -90,6 +129,36 @@ def test_key_get_zone_keys():
     keys = Dnskey.objects.get_zone_keys(TEST_ZONE_NAME)
     assert keys.count() == count + 2
 
+def test_key_get_zone_key():
+    from psz import models
+    key = Dnskey.from_dnssec_keygen(TEST_ZONE_NAME, keytype='KSK')
+    key.status = 'rolled-stage1'
+    key.save()
+    assert key.zone_hash == models.zone_hash(TEST_ZONE_NAME)
+    found = Dnskey.objects.get_zone_key(TEST_ZONE_NAME, 'rolled-stage1', 'KSK')
+    assert found.id == key.id
+    try:
+        Dnskey.objects.get_zone_key('other.' + TEST_ZONE_NAME,
+                                    'rolled-stage1', 'KSK')
+    except Dnskey.DoesNotExist:
+        pass
+    else:
+        assert False, 'found a key of another zone'
+
+def test_key_records():
+    from psz import models
+    key = Dnskey.from_dnssec_keygen(TEST_ZONE_NAME, keytype='KSK')
+    key.save()
+    keys = Dnskey.objects.filter(pk=key.id)
+    record, = models.key_records(keys)
+    assert record.rdata is None
+    assert record.keyname == key.keyname
+    assert record.path_public == key.path_public
+    assert record.path_private == key.path_private
+    assert record.read_dnsdata() == key.read_dnsdata()
+    record, = models.key_records(keys, rdata=True)
+    assert record.rdata == key.rdata
+
 def test_key_directory():
     key = Dnskey.from_dnssec_keygen(TEST_ZONE_NAME)
     key.save()
@@ -110,3 +179,119 @@ def test_named_keygen():
     dnstext = key2.dnsdata.split(' ', 3)[-1]
     dnskeys = dns.rrset.from_text(TEST_ZONE_NAME, 300, 'in', 'dnskey', dnstext)
     assert int(key2.keytag) == named.keytag(dnskeys[0]) 
+
+def test_native_keygen():
+    from psz import keygen
+    if not keygen.have_cryptography():
+        from nose.plugins.skip import SkipTest
+        raise SkipTest('cryptography is not installed')
+    config.DEFAULTS['keygen_backend'] = 'native'
+    try:
+        key = Dnskey.from_dnssec_keygen(TEST_ZONE_NAME, keytype='KSK')
+        key.save()
+        key2 = Dnskey.from_dnssec_keygen(TEST_ZONE_NAME,
+                                         algname='ECDSAP256SHA256')
+        key2.save()
+    finally:
+        config.DEFAULTS['keygen_backend'] = 'dnssec-keygen'
+    for k in (key, key2):
+        assert os.path.exists(k.path_public)
+        assert open(k.path_public).read() == k.dnsdata + '\n'
+        private = open(k.path_private).read()
+        assert private.startswith('Private-key-format: v1.')
+        dnstext = k.dnsdata.split(' ', 3)[-1]
+        dnskeys = dns.rrset.from_text(TEST_ZONE_NAME, 300, 'in', 'dnskey',
+                                      dnstext)
+        assert int(k.keytag) == named.keytag(dnskeys[0])
+    assert 'Modulus: ' in open(key.path_private).read()
+    assert dnskeys[0].flags == 256
+
+def test_native_keygen_cleanup():
+    from psz import keygen
+    import shutil
+    import tempfile
+    if not keygen.have_cryptography():
+        from nose.plugins.skip import SkipTest
+        raise SkipTest('cryptography is not installed')
+    def _broken(wire):
+        raise ValueError('broken')
+    directory = tempfile.mkdtemp()
+    saved = keygen._b64_words
+    keygen._b64_words = _broken
+    try:
+        try:
+            keygen._native_create_key(TEST_ZONE_NAME, 'ECDSAP256SHA256', 256,
+                                      'ZSK', directory)
+        except ValueError:
+            pass
+        else:
+            assert False, 'expected ValueError'
+        # the keytag's reservation was given back
+        assert os.listdir(directory) == []
+    finally:
+        keygen._b64_words = saved
+        shutil.rmtree(directory)
+
+def test_key_status_json():
+    from psz import models, tools
+    import json
+    import StringIO
+    import sys
+    tools.models = models
+    key = Dnskey.from_dnssec_keygen(TEST_ZONE_NAME, keytype='KSK')
+    key.save()
+    stdout = sys.stdout
+    sys.stdout = StringIO.StringIO()
+    try:
+        tools._show_zone_keystatus([TEST_ZONE_NAME], output='json')
+        output = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+    rows = [json.loads(line) for line in output.splitlines()]
+    assert rows
+    assert [row['zone'] for row in rows] == [TEST_ZONE_NAME] * len(rows)
+    types = [row['type'] for row in rows]
+    assert types == sorted(types)
+    assert key.keytag in [row['keytag'] for row in rows]
+
+def test_keypool():
+    from psz import models, tools
+    from psz.models import PooledKey
+    import shutil
+    import tempfile
+    pool_dir = tempfile.mkdtemp()
+    zone_dir = tempfile.mkdtemp()
+    saved = config.DEFAULTS['path_keypool']
+    config.DEFAULTS['path_keypool'] = pool_dir
+    algname = config.DEFAULTS['zsk_algorithm']
+    size = int(config.DEFAULTS['zsk_keysize'])
+    kind = ('ZSK', algname, size)
+    try:
+        assert PooledKey.objects.fill('ZSK', algname, size, 3) == 3
+        assert PooledKey.objects.stats()[kind] == 3
+        assert len(os.listdir(pool_dir)) == 6
+
+        # a row whose files are gone is dropped, not left to hide the rest
+        stale = PooledKey.objects.order_by('id')[0]
+        for ext in ('key', 'private'):
+            os.unlink(os.path.join(pool_dir, '%s.%s' % (stale.keyname, ext)))
+        key = Dnskey.from_keypool(TEST_ZONE_NAME, 'ZSK', directory=zone_dir)
+        assert key is not None and key.keytag != stale.keytag
+        assert not PooledKey.objects.filter(pk=stale.pk).count()
+        assert PooledKey.objects.stats()[kind] == 1
+        assert os.path.exists(key.path_public)
+        assert os.path.exists(key.path_private)
+        assert key.dnsdata.startswith(TEST_ZONE_NAME + '. ')
+        assert len(os.listdir(pool_dir)) == 2
+
+        counts = PooledKey.objects.stats()
+        wants = dict(tools._keypool_wants(counts, 4))
+        assert wants[kind] == 3
+        # refill only tops up kinds below the low water mark
+        assert kind not in dict(tools._keypool_wants(counts, 4, 1))
+        assert dict(tools._keypool_wants(counts, 4, 2))[kind] == 3
+    finally:
+        config.DEFAULTS['path_keypool'] = saved
+        PooledKey.objects.all().delete()
+        shutil.rmtree(pool_dir)
+        shutil.rmtree(zone_dir)
@@ -0,0 +1,44 @@
+from psz import delegation, errors
+import os
+import tempfile
+
+# The DNSKEY of RFC 4034 section 5.4 and RFC 4509 section 2.2
+ZONE = 'dskey.example.com'
+RDATA = ('256 3 5 AQOeiiR0GOMYkDshWoSKz9XzfwJr1AYtsmx3TGkJaNXVbfi/'
+         '2pHm822aJ5iI9BMzNXxeYCmZDRD99WYwYqUSdjMmmAphXdvxegXd/'
+         'M5+X7OrzKBaMbCVdFLUUh6DhweJBjEVv5f2wwjM9XzcnOf+EPbtG9DMBmADjFDc'
+         '2w/rljwvFw==')
+SHA1 = '2BB183AF5F22588179A53B0A98631FAD1A292118'
+SHA256 = 'D4B7D520E7BB5F0F67674A0CCEB1E3E0614B93C4F9E99B8383F6A1E4469DA50A'
+
+def test_digest():
+    assert delegation.digest(ZONE, RDATA, 1) == SHA1
+    assert delegation.digest(ZONE.upper() + '.', RDATA, 2) == SHA256
+    assert delegation.parse_digest_types('1, 2') == [1, 2]
+    try:
+        delegation.parse_digest_types('3')
+    except errors.PszConfigError:
+        pass
+    else:
+        assert False, "digest type 3 was accepted"
+
+def test_digest_cache():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        cache = delegation.DigestCache(path)
+        records = cache.ds_records(ZONE, '60485', RDATA, [1, 2])
+        assert records == [(ZONE, '60485', 5, 1, SHA1),
+                           (ZONE, '60485', 5, 2, SHA256)]
+        assert cache.computed == 2
+        cache.save()
+
+        cache = delegation.DigestCache(path)
+        assert cache.digest(ZONE, '60485', RDATA, 2) == SHA256
+        assert cache.computed == 0
+        # a different key with the same keytag isn't given the old digest
+        other = RDATA.replace('256', '257', 1)
+        assert cache.digest(ZONE, '60485', other, 2) != SHA256
+        assert cache.computed == 1
+    finally:
+        os.unlink(path)
@@ -0,0 +1,109 @@
+from psz import config, inventory
+import os
+import shutil
+import tempfile
+import time
+
+def _touch(path):
+    open(path, 'w').close()
+
+def _age(path):
+    old = time.time() - 60
+    os.utime(path, (old, old))
+
+def _record(zone, keytype, keytag, status, size=1024, updated=None):
+    from psz import models
+    return models.KeyRecord(None, zone, keytype, keytag, 'RSASHA1', size,
+                            status, updated, None)
+
+def test_scan_and_check():
+    zonedir = tempfile.mkdtemp()
+    try:
+        zone = os.path.join(zonedir, 'inv.test')
+        for sub in ('', 'newkeys', 'oldkeys'):
+            os.mkdir(os.path.join(zone, sub))
+        # active ZSK where it belongs
+        _touch(os.path.join(zone, 'Kinv.test.+005+00001.key'))
+        _touch(os.path.join(zone, 'Kinv.test.+005+00001.private'))
+        # published ZSK left in the zone directory
+        _touch(os.path.join(zone, 'Kinv.test.+005+00002.key'))
+        _touch(os.path.join(zone, 'Kinv.test.+005+00002.private'))
+        # untracked and missing its .private
+        _touch(os.path.join(zone, 'oldkeys', 'Kinv.test.+005+00004.key'))
+        for sub in ('', 'newkeys', 'oldkeys'):
+            _age(os.path.join(zone, sub))
+        _age(zonedir)
+
+        cache = zonedir + '.keyindex'
+        scanner = inventory.Scanner(zonedir, cache, workers=4)
+        index = scanner.scan()
+        assert scanner.rescanned == 4
+        assert index.zones == set(['inv.test'])
+        rows = [
+            _record('inv.test', 'ZSK', '00001', 'active'),
+            _record('inv.test', 'ZSK', '00002', 'published'),
+            _record('inv.test', 'KSK', '00003', 'active'),
+        ]
+        saved = config.DEFAULTS['path_zonedir']
+        config.DEFAULTS['path_zonedir'] = zonedir
+        try:
+            problems = inventory.check(index, rows)
+        finally:
+            config.DEFAULTS['path_zonedir'] = saved
+        tags = [(keytag, problem.split()[0]) for zone, keytag, problem
+                in problems]
+        assert ('1', 'ZSK') not in tags
+        assert ('2', 'ZSK') in tags
+        assert ('3', 'KSK') in tags
+        assert ('4', 'no') in tags
+        assert ('4', 'files') in tags
+
+        # unchanged directories come from the cache
+        scanner = inventory.Scanner(zonedir, cache, workers=4)
+        again = scanner.scan()
+        assert scanner.rescanned == 0
+        assert again.keys == index.keys
+    finally:
+        shutil.rmtree(zonedir)
+        if os.path.exists(cache):
+            os.unlink(cache)
+
+def test_audit_zone():
+    from psz import models, tools
+    import datetime
+    tools.models = models
+    zonedir = config.DEFAULTS['path_zonedir']
+    index = inventory.Index()
+    for ext in ('key', 'private'):
+        index.add(os.path.join(zonedir, 'a.test'), 'Ka.test.+005+00010.' + ext)
+        index.add(os.path.join(zonedir, 'a.test', 'newkeys'),
+                  'Ka.test.+005+00020.' + ext)
+    now = datetime.datetime.now()
+    rows = [
+        _record('a.test', 'KSK', '00010', 'active', 2048, now),
+        _record('a.test', 'ZSK', '00020', 'published', 1024, now),
+        _record('a.test', 'ZSK', '00030', 'new', 1024, now),
+    ]
+    problems = list(tools._audit_zone('a.test', rows, index, set([10, 99])))
+    found = sorted((p['source'], p['keytag']) for p in problems)
+    assert found == [('db', '99'), ('disk', '00030'), ('dns', '00020')]
+    problems = list(tools._audit_zone('a.test', rows[:1], index, None))
+    assert [p['source'] for p in problems] == ['dns']
+
+def test_audit_chunks():
+    from psz import models, tools
+    from psz.models import Dnskey
+    tools.models = models
+    zones = ['a.audit.test', 'b.audit.test']
+    for zone, status in zip(zones, ('active', 'expired')):
+        Dnskey(zone=zone, type='ZSK', status=status, algorithm='RSASHA1',
+               keytag='1', size=1024, keyname='K%s' % zone).save()
+    try:
+        for asked in (zones, []):
+            chunks = list(tools._audit_chunks(asked, 10))
+            found = [(zone, len(rows)) for chunk in chunks
+                     for zone, rows in chunk if zone in zones]
+            # b.audit.test has no live keys but is still audited
+            assert found == [('a.audit.test', 1), ('b.audit.test', 0)]
+    finally:
+        Dnskey.objects.filter(zone__in=zones).delete()
@@ -0,0 +1,117 @@
+from psz import config, errors, log
+import json
+import logging
+import threading
+
+class _Capture(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+        self.threads = set()
+
+    def emit(self, record):
+        self.records.append(record.getMessage())
+        self.threads.add(threading.current_thread().name)
+
+def _logged(func):
+    capture = _Capture()
+    log.LOGGER.addHandler(capture)
+    try:
+        func()
+        log.flush()
+    finally:
+        log.LOGGER.removeHandler(capture)
+    return capture
+
+def test_formats():
+    saved = config.DEFAULTS.get('log_format')
+    try:
+        config.DEFAULTS['log_format'] = 'text'
+        capture = _logged(lambda: log.log("rolled", zone='a.test', stage='x'))
+        assert capture.records[0].startswith('<lambda>: ')
+        assert capture.records[0].endswith(': rolled zone=a.test stage=x')
+
+        config.DEFAULTS['log_format'] = 'kv'
+        capture = _logged(lambda: log.log("two words", keytag=5))
+        assert capture.records[0].endswith('msg="two words" keytag=5')
+
+        config.DEFAULTS['log_format'] = 'json'
+        capture = _logged(lambda: log.log("done", zone='a.test'))
+        record = json.loads(capture.records[0])
+        assert record['msg'] == 'done' and record['zone'] == 'a.test'
+        assert record['caller'] == '<lambda>'
+    finally:
+        config.DEFAULTS['log_format'] = saved
+
+def test_async_and_error():
+    saved = config.DEFAULTS.get('log_async')
+    config.DEFAULTS['log_async'] = True
+    try:
+        def _log_many():
+            for i in range(100):
+                log.log("message %d" % i, zone='a.test')
+        capture = _logged(_log_many)
+        assert len(capture.records) == 100
+        assert capture.threads == set(['psz-log-writer'])
+
+        def _error():
+            try:
+                log.error("broken", zone='a.test')
+            except errors.PszFatalError, err:
+                assert str(err) == 'broken'
+            else:
+                assert False, "error() didn't raise"
+        log.EXIT_ON_ERROR = False
+        try:
+            capture = _logged(_error)
+        finally:
+            log.EXIT_ON_ERROR = True
+        assert 'broken' in capture.records[0]
+    finally:
+        config.DEFAULTS['log_async'] = saved
+
+class _FailingDns(object):
+    def update_dnskeys(self, zone, adds=(), deletes=()):
+        raise errors.PszDnsError("refused")
+
+def test_tool_error_fields():
+    from psz import tools
+    def _add():
+        try:
+            tools._add_keys_to_dns([], 'a.test', _FailingDns())
+        except errors.PszFatalError:
+            pass
+        else:
+            assert False, "no PszFatalError"
+    log.EXIT_ON_ERROR = False
+    try:
+        capture = _logged(_add)
+    finally:
+        log.EXIT_ON_ERROR = True
+    assert capture.records[0].endswith(
+        'Dns update error: (refused) zone=a.test stage=securezone')
+
+class _Broken(logging.Handler):
+    def emit(self, record):
+        raise IOError("syslog is gone")
+
+    def handleError(self, record):
+        raise
+
+def test_async_handler_error():
+    saved = config.DEFAULTS.get('log_async'), logging.raiseExceptions
+    config.DEFAULTS['log_async'] = True
+    logging.raiseExceptions = False
+    broken = _Broken()
+    log.LOGGER.addHandler(broken)
+    try:
+        try:
+            _logged(lambda: log.log("lost"))
+        finally:
+            log.LOGGER.removeHandler(broken)
+        # the writer lived on and flush() returned
+        capture = _logged(lambda: log.log("after"))
+        assert capture.threads == set(['psz-log-writer'])
+        assert 'after' in capture.records[0]
+    finally:
+        config.DEFAULTS['log_async'], logging.raiseExceptions = saved
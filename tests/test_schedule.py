@@ -0,0 +1,106 @@
+from psz import config, errors, scheduler
+from psz.models import Dnskey, ZonePolicy
+from datetime import datetime, timedelta
+
+ZONES = ['a.sched.test', 'b.sched.test', 'c.sched.test', 'd.sched.test',
+         'e.sched.test']
+
+def _key(zone, keytype, status, age):
+    key = Dnskey(zone=zone, type=keytype, status=status, algorithm='RSASHA1',
+                 keytag='1', size=1024, keyname='K%s' % zone,
+                 updated=datetime.now() - age)
+    key.save()
+    return key
+
+def teardown():
+    Dnskey.objects.filter(zone__in=ZONES).delete()
+    ZonePolicy.objects.filter(zone__in=ZONES).delete()
+
+def test_find_due():
+    days = config.DEFAULTS['zsk_lifetime_days']
+    # due for ZSK stage 1 and, first, KSK stage 2
+    _key(ZONES[0], 'ZSK', 'active', timedelta(days=days + 1))
+    _key(ZONES[0], 'KSK', 'rolled-stage1', timedelta(days=days + 1))
+    # not due yet
+    _key(ZONES[1], 'ZSK', 'active', timedelta(days=days - 1))
+    # due by its own policy only
+    _key(ZONES[2], 'ZSK', 'active', timedelta(days=3))
+    ZonePolicy(zone=ZONES[2], zsk_lifetime_days=2).save()
+    # due but disabled
+    _key(ZONES[3], 'ZSK', 'active', timedelta(days=days + 1))
+    ZonePolicy(zone=ZONES[3], enabled=False).save()
+
+    due = [(zone, stage) for priority, zone, stage in scheduler.find_due()
+           if zone in ZONES]
+    assert due == [(ZONES[0], 'rollover_ksk_stage2'),
+                   (ZONES[2], 'rollover_zsk_stage1')]
+
+class _Clock(object):
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+def test_release():
+    clock = _Clock()
+    tasks = [((3, -i), 'z%d' % i, 'rollover_zsk_stage1') for i in range(4)]
+    servers = {'z0': ('ns1',), 'z1': ('ns1',), 'z2': ('ns2',), 'z3': ('ns1',)}
+    limiter = scheduler.RateLimiter(10, 1, 1, clock())
+    started = [(clock(), task[1]) for task in
+               scheduler.release(tasks, servers, limiter, clock, clock.sleep)]
+    # z3 is the most overdue; z2 goes before z1 as ns2 isn't busy
+    assert [zone for when, zone in started] == ['z3', 'z2', 'z1', 'z0']
+    assert [round(when, 3) for when, zone in started] == [0, 0.1, 1, 2]
+
+class _Dns(object):
+    def __init__(self, answers):
+        self.answers = answers
+
+    def lookup_many(self, qnames, rdtype):
+        assert rdtype == 'DS'
+        return dict((qname, self.answers.get(qname, ())) for qname in qnames)
+
+def test_ksk_stage2_held():
+    days = config.DEFAULTS['zsk_lifetime_days']
+    zone = ZONES[4]
+    _key(zone, 'ZSK', 'active', timedelta(days=days + 1))
+    _key(zone, 'KSK', 'rolled-stage1', timedelta(days=days + 1))
+    due = [task for task in scheduler.find_due(every=True) if task[1] == zone]
+    assert [stage for priority, zone, stage in due] == [
+        'rollover_ksk_stage2', 'rollover_zsk_stage1']
+    # no DS for the new KSK: the ZSK rollover goes ahead
+    held = set([(zone, 'rollover_ksk_stage2')])
+    tasks = scheduler.one_per_zone(due, held)
+    assert [stage for priority, zone, stage in tasks] == ['rollover_zsk_stage1']
+    tasks = scheduler.one_per_zone(due)
+    assert [stage for priority, zone, stage in tasks] == ['rollover_ksk_stage2']
+
+def test_waiting_for_ds():
+    from psz import delegation
+    import dns.rrset
+    from test_ds import RDATA
+    zone = ZONES[1]
+    key = Dnskey(zone=zone, type='KSK', status='active', algorithm='RSASHA1',
+                 keytag='60485', size=1024, keyname='K%s' % zone)
+    key.dnsdata = '%s. IN DNSKEY %s' % (zone, RDATA)
+    key.save()
+    tasks = [((1, 0), zone, 'rollover_ksk_stage2'),
+             ((2, 0), ZONES[0], 'rollover_zsk_stage1')]
+    assert scheduler.waiting_for_ds(tasks, _Dns({})) == {
+        zone: "no DS in parent yet"}
+    old = dns.rrset.from_text(zone, 3600, 'IN', 'DS',
+                              '1 5 2 ' + delegation.digest(zone, RDATA, 2))
+    waiting = scheduler.waiting_for_ds(tasks, _Dns({zone: old}))
+    assert waiting[zone].startswith("no DS for the new KSK")
+    failed = errors.PszDnsError("timed out")
+    waiting = scheduler.waiting_for_ds(tasks, _Dns({zone: failed}))
+    assert waiting[zone] == "DS lookup failed: timed out"
+    new = dns.rrset.from_text(zone, 3600, 'IN', 'DS',
+                              '60485 5 2 ' + delegation.digest(zone, RDATA, 2))
+    assert scheduler.waiting_for_ds(tasks, _Dns({zone: new})) == {}
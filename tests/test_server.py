@@ -0,0 +1,61 @@
+from psz import server
+import socket
+
+def test_frames():
+    ours, theirs = socket.socketpair()
+    out = server._FrameWriter(ours, server.STDOUT)
+    print >>out, u'zone\xe9', 'ok'
+    server._send_frame(ours, server.EXIT, '3')
+    frames = []
+    while True:
+        kind, data = server._recv_frame(theirs)
+        frames.append((kind, data))
+        if kind == server.EXIT:
+            break
+    output = ''.join(data for kind, data in frames if kind == server.STDOUT)
+    assert output == u'zone\xe9 ok\n'.encode('utf-8')
+    assert frames[-1] == (server.EXIT, '3')
+    ours.close()
+    try:
+        server._recv_frame(theirs)
+    except EOFError:
+        pass
+    else:
+        assert False, 'no EOFError'
+
+def test_call_without_daemon():
+    assert server.call('/nonexistent/psz.sock', ['status']) is None
+
+def test_request_flushes_log():
+    from psz import config, log, tools
+    import logging
+    import os
+    import sys
+    import time
+
+    class _Slow(logging.Handler):
+        def __init__(self):
+            logging.Handler.__init__(self)
+            self.records = []
+
+        def emit(self, record):
+            time.sleep(0.2)
+            self.records.append(record.getMessage())
+
+    def _status():
+        log.log("served", zone='a.test')
+        return 0
+
+    saved = (config.DEFAULTS.get('log_async'), tools.status, sys.argv,
+             sys.stdin)
+    handler = _Slow()
+    config.DEFAULTS['log_async'] = True
+    tools.status = _status
+    log.LOGGER.addHandler(handler)
+    try:
+        rc = server._run_request({'argv': ['status'], 'cwd': os.getcwd()})
+        assert rc == 0
+        assert [r for r in handler.records if r.endswith('served zone=a.test')]
+    finally:
+        log.LOGGER.removeHandler(handler)
+        config.DEFAULTS['log_async'], tools.status, sys.argv, sys.stdin = saved
@@ -0,0 +1,238 @@
+import calendar
+import imp
+import os
+import shutil
+import struct
+import tempfile
+import time
+from array import array
+from cStringIO import StringIO
+
+import dns.message
+import dns.name
+import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+import dns.zone
+
+siggraph = imp.load_source('siggraph', os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), os.pardir, 'bin', 'siggraph'))
+
+ORIGIN = dns.name.from_text('sig.test.')
+
+def _soa(serial):
+    return 'ns1 hostmaster %d 3600 600 86400 300' % serial
+
+def _rrsig(expiration, keytag=1234):
+    stamp = '%04d%02d%02d%02d%02d%02d' % time.gmtime(expiration)[:6]
+    return ('A 5 2 300 %s 20200101000000 %d sig.test. '
+            'dGVzdA==' % (stamp, keytag))
+
+def _epoch(*date):
+    return calendar.timegm(date + (0, 0, 0))
+
+EXP1 = _epoch(2030, 1, 1, 12, 0, 0)
+EXP2 = _epoch(2030, 1, 2, 12, 0, 0)
+EXP3 = _epoch(2030, 1, 3, 12, 0, 0)
+
+def setup_module():
+    global TMPDIR
+    TMPDIR = tempfile.mkdtemp()
+
+def teardown_module():
+    shutil.rmtree(TMPDIR)
+
+def _write_zone(path, serial, expirations):
+    text = ['@ 300 IN SOA %s' % _soa(serial), '@ 300 IN NS ns1',
+            'ns1 300 IN A 192.0.2.1']
+    # identical RRSIGs would be merged into one
+    text.extend('www 300 IN RRSIG %s' % _rrsig(e, keytag)
+                for keytag, e in enumerate(expirations))
+    zone = dns.zone.from_text('\n'.join(text) + '\n', ORIGIN,
+                              relativize=False)
+    zone.to_file(path, relativize=False)
+
+def _rr(name, rdtype, text):
+    rdtype = dns.rdatatype.from_text(rdtype)
+    rdata = dns.rdata.from_text(dns.rdataclass.IN, rdtype, text, ORIGIN)
+    wire = StringIO()
+    rdata.to_wire(wire, origin=ORIGIN)
+    rdata = wire.getvalue()
+    owner = dns.name.from_text(name, ORIGIN).to_wire()
+    rr = owner + struct.pack('!HHIH', rdtype, dns.rdataclass.IN, 300,
+                             len(rdata)) + rdata
+    return struct.pack('!I', len(rr)) + rr
+
+def _write_journal(path, transactions, version='9'):
+    """transactions are (old serial, new serial, deleted expirations,
+    added expirations)."""
+    body = []
+    for old, new, deleted, added in transactions:
+        rrs = [_rr('@', 'SOA', _soa(old))]
+        rrs.extend(_rr('www', 'RRSIG', _rrsig(e)) for e in deleted)
+        rrs.append(_rr('@', 'SOA', _soa(new)))
+        rrs.extend(_rr('www', 'RRSIG', _rrsig(e)) for e in added)
+        data = ''.join(rrs)
+        if version == '9':
+            header = struct.pack('!III', len(data), old, new)
+        else:
+            header = struct.pack('!IIII', len(data), len(rrs), old, new)
+        body.append(header + data)
+    body = ''.join(body)
+    begin = siggraph._JOURNAL_HEADER_SIZE
+    header = siggraph._JOURNAL_HEADER.pack(';BIND LOG V%s\n' % version,
+        transactions[0][0], begin, transactions[-1][1], begin + len(body))
+    fp = open(path, 'wb')
+    fp.write(header.ljust(begin, '\0') + body)
+    fp.close()
+
+def test_read_zonefile():
+    path = os.path.join(TMPDIR, 'db.read')
+    _write_zone(path, 7, [EXP1, EXP2, EXP2])
+    serial, expirations = siggraph.read_zonefile(path)
+    assert serial == 7
+    assert sorted(expirations) == [EXP1, EXP2, EXP2]
+
+def test_read_journal():
+    for version in ('9', '9.2'):
+        path = os.path.join(TMPDIR, 'read.jnl')
+        _write_journal(path, [(1, 2, [EXP1], [EXP2]),
+                              (2, 3, [EXP2], [EXP3, EXP3])], version)
+        added, removed = array('L'), array('L')
+        assert siggraph.read_journal(path, 1, added, removed) == 3
+        assert list(added) == [EXP2, EXP3, EXP3]
+        assert list(removed) == [EXP1, EXP2]
+        # transactions before serial are already in the zone file
+        added, removed = array('L'), array('L')
+        assert siggraph.read_journal(path, 2, added, removed) == 3
+        assert list(added) == [EXP3, EXP3] and list(removed) == [EXP2]
+        assert siggraph._last_serial(path) == 3
+
+def test_file_changes():
+    path = os.path.join(TMPDIR, 'db.changes')
+    _write_zone(path, 1, [EXP1, EXP1])
+    _write_journal(path + '.jnl', [(1, 2, [EXP1], [EXP2])])
+    serial, full, added, removed = siggraph.file_changes(path)
+    assert (serial, full) == (2, True)
+    tally = siggraph.update_tally(siggraph.tally(added), added, removed, full)
+    assert tally == ([EXP1, EXP2], [1, 1])
+    # from a known serial only the journal is read
+    serial, full, added, removed = siggraph.file_changes(path, 1)
+    assert (serial, full, list(added), list(removed)) == \
+           (2, False, [EXP2], [EXP1])
+    # and without it the whole zone file
+    serial, full, added, removed = siggraph.file_changes(path, 1,
+                                                         journal=False)
+    assert (serial, full) == (1, True)
+
+def test_config_zonedir():
+    path = os.path.join(TMPDIR, 'psz.conf')
+    fp = open(path, 'w')
+    fp.write("path_zonedir = '/var/named/zones'\n")
+    fp.close()
+    assert siggraph.config_zonedir(path) == '/var/named/zones'
+    try:
+        siggraph.config_zonedir(os.path.join(TMPDIR, 'missing.conf'))
+    except ValueError:
+        pass
+    else:
+        assert False, 'expected ValueError'
+
+def _rrset(name, rdtype, text):
+    return dns.rrset.from_text(dns.name.from_text(name, ORIGIN), 300, 'IN',
+                               rdtype, text)
+
+def _message(*rrsets):
+    message = dns.message.Message()
+    message.answer.extend(rrsets)
+    return message
+
+def _xfr(messages):
+    calls = []
+    def xfr(server, zonename, rdtype=None, serial=None):
+        calls.append((rdtype, serial))
+        return iter(messages)
+    return xfr, calls
+
+def _changes(messages, serial):
+    saved = siggraph.dns.query.xfr
+    siggraph.dns.query.xfr, calls = _xfr(messages)
+    try:
+        return siggraph.xfr_changes('127.0.0.1', 'sig.test.', serial), calls
+    finally:
+        siggraph.dns.query.xfr = saved
+
+def test_xfr_changes():
+    soa = lambda serial: _rrset('@', 'SOA', _soa(serial))
+    sig = lambda e: _rrset('www', 'RRSIG', _rrsig(e))
+    # AXFR
+    (serial, full, added, removed), calls = _changes(
+        [_message(soa(3), sig(EXP1)), _message(sig(EXP2), soa(3))], None)
+    assert calls == [(None, None)]
+    assert (serial, full, list(added), list(removed)) == \
+           (3, True, [EXP1, EXP2], [])
+    # IXFR, one message per RR: the SOA toggles between deletions and
+    # additions
+    (serial, full, added, removed), calls = _changes(
+        [_message(soa(3)), _message(soa(1)), _message(sig(EXP1)),
+         _message(soa(2)), _message(sig(EXP2)), _message(soa(2)),
+         _message(sig(EXP2)), _message(soa(3)), _message(sig(EXP3)),
+         _message(soa(3))], 1)
+    assert calls == [(dns.rdatatype.IXFR, 1)]
+    assert (serial, full, list(added), list(removed)) == \
+           (3, False, [EXP2, EXP3], [EXP1, EXP2])
+    # the server answered the IXFR with the whole zone
+    (serial, full, added, removed), calls = _changes(
+        [_message(soa(3), _rrset('@', 'NS', 'ns1'), sig(EXP1), soa(3))], 1)
+    assert (serial, full, list(added), list(removed)) == \
+           (3, True, [EXP1], [])
+    # up to date, only the current SOA comes back
+    (serial, full, added, removed), calls = _changes([_message(soa(3))], 3)
+    assert (serial, full, list(added), list(removed)) == (3, False, [], [])
+
+def test_tallies():
+    expirations = array('L', [EXP2, EXP1, EXP2, EXP3])
+    saved = siggraph.numpy
+    try:
+        for numpy in (saved, None):
+            siggraph.numpy = numpy
+            tally = siggraph.tally(expirations)
+            assert tally == ([EXP1, EXP2, EXP3], [1, 2, 1])
+            assert siggraph.histogram(tally, 2 * 86400) == [
+                (EXP1 // (2 * 86400) * 2 * 86400, 1),
+                (EXP3 // (2 * 86400) * 2 * 86400, 3)]
+            assert siggraph.percentiles(tally, [0, 25, 50, 100]) == [
+                (0, EXP1), (25, EXP1), (50, EXP2), (100, EXP3)]
+    finally:
+        siggraph.numpy = saved
+    tally = siggraph.tally(expirations)
+    updated = siggraph.update_tally(tally, array('L', [EXP3]),
+                                    array('L', [EXP2, EXP1]))
+    assert updated == ([EXP2, EXP3], [1, 2])
+    try:
+        siggraph.update_tally(tally, array('L'), array('L', [12345]))
+    except ValueError:
+        pass
+    else:
+        assert False, 'expected ValueError'
+
+def test_survey():
+    statedir = os.path.join(TMPDIR, 'state')
+    os.mkdir(statedir)
+    calls = []
+    def changes(serial):
+        calls.append(serial)
+        if serial is None:
+            return 2, True, array('L', [EXP1, EXP2]), array('L')
+        # removes an RRSIG the saved tally doesn't have
+        return 3, False, array('L'), array('L', [EXP3])
+    assert siggraph.survey(changes, 'sig.test.', statedir) == \
+           (2, ([EXP1, EXP2], [1, 1]))
+    assert siggraph.load_state(statedir, 'sig.test.') == \
+           (2, ([EXP1, EXP2], [1, 1]))
+    # the state and the changes don't agree, start over from the whole zone
+    del calls[:]
+    assert siggraph.survey(changes, 'sig.test.', statedir) == \
+           (2, ([EXP1, EXP2], [1, 1]))
+    assert calls == [2, None]
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+"Compare the speed of psz's keytag functions with the per byte checksum."
+
+import sys
+import os
+import base64
+import struct
+import timeit
+import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
+import psz.named
+
+def reference_keytag(dnskey):
+    """The RFC 4034 appendix B checksum, one byte at a time."""
+    if dnskey.algorithm == 1:
+        return (ord(dnskey.key[-3]) << 8) + ord(dnskey.key[-2])
+    header = struct.pack("!HBB", dnskey.flags, dnskey.protocol,
+                         dnskey.algorithm)
+    ac = 0
+    for i, value in enumerate(ord(x) for x in header + dnskey.key):
+        if i % 2:
+            ac += value
+        else:
+            ac += (value << 8)
+    ac += (ac >> 16) & 0xffff
+    return ac & 0xffff
+
+def make_keys(count, size=2048):
+    """Make count DNSKEYs with random RSA sized public keys."""
+    keys = []
+    for i in range(count):
+        key = '\x03\x01\x00\x01' + os.urandom(size // 8)
+        text = '256 3 8 %s' % base64.b64encode(key)
+        keys.append(dns.rdata.from_text(dns.rdataclass.IN,
+                                        dns.rdatatype.DNSKEY, text))
+    return keys
+
+def main(args):
+    try:
+        count = int(args[1])
+    except (IndexError, ValueError):
+        count = 10000
+    keys = make_keys(count)
+    expected = [reference_keytag(key) for key in keys]
+    assert psz.named.keytags(keys) == expected
+
+    runs = [
+        ('per byte', lambda: [reference_keytag(key) for key in keys]),
+        ('keytag', lambda: [psz.named.keytag(key) for key in keys]),
+        ('keytags', lambda: psz.named.keytags(keys)),
+    ]
+    print "%d 2048 bit keys, numpy %s" % (count,
+        psz.named.numpy is not None and 'on' or 'off')
+    base = None
+    for name, func in runs:
+        seconds = min(timeit.repeat(func, number=1, repeat=3))
+        if base is None:
+            base = seconds
+        print "%-10s %8.3fs %6.1fx" % (name, seconds, base / seconds)
+
+if __name__ == '__main__':
+    main(sys.argv)